@@ -4,34 +4,84 @@ been configured for audio ingestion.  It will trigger the main Step Functions wo
 No checks are made here to see if a file is already being processed, as there are multiple modes for Transcribe,
 and the configured settings can be overridden - existing jobs will be properly checked later in the workflow
 
+As well as direct S3 event notifications it will also accept batches of SQS messages, which lets bulk drops of files
+be ingested in batches rather than one invocation per file.  Every object in the event is validated concurrently,
+and an outcome is reported for each of them.  If content deduplication is enabled then any audio file that is a copy
+of one that has already been processed is linked to the original rather than being processed again, and a copy of one
+that is still being processed is sent back to the ingestion queue to be checked again later
+
 Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 import json
 import urllib.parse
+import threading
+import random
+import time
 import boto3
 import pcaconfiguration as cf
-import pcacommon
+import pcacontentdedup
+import pcabulkscheduler
 import filetype
 import os
 
-TMP_DIR = "/tmp/"
 VALID_MIME_TYPES = ["audio", "video"]
 SUMMARIZE = os.getenv("SUMMARIZE", "false")
+INGESTION_QUEUE_URL = os.getenv("INGESTION_QUEUE_URL", "")
+
+# The filetype library only ever looks at this many bytes at the start of a file
+MIME_SNIFF_BYTES = 261
+
+# Step Function ARN is cached across invocations of a warm Lambda container
+state_machine_arn = None
+
+# Batch ingestion settings - objects are validated in parallel, but we limit how hard we push Step Functions
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", "10"))
+SFN_START_CONCURRENCY = int(os.getenv("SFN_START_CONCURRENCY", "4"))
+SFN_START_RETRIES = int(os.getenv("SFN_START_RETRIES", "5"))
+SFN_START_BACKOFF = 0.2
+SFN_THROTTLE_ERRORS = ["ThrottlingException", "TooManyRequestsException", "RequestLimitExceeded"]
+start_execution_slots = threading.BoundedSemaphore(SFN_START_CONCURRENCY)
+
+# Per-object ingestion outcomes
+INGEST_STARTED = "STARTED"
+INGEST_SKIPPED = "SKIPPED"
+INGEST_FAILED = "FAILED"
+INGEST_DUPLICATE = "DUPLICATE"
+INGEST_DEFERRED = "DEFERRED"
 
 
-def get_invalid_mime_type(filename):
+def get_file_header(s3_client, bucket, key, object_size):
+    """
+    Reads just enough bytes from the start of an S3 object for us to be able to work out its mime type
+
+    :param s3_client: Boto3 client for S3
+    :param bucket: Bucket holding the object
+    :param key: Key of the object
+    :param object_size: Size of the object, as a ranged read of an empty object will fail
+    :return: Bytes at the start of the object
+    """
+    if object_size == 0:
+        return b""
+
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{MIME_SNIFF_BYTES - 1}")
+    return response["Body"].read()
+
+
+def get_invalid_mime_type(filename, file_header):
     """
     Checks to see if the file's mime type is one that we support or not.  We return the invalid mime type
     if we do not support this file type, or None if we do
 
-    :param filename: Local filename
+    :param filename: Name of the file
+    :param file_header: Bytes at the start of the file
     :return: Invalid mime type (or None if it's valid)
     """
 
     # Guess the mime-type, noting that the filetype library doesn't classify everything
-    guess = filetype.guess(filename)
+    guess = filetype.guess(file_header)
     if guess is not None:
         mime_type = guess.mime
     else:
@@ -51,24 +101,21 @@ def get_invalid_mime_type(filename):
     return mime_type
 
 
-def verify_transcribe_file(bucket, key):
+def verify_transcribe_file(bucket, key, s3Client=None):
     """
     Loads in the specified JSON file and validates if it is an Amazon Transcribe output file
 
     :param bucket: S3 bucket holding the JSON file
     :param key: Location of the JSON file in the S3 bucket
+    :param s3Client: Pre-initialised boto3 client for S3, but a new one will be created if required
     :return: Flag indicating if this file is an Amazon Transcribe file
     """
 
-    # Download our JSON file to local storage
+    # Load the JSON file straight into memory - several may be being checked at once, so we avoid local storage
     transcribe_file = False
-    inputFilename = TMP_DIR + key.split('/')[-1]
-    s3Client = boto3.client('s3')
-    s3Client.download_file(bucket, key, inputFilename)
-
-    # Load the JSON file into memory
-    json_filepath = Path(inputFilename)
-    asr_output = json.load(open(json_filepath.absolute(), "r", encoding="utf-8"))
+    if s3Client is None:
+        s3Client = boto3.client('s3')
+    asr_output = json.loads(s3Client.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
 
     # Standard Transcribe should have a ["results"]["transcripts"] line
     if "results" in asr_output:
@@ -77,20 +124,57 @@ def verify_transcribe_file(bucket, key):
     elif "Transcript" in asr_output and "LanguageCode" in asr_output:
         transcribe_file = True
 
-    # Remove our temporary file in case of Lambda container re-use
-    pcacommon.remove_temp_file(inputFilename)
-
     return transcribe_file
 
 
-def lambda_handler(event, context):
-    # Load our configuration
-    cf.loadConfiguration()
+def get_ingest_records(event):
+    """
+    Extracts the list of objects to be processed from the triggering event.  This can either be an S3 event
+    notification, holding one or more records, or a batch of SQS messages.  Each SQS message can hold an S3
+    event notification or a simple {"bucket": ..., "key": ...} request, as written by other ingestion tools
 
-    # Get handles to the object from the event
-    s3 = boto3.client("s3")
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    :param event: Lambda event
+    :return: List of ingest records, each holding the bucket, key and any SQS message ID
+    """
+    ingest_records = []
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:sqs":
+            body = json.loads(record["body"])
+            if "Records" in body:
+                # S3 event notification delivered via SQS
+                for s3_record in body["Records"]:
+                    ingest_records.append({"bucket": s3_record["s3"]["bucket"]["name"],
+                                           "key": urllib.parse.unquote_plus(s3_record["s3"]["object"]["key"],
+                                                                            encoding='utf-8'),
+                                           "messageId": record["messageId"]})
+            elif "bucket" in body and "key" in body:
+                ingest_records.append({"bucket": body["bucket"], "key": body["key"],
+                                       "messageId": record["messageId"]})
+            else:
+                # Probably an s3:TestEvent when the notification was created - nothing to do
+                print(f"Ignoring SQS message {record['messageId']} with no objects to process")
+        elif "s3" in record:
+            ingest_records.append({"bucket": record['s3']['bucket']['name'],
+                                   "key": urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')})
+
+    return ingest_records
+
+
+def process_object(bucket, key, s3, sfn_client):
+    """
+    Validates a single newly-arrived object and, if it's something that we can process, starts the
+    Step Functions workflow for it
+
+    :param bucket: Bucket holding the object
+    :param key: Key of the object
+    :param s3: Boto3 client for S3
+    :param sfn_client: Boto3 client for Step Functions
+    :return: Ingestion status of the object
+    :return: Message describing what happened to the object
+    :return: Content deduplication result, or None if the object was not checked for duplicates
+    """
+    ingest_status = INGEST_SKIPPED
+    dedup_result = None
 
     # Check if there's actually a file and that this wasn't just a folder creation event
     key_filename = key.split("/")[-1]
@@ -100,7 +184,7 @@ def lambda_handler(event, context):
     else:
         # Validate that the object exists
         try:
-            response = s3.get_object(Bucket=bucket, Key=key)
+            response = s3.head_object(Bucket=bucket, Key=key)
         except Exception as e:
             print(e)
             raise Exception(
@@ -111,9 +195,10 @@ def lambda_handler(event, context):
             # This came from the transcript bucket, not the audio bucket
             if key.endswith(".json"):
                 # Currently we only process Transcribe JSON files
-                if verify_transcribe_file(bucket, key):
+                if verify_transcribe_file(bucket, key, s3):
                     # Looks like a Transcribe file - start the workflow
-                    invoke_step_function(bucket, key, "transcript")
+                    invoke_step_function(bucket, key, "transcript", sfn_client)
+                    ingest_status = INGEST_STARTED
                     final_message = f"Post-call analytics workflow for file {key} successfully started."
                 else:
                     # Not a Transcribe file - possibly a CTR file, but regardless we can't process it here
@@ -121,59 +206,216 @@ def lambda_handler(event, context):
             else:
                 final_message = f"File \'{key.split('/')[-1]}\' is not processable by PCA: Transcribe JSON files only"
         else:
-            # Download our object to local file storage
-            local_filename = TMP_DIR + key.split('/')[-1]
-            s3_client = boto3.client('s3')
-            s3_client.download_file(bucket, key, local_filename)
-
-            # Get some file metadata to see what kind of file this actually is
-            invalid_mime = get_invalid_mime_type(local_filename)
-            pcacommon.remove_temp_file(local_filename)
+            # Get some file metadata to see what kind of file this actually is, which only needs the first few bytes
+            file_header = get_file_header(s3, bucket, key, response["ContentLength"])
+            invalid_mime = get_invalid_mime_type(key_filename, file_header)
             if invalid_mime is not None:
                 # File metadata contains at least one banned tag
                 final_message = f"File \'{key.split('/')[-1]}\' is not processable by PCA: {invalid_mime}"
             else:
-                # File looks good - go find our Step Function
-                invoke_step_function(bucket, key, "audio")
-                final_message = f"Post-call analytics workflow for file {key} successfully started."
+                # File looks good, but if it's a copy of something that we've already ingested then just link it
+                fingerprint = None
+                original = None
+                if pcacontentdedup.is_content_dedup_enabled():
+                    fingerprint = pcacontentdedup.create_content_fingerprint(s3, bucket, key, response)
+                    original = pcacontentdedup.claim_content_fingerprint(fingerprint, bucket, key)
+                    dedup_result = {"hit": original is not None, "costSaved": 0.0}
+
+                if (original is not None) and not pcacontentdedup.has_content_results(original):
+                    # The original could still fail, so check this copy again once it has had time to finish, or
+                    # just process it if there's no queue to send it back to
+                    dedup_result = None
+                    if INGESTION_QUEUE_URL != "":
+                        defer_object(bucket, key)
+                        ingest_status = INGEST_DEFERRED
+                        final_message = f"File {key} is a copy of {original['OriginalKey']}, which is still being " \
+                                        f"processed, so it will be checked again in " \
+                                        f"{pcacontentdedup.DEDUP_DEFER_SECONDS}s"
+                    else:
+                        invoke_step_function(bucket, key, "audio", sfn_client)
+                        ingest_status = INGEST_STARTED
+                        final_message = f"Post-call analytics workflow for file {key} successfully started, " \
+                                        f"as it can't wait for {original['OriginalKey']} to finish processing"
+                elif original is not None:
+                    pcacontentdedup.link_duplicate(fingerprint, bucket, key)
+                    dedup_result["costSaved"] = pcacontentdedup.estimate_cost_saved(original)
+                    ingest_status = INGEST_DUPLICATE
+                    final_message = f"File {key} is a duplicate of {original['OriginalKey']}, " \
+                                    f"results: {original['ParsedResultsFile']}"
+                else:
+                    # Go find our Step Function - if it can't be started then nothing will produce the results
+                    # for our claim, so give it up and let a copy take over
+                    try:
+                        invoke_step_function(bucket, key, "audio", sfn_client, fingerprint)
+                    except Exception:
+                        if fingerprint is not None:
+                            pcacontentdedup.release_content_fingerprint(fingerprint, bucket, key)
+                        raise
+                    ingest_status = INGEST_STARTED
+                    final_message = f"Post-call analytics workflow for file {key} successfully started."
+
+    return ingest_status, final_message, dedup_result
+
+
+def process_ingest_record(ingest_record, s3, sfn_client):
+    """
+    Processes a single ingest record, catching any failure so that it can be reported against just this record.
+    Any object that doesn't start a workflow gives up its bulk in-flight slot, as no workflow will ever release it
+
+    :param ingest_record: Ingest record, as created by get_ingest_records()
+    :param s3: Boto3 client for S3
+    :param sfn_client: Boto3 client for Step Functions
+    :return: Outcome for this record
+    """
+    outcome = {"bucket": ingest_record["bucket"], "key": ingest_record["key"]}
+    try:
+        outcome["status"], outcome["message"], dedup_result = process_object(ingest_record["bucket"],
+                                                                             ingest_record["key"], s3, sfn_client)
+        if dedup_result is not None:
+            outcome["dedup"] = dedup_result
+    except Exception as e:
+        outcome["status"] = INGEST_FAILED
+        outcome["message"] = str(e)
+
+    if outcome["status"] != INGEST_STARTED:
+        pcabulkscheduler.finish_in_flight(ingest_record["bucket"], ingest_record["key"])
+
+    print(f"{outcome['status']}: {outcome['message']}")
+    return outcome
 
-    # Return our final message
-    print(final_message)
+
+def lambda_handler(event, context):
+    # Load our configuration
+    cf.loadConfiguration()
+
+    # Get handles to the objects from the event - clients are created up front as they are shared by our threads
+    s3 = boto3.client("s3")
+    sfn_client = boto3.client('stepfunctions')
+    ingest_records = get_ingest_records(event)
+
+    # Validate every object concurrently - starting the workflows has its own tighter concurrency limit
+    outcomes = []
+    if ingest_records:
+        with ThreadPoolExecutor(max_workers=min(INGEST_THREADS, len(ingest_records))) as executor:
+            outcomes = list(executor.map(lambda x: process_ingest_record(x, s3, sfn_client), ingest_records))
+    failures = [ingest_records[index] for index, outcome in enumerate(outcomes) if outcome["status"] == INGEST_FAILED]
+    report_dedup_results(outcomes)
+
+    # Queued messages report their own failures so that only they are retried
+    if any("messageId" in ingest_record for ingest_record in ingest_records):
+        failed_messages = {failure["messageId"] for failure in failures if "messageId" in failure}
+        return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_messages]}
+
+    # Direct S3 notifications have no per-record retry, so fail the invocation if anything failed
+    if failures:
+        raise Exception(f"Failed to process {len(failures)} of {len(ingest_records)} object(s): " +
+                        "; ".join([outcome["message"] for outcome in outcomes if outcome["status"] == INGEST_FAILED]))
+
+    # Return our final message, which is just the message text if there was only one object
+    if len(outcomes) == 1:
+        final_message = outcomes[0]["message"]
+    else:
+        final_message = outcomes
     return {
         'statusCode': 200,
         'body': json.dumps(final_message)
     }
 
 
-def invoke_step_function(bucket, key, file_type):
+def report_dedup_results(outcomes):
+    """
+    Logs a summary of the content deduplication checks made in this invocation, as a JSON line that
+    CloudWatch Logs metric filters can pick out
+
+    :param outcomes: List of ingestion outcomes
+    """
+    dedup_results = [outcome["dedup"] for outcome in outcomes if "dedup" in outcome]
+    if dedup_results:
+        hits = sum(1 for dedup_result in dedup_results if dedup_result["hit"])
+        print(json.dumps({"ContentDedup": {"Hits": hits,
+                                           "Misses": len(dedup_results) - hits,
+                                           "EstimatedCostSaved": round(sum(dedup_result["costSaved"]
+                                                                           for dedup_result in dedup_results), 4)}}))
+
+
+def defer_object(bucket, key):
+    """
+    Sends an object back to the ingestion queue, delayed so that it is checked again later
+
+    :param bucket: Bucket holding the object
+    :param key: Key of the object
+    """
+    boto3.client("sqs").send_message(QueueUrl=INGESTION_QUEUE_URL,
+                                     MessageBody=json.dumps({"bucket": bucket, "key": key}),
+                                     DelaySeconds=pcacontentdedup.DEDUP_DEFER_SECONDS)
+
+
+def invoke_step_function(bucket, key, file_type, sfnClient=None, content_fingerprint=None):
     """
     Attempts to invoke a new Step Function instance to start to process this file.  As well as the file
-    location it also passes info to the Step Function about the type of file that triggered it.
+    location it also passes info to the Step Function about the type of file that triggered it.  The number
+    of concurrent start requests is limited, and any that are throttled are retried with an exponential backoff
 
     :param bucket: Bucket holding the input trigger file
     :param key: Key of for the input trigger file
     :param file_type: The type of file, either "audio" or "transcript"
+    :param sfnClient: Pre-initialised boto3 client for Step Functions, but a new one will be created if required
+    :param content_fingerprint: Content fingerprint claimed by this file, if deduplication is enabled
     """
-    ourStepFunction = cf.appConfig[cf.COMP_SFN_NAME]
-    sfnClient = boto3.client('stepfunctions')
-    sfnMachinesResult = sfnClient.list_state_machines(maxResults=1000)
-
-    sfnArnList = list(
-        filter(lambda x: x["stateMachineArn"].endswith(ourStepFunction), sfnMachinesResult["stateMachines"]))
-    if sfnArnList == []:
-        # Doesn't exist
-        raise Exception(
-            'Cannot find configured Step Function \'{}\' in the AWS account in this region - cannot begin workflow.'.format(
-                ourStepFunction))
-
-    # Trigger a new Step Function execution
-    sfnArn = sfnArnList[0]['stateMachineArn']
-    parameters = '{\n  \"bucket\": \"' + bucket + '\",\n' + \
-                 '  \"key\": \"' + key + '\",\n' + \
-                 '  \"inputType\": \"' + file_type + '\",\n' + \
-                 '  \"summarize\": \"' + SUMMARIZE + '\"\n' + \
-                 '}'
-    sfnClient.start_execution(stateMachineArn=sfnArn, input=parameters)
+    if sfnClient is None:
+        sfnClient = boto3.client('stepfunctions')
+    sfn_input = {"bucket": bucket, "key": key, "inputType": file_type, "summarize": SUMMARIZE}
+    if content_fingerprint is not None:
+        sfn_input["contentFingerprint"] = content_fingerprint
+    parameters = json.dumps(sfn_input, indent=2)
+
+    with start_execution_slots:
+        for attempt in range(SFN_START_RETRIES + 1):
+            try:
+                # Trigger a new Step Function execution - if our cached ARN is stale then look it up again, but only once
+                try:
+                    sfnClient.start_execution(stateMachineArn=get_state_machine_arn(sfnClient), input=parameters)
+                except sfnClient.exceptions.StateMachineDoesNotExist:
+                    sfnClient.start_execution(stateMachineArn=get_state_machine_arn(sfnClient, refresh=True),
+                                              input=parameters)
+                return
+            except ClientError as e:
+                if (e.response["Error"]["Code"] not in SFN_THROTTLE_ERRORS) or (attempt == SFN_START_RETRIES):
+                    raise
+                backoff = SFN_START_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+                print(f"Step Functions throttled starting workflow for {key}, retrying in {backoff:.2f}s")
+                time.sleep(backoff)
+
+
+def get_state_machine_arn(sfn_client, refresh=False):
+    """
+    Returns the ARN of our configured Step Function.  This is looked up on the first call and then cached, so
+    that a warm Lambda container doesn't have to list every Step Function in the account for every file
+
+    :param sfn_client: Boto3 client for Step Functions
+    :param refresh: Ignore any cached value and look up the ARN again
+    :return: ARN of the Step Function
+    """
+    global state_machine_arn
+
+    if (state_machine_arn is None) or refresh:
+        ourStepFunction = cf.appConfig[cf.COMP_SFN_NAME]
+        state_machine_arn = None
+        paginator = sfn_client.get_paginator('list_state_machines')
+        for page in paginator.paginate():
+            sfnArnList = list(
+                filter(lambda x: x["stateMachineArn"].endswith(ourStepFunction), page["stateMachines"]))
+            if sfnArnList != []:
+                state_machine_arn = sfnArnList[0]['stateMachineArn']
+                break
+
+        if state_machine_arn is None:
+            # Doesn't exist
+            raise Exception(
+                'Cannot find configured Step Function \'{}\' in the AWS account in this region - cannot begin workflow.'.format(
+                    ourStepFunction))
+
+    return state_machine_arn
 
 
 # Main entrypoint
@@ -0,0 +1,108 @@
+"""
+This python function indexes call transcripts in Kendra off the critical path of the main processing workflow.
+The transcript processing step writes each call's Kendra documents to S3 and queues a message pointing to them - a
+long call's transcript may be split across several linked documents.  This function receives batches of those
+messages, loads the documents concurrently and submits them to Kendra in batches of up to 10, retrying any documents
+that fail, and then removes any parts left over from when a call was last indexed in more parts.  Only the messages
+for calls whose documents still could not all be indexed are reported as failures, so that just they are retried by
+the queue.  Documents that Kendra rejects outright are logged straight away instead, as retrying them would never
+succeed.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from pcakendrasearch import load_kendra_documents, put_kendra_documents, delete_stale_kendra_parts
+
+INDEXER_THREADS = int(os.getenv("INDEXER_THREADS", "10"))
+
+
+def load_queued_documents(record):
+    """
+    Loads the Kendra documents for the call that a queue message points to
+
+    :param record: SQS message record
+    :return: Tuple of (message id, message body, documents), where the documents are None if they couldn't be loaded,
+             or empty if they have gone because an earlier copy of this message was indexed
+    """
+    body = json.loads(record["body"])
+    try:
+        return record["messageId"], body, load_kendra_documents(body["bucket"], body["key"])
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "NoSuchKey":
+            print(f"Kendra document s3://{body['bucket']}/{body['key']} has already been indexed")
+            return record["messageId"], body, []
+        print(f"Unable to load Kendra document s3://{body['bucket']}/{body['key']}: {str(e)}")
+        return record["messageId"], body, None
+
+
+def remove_indexed_documents(messages):
+    """
+    Deletes the S3 copies of documents that have been indexed, in batches.  Failures are only logged
+
+    :param messages: List of message bodies for the indexed documents
+    """
+    s3_client = boto3.client("s3")
+    keys_by_bucket = {}
+    for body in messages:
+        keys = keys_by_bucket.setdefault(body["bucket"], [])
+        if body["key"] not in keys:
+            keys.append(body["key"])
+
+    for bucket, keys in keys_by_bucket.items():
+        for batch_start in range(0, len(keys), 1000):
+            batch = keys[batch_start:batch_start + 1000]
+            try:
+                s3_client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in batch],
+                                                                "Quiet": True})
+            except Exception as e:
+                print(f"Unable to remove {len(batch)} indexed Kendra document(s) from {bucket}: {str(e)}")
+
+
+def lambda_handler(event, context):
+    """
+    Lambda function entrypoint
+    """
+    # Load every call's documents at the same time
+    records = event.get("Records", [])
+    loaded = []
+    if records:
+        with ThreadPoolExecutor(max_workers=min(INDEXER_THREADS, len(records))) as executor:
+            loaded = list(executor.map(load_queued_documents, records))
+    failed_messages = [message_id for message_id, body, documents in loaded if documents is None]
+
+    # Group the calls by index, and then by their main document id, as a call may have been queued more than once -
+    # each of its messages points to its own copy of the documents, so order them by when they were queued
+    indexes = {}
+    for message_id, body, documents in sorted(loaded, key=lambda queued: queued[1].get("queuedAt", 0)):
+        if documents:
+            indexes.setdefault(body["indexId"], {}).setdefault(documents[0]["Id"], []).append((message_id, body,
+                                                                                               documents))
+
+    # Submit the latest version of each index's documents in batches, then tidy up the calls that were indexed
+    indexed = []
+    for index_id, index_calls in indexes.items():
+        indexed_calls = []
+        failures, rejected = put_kendra_documents(index_id, [document for queued in index_calls.values()
+                                                             for document in queued[-1][2]])
+        for call_id, queued in index_calls.items():
+            for document in queued[-1][2]:
+                if document["Id"] in rejected:
+                    print(f"ERROR: Kendra rejected document {document['Id']}, so it will not be retried: "
+                          f"{rejected[document['Id']]}")
+            call_failures = [document["Id"] for document in queued[-1][2] if document["Id"] in failures]
+            if call_failures:
+                for document_id in call_failures:
+                    print(f"ERROR: Failed to index document {document_id}: {failures[document_id]}")
+                failed_messages += [message_id for message_id, body, documents in queued]
+            else:
+                indexed += [body for message_id, body, documents in queued]
+                indexed_calls.append(queued[-1][2])
+        delete_stale_kendra_parts(index_id, indexed_calls)
+    remove_indexed_documents(indexed)
+
+    # Report just the failed messages, so that only they are retried
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_messages]}
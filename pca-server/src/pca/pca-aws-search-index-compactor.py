@@ -0,0 +1,114 @@
+"""
+This python function maintains the embedded transcript search index.  It runs on a schedule, and applies all of the
+call updates that have been written to the pending folder since it last ran to a local copy of the index database,
+replacing the earlier rows of any call that has been processed again.  It then compacts the index and writes it back
+to S3 for the query function, and only then removes the updates that it applied.
+
+Only one copy of this function should run at a time, as each one replaces the whole database in S3.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import pcaconfiguration as cf
+import pcacommon
+import pcasearchindex
+
+COMPACTOR_THREADS = int(os.getenv("COMPACTOR_THREADS", "10"))
+COMPACTOR_MAX_UPDATES = int(os.getenv("COMPACTOR_MAX_UPDATES", "5000"))
+COMPACTOR_DATABASE_FILE = "/tmp/transcripts-compact.db"
+
+
+def list_pending_updates(bucket):
+    """
+    Lists the pending search index updates, oldest first, up to the most that we will apply in one run
+
+    :param bucket: Bucket holding the search index
+    :return: List of S3 keys of the pending updates
+    """
+    keys = []
+    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=pcasearchindex.SEARCH_INDEX_PENDING_PREFIX):
+        keys += [item["Key"] for item in page.get("Contents", [])]
+        if len(keys) >= COMPACTOR_MAX_UPDATES:
+            break
+    return sorted(keys)[:COMPACTOR_MAX_UPDATES]
+
+
+def load_pending_update(bucket, key):
+    """
+    Loads a pending search index update
+
+    :param bucket: Bucket holding the search index
+    :param key: S3 key of the update
+    :return: Search index update, or None if it couldn't be loaded
+    """
+    try:
+        response = boto3.client("s3").get_object(Bucket=bucket, Key=key)
+        return json.loads(response["Body"].read().decode("utf-8"))
+    except Exception as e:
+        print(f"Unable to load search index update s3://{bucket}/{key}: {str(e)}")
+        return None
+
+
+def remove_applied_updates(bucket, keys):
+    """
+    Deletes the pending updates that have been applied, in batches.  Failures are only logged, as applying
+    an update again just replaces the call's rows with the same ones
+
+    :param bucket: Bucket holding the search index
+    :param keys: S3 keys of the applied updates
+    """
+    s3_client = boto3.client("s3")
+    for batch_start in range(0, len(keys), 1000):
+        batch = keys[batch_start:batch_start + 1000]
+        try:
+            s3_client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in batch],
+                                                            "Quiet": True})
+        except Exception as e:
+            print(f"Unable to remove {len(batch)} applied search index update(s) from {bucket}: {str(e)}")
+
+
+def lambda_handler(event, context):
+    """
+    Lambda function entrypoint
+    """
+    # Load our configuration data, and see if there's anything to do
+    cf.loadConfiguration()
+    bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+    pending_keys = list_pending_updates(bucket)
+    if not pending_keys:
+        return {"applied": 0}
+
+    # Load every update at the same time - any that fail are left for the next run
+    with ThreadPoolExecutor(max_workers=min(COMPACTOR_THREADS, len(pending_keys))) as executor:
+        updates = list(executor.map(lambda key: load_pending_update(bucket, key), pending_keys))
+    applied_keys = [key for key, update in zip(pending_keys, updates) if update is not None]
+    updates = [update for update in updates if update is not None]
+
+    # Apply them to the current database, or to a new one if this is the first run
+    pcacommon.remove_temp_file(COMPACTOR_DATABASE_FILE)
+    try:
+        pcasearchindex.download_search_index(bucket, COMPACTOR_DATABASE_FILE)
+        connection = pcasearchindex.open_search_index(COMPACTOR_DATABASE_FILE)
+        try:
+            pcasearchindex.apply_search_index_updates(connection, updates)
+            pcasearchindex.compact_search_index(connection)
+            calls = connection.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+            segments = connection.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+        finally:
+            connection.close()
+
+        # The updates can only go once the database holding them is safely in S3
+        pcasearchindex.upload_search_index(bucket, COMPACTOR_DATABASE_FILE)
+        remove_applied_updates(bucket, applied_keys)
+        database_bytes = os.path.getsize(COMPACTOR_DATABASE_FILE)
+    finally:
+        pcacommon.remove_temp_file(COMPACTOR_DATABASE_FILE)
+
+    print(json.dumps({"SearchIndexCompaction": {"Applied": len(updates), "Failed": len(pending_keys) - len(updates),
+                                                "Calls": calls, "Segments": segments, "Bytes": database_bytes}}))
+    return {"applied": len(updates)}
@@ -0,0 +1,62 @@
+"""
+This python function is the query API for the embedded transcript search index.  It keeps a local copy of the index
+database between invocations, only downloading it again when the compactor has changed it, so searches run against
+local storage and return the matching speech segments, with their time offsets in each call, within milliseconds.
+
+It can be invoked directly with the search parameters as the event, or through API Gateway with them as query
+string parameters - "query" is required, and "speaker", "sentiment", "callId" and "limit" are optional.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import time
+import pcaconfiguration as cf
+import pcasearchindex
+
+
+def create_response(status_code, body, api_request):
+    """
+    Creates the function's response, which is wrapped up for API Gateway if that is where the request came from
+
+    :param status_code: HTTP status code of the response
+    :param body: Response data
+    :param api_request: Flag to say that the request came through API Gateway
+    :return: Response for the caller
+    """
+    if not api_request:
+        return body
+    return {"statusCode": status_code,
+            "headers": {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"},
+            "body": json.dumps(body)}
+
+
+def lambda_handler(event, context):
+    """
+    Lambda function entrypoint
+    """
+    api_request = "queryStringParameters" in event
+    params = (event.get("queryStringParameters") or {}) if api_request else event
+    query = params.get("query", "").strip()
+    if query == "":
+        return create_response(400, {"error": "A search query must be supplied"}, api_request)
+    try:
+        limit = int(params.get("limit", pcasearchindex.SEARCH_DEFAULT_RESULTS))
+    except ValueError:
+        return create_response(400, {"error": "The result limit must be a number"}, api_request)
+
+    # Only load our configuration the first time, as the query is only using it to find the bucket
+    if cf.CONF_S3BUCKET_OUTPUT not in cf.appConfig:
+        cf.loadConfiguration()
+    connection = pcasearchindex.load_search_index(cf.appConfig[cf.CONF_S3BUCKET_OUTPUT])
+    if connection is None:
+        return create_response(200, {"query": query, "results": []}, api_request)
+
+    start_time = time.time()
+    results = pcasearchindex.search_transcripts(connection, query, speaker=params.get("speaker"),
+                                                sentiment=params.get("sentiment"), call_id=params.get("callId"),
+                                                limit=limit)
+    query_millis = round((time.time() - start_time) * 1000, 1)
+    print(json.dumps({"SearchQuery": {"Results": len(results), "Milliseconds": query_millis}}))
+
+    return create_response(200, {"query": query, "results": results, "milliseconds": query_millis}, api_request)
@@ -4,16 +4,186 @@ once, and re-use them throughout the run, so the config values at the start of t
 There is not quick way to count the files in an S3 bucket, so rather than track what's left in the bucket
 we just care about having any left to process and instead count how far we've gotten instead.
 
+The bucket's keyspace can be split into prefix shards, which are listed concurrently, and each shard carries a
+cursor so that a listing carries on from where the previous cycle got to rather than starting again from the
+beginning of the bucket.  The files found here are passed on to the move-files step, so each cycle only lists the
+bucket once, but as the workflow data has a size limit the listing itself is written to the output bucket and only
+its location is passed on.  When a shard's listing reaches the end of its keyspace it wraps round to the
+start once, which picks up any files that previously failed to move.
+
+Files are also assigned to priority classes, and when classes are defined by key prefix each top-level class
+prefix gets its own shard, so that a small urgent batch is listed alongside a large backfill rather than behind it.
+The remaining shard, for files outside those prefixes, skips over them - see pcabulkscheduler for the details.
+
+Alternatively, if the workflow is started with a "manifest" in its input then the files are read in chunks from
+that manifest instead of listing the bucket - see pcabulkmanifest for the details.
+
 Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
 import pcaconfiguration as cf
+import pcabulkmanifest
+import pcabulkscheduler
 import copy
+import json
+import os
+import time
+import uuid
 import boto3
 
+# Optionally create a shard for each top-level folder in the bucket, and how we list them
+BULK_SHARD_BY_FOLDER = os.getenv("BULK_SHARD_BY_FOLDER", "false")
+LIST_PAGE_SIZE = 1000
+LIST_THREADS = 16
+
+# Where each run's latest listing is written for the move-files step, as it is too big for the workflow data
+BULK_LISTING_PREFIX = "bulkListings/"
+
+# Start-after value that moves a listing past every key under a prefix, as S3 lists keys in UTF-8 byte order
+SKIP_PREFIX_MARKER = "\U0010FFFF"
+
+
+def createShard(prefix, delimiter=None, exclude=None):
+    """
+    Creates the workflow data for a prefix shard, whose cursor is the last key that has been moved or skipped
+
+    :param prefix: Key prefix covered by this shard
+    :param delimiter: Optional delimiter, which restricts a shard to the objects directly under its prefix
+    :param exclude: Optional list of prefixes within this shard that are skipped, as other shards cover them
+    :return: New shard
+    """
+    shard = {"prefix": prefix, "cursor": ""}
+    if delimiter is not None:
+        shard["delimiter"] = delimiter
+    if exclude:
+        shard["exclude"] = exclude
+    return shard
+
+
+def discoverShards(s3Client, bucket, shardPrefixes=None, classPrefixes=None):
+    """
+    Works out the prefix shards to use for this run.  These can be given in the workflow's input, or can be
+    one per top-level priority class prefix, with another for everything else that skips those prefixes, or
+    can be one per top-level folder, with another for the files at the top level.  Otherwise the whole bucket
+    is a single shard.  Note that shards must not overlap, or files would be moved twice
+
+    :param s3Client: Boto3 client for S3
+    :param bucket: Bulk upload bucket
+    :param shardPrefixes: Optional list of prefixes from the workflow's input
+    :param classPrefixes: Optional list of top-level priority class prefixes
+    :return: List of shards
+    """
+    if shardPrefixes:
+        return [createShard(prefix) for prefix in shardPrefixes]
+    elif classPrefixes:
+        return [createShard(prefix) for prefix in classPrefixes] + [createShard("", exclude=classPrefixes)]
+    elif BULK_SHARD_BY_FOLDER.lower() == "true":
+        shards = [createShard("", delimiter="/")]
+        paginator = s3Client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Delimiter="/"):
+            shards += [createShard(commonPrefix["Prefix"]) for commonPrefix in page.get("CommonPrefixes", [])]
+        return shards
+    else:
+        return [createShard("")]
+
+
+def listShard(s3Client, bucket, shard, filesWanted, pendingDeletes, canWrap=True):
+    """
+    Lists the next files in a shard after its cursor, collecting any folder objects along the way.  If there
+    are no files after the cursor then the listing starts again from the beginning of the shard
+
+    :param s3Client: Boto3 client for S3
+    :param bucket: Bulk upload bucket
+    :param shard: Shard to be listed
+    :param filesWanted: Maximum number of files to return
+    :param pendingDeletes: Keys that have already been copied, which are ignored
+    :param canWrap: Whether the listing may start again from the beginning of the shard
+    :return: Listing for this shard, holding its "files", their "modified" times, "folders" and the "lastKey" examined
+    """
+    listing = {"files": [], "modified": [], "folders": [], "lastKey": shard["cursor"]}
+    kwargs = {"Bucket": bucket, "Prefix": shard["prefix"]}
+    if "delimiter" in shard:
+        kwargs["Delimiter"] = shard["delimiter"]
+    if shard["cursor"] != "":
+        kwargs["StartAfter"] = shard["cursor"]
+
+    while len(listing["files"]) < filesWanted:
+        kwargs["MaxKeys"] = min(LIST_PAGE_SIZE, filesWanted - len(listing["files"]) + 10)
+        response = s3Client.list_objects_v2(**kwargs)
+        skipPrefix = None
+        for s3Object in response.get("Contents", []):
+            skipPrefix = next((prefix for prefix in shard.get("exclude", []) if s3Object["Key"].startswith(prefix)),
+                              None)
+            if skipPrefix is not None:
+                break
+            listing["lastKey"] = s3Object["Key"]
+            if s3Object["Key"].endswith("/"):
+                listing["folders"].append(s3Object["Key"])
+            elif s3Object["Key"] not in pendingDeletes:
+                listing["files"].append(s3Object["Key"])
+                listing["modified"].append(int(s3Object["LastModified"].timestamp()))
+                if len(listing["files"]) == filesWanted:
+                    break
+
+        if skipPrefix is not None:
+            # We've reached a prefix that another shard covers, so start listing again after all of its keys
+            listing["lastKey"] = skipPrefix + SKIP_PREFIX_MARKER
+            kwargs["StartAfter"] = listing["lastKey"]
+            kwargs.pop("ContinuationToken", None)
+        elif not response.get("IsTruncated", False):
+            break
+        else:
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    # Nothing left after our cursor, so wrap round to pick up anything that we passed over earlier
+    if not listing["files"] and shard["cursor"] != "" and canWrap:
+        shard["cursor"] = ""
+        return listShard(s3Client, bucket, shard, filesWanted, pendingDeletes)
+
+    return listing
+
+
+def topUpListing(s3Client, bucket, shard, listing, filesWanted, pendingDeletes):
+    """
+    Extends a shard's listing with more files from after the last key that it examined
+
+    :param s3Client: Boto3 client for S3
+    :param bucket: Bulk upload bucket
+    :param shard: Shard that was listed
+    :param listing: Existing listing for this shard, which is extended
+    :param filesWanted: Maximum number of extra files to add
+    :param pendingDeletes: Keys that have already been copied, which are ignored
+    """
+    moreFiles = listShard(s3Client, bucket, dict(shard, cursor=listing["lastKey"]), filesWanted, pendingDeletes,
+                          canWrap=False)
+    listing["files"] += moreFiles["files"]
+    listing["modified"] += moreFiles["modified"]
+    listing["folders"] += moreFiles["folders"]
+    listing["lastKey"] = moreFiles["lastKey"]
+
+
+def saveListing(s3Client, sfData, listing):
+    """
+    Writes this cycle's listing to the output bucket for the move-files step, replacing the previous cycle's, or
+    removes the previous one if there is nothing to move
+
+    :param s3Client: Boto3 client for S3
+    :param sfData: Workflow data, holding the location of this run's listing
+    :param listing: Dictionary of listing data for the move-files step, or None if there is none
+    """
+    if listing is None:
+        s3Client.delete_object(Bucket=sfData["listingBucket"], Key=sfData["listingKey"])
+    else:
+        s3Client.put_object(Bucket=sfData["listingBucket"], Key=sfData["listingKey"],
+                            Body=json.dumps(listing).encode("utf-8"), ContentType="application/json")
+
+
 def lambda_handler(event, context):
 
     # Get our params, looking them up if we haven't got them
+    s3Client = boto3.client('s3')
     if "sourceBucket" in event:
         # Read them from the event data
         sfData = copy.deepcopy(event)
@@ -35,17 +205,56 @@ def lambda_handler(event, context):
         sfData["filesLimit"] = max(1, limit)
         sfData["dripRate"] = max(1, dripRate)
         sfData["filesProcessed"] = 0
+        sfData["runStartTime"] = int(time.time())
+        sfData["listingBucket"] = ssmClient.get_parameter(Name=cf.CONF_S3BUCKET_OUTPUT)["Parameter"]["Value"]
+        sfData["listingKey"] = f"{BULK_LISTING_PREFIX}{uuid.uuid4()}.json"
+        sfData["priorityClasses"] = pcabulkscheduler.load_priority_classes(event.get("priorityClasses"))
+        if "manifest" in event:
+            # Our files come from a manifest, and we may be resuming an earlier run through it
+            manifest = pcabulkmanifest.create_manifest_state(s3Client, event["manifest"], event.get("inPlace", False),
+                                                             sfData["listingBucket"], BULK_LISTING_PREFIX)
+            sfData["filesProcessed"] = pcabulkmanifest.load_manifest_progress(manifest)
+            sfData["bulkManifest"] = manifest
+        else:
+            classPrefixes = pcabulkscheduler.get_top_level_prefixes(sfData["priorityClasses"])
+            sfData["bulkShards"] = discoverShards(s3Client, bucket, event.get("shardPrefixes"), classPrefixes)
 
-    # Just get a single S3 check on whether or not we have files to go
-    s3Client = boto3.client('s3')
-    maxKeys = dripRate + 10 # list a few additional keys to allow for some folder objects that won't be moved
-    response = s3Client.list_objects_v2(Bucket=bucket, MaxKeys=maxKeys)
-    if "Contents" in response:
-        files = [f for f in response["Contents"] if not f["Key"].endswith("/")][:dripRate] # ignore folder objects
-        filesFound = len(files)
+    # If we're working through a manifest then just read the next chunk of it
+    if "bulkManifest" in sfData:
+        entries = pcabulkmanifest.read_manifest_chunk(s3Client, sfData["bulkManifest"], dripRate)
+        saveListing(s3Client, sfData, {"manifestEntries": entries} if entries else None)
+        sfData["filesToMove"] = len(entries)
+        return sfData
+
+    # List the next files from every shard at the same time, sharing out our drip rate between them - unless we
+    # have priority classes, when each shard could supply the whole drip rate for the move step to choose from
+    shards = sfData["bulkShards"]
+    pendingDeletes = set(sfData.get("pendingDeletes", []))
+    if len(sfData.get("priorityClasses", {})) > 1:
+        filesPerShard = dripRate
     else:
-        filesFound = 0
-    sfData["filesToMove"] = filesFound
+        filesPerShard = ceil(dripRate / len(shards))
+    with ThreadPoolExecutor(max_workers=min(LIST_THREADS, len(shards))) as executor:
+        listings = list(executor.map(lambda shard: listShard(s3Client, bucket, shard, filesPerShard, pendingDeletes),
+                                     shards))
+
+        # If some shards ran short then give their share of the drip rate to the ones that didn't
+        filesShort = dripRate - sum(len(listing["files"]) for listing in listings)
+        fullShards = [index for index, listing in enumerate(listings) if len(listing["files"]) == filesPerShard]
+        if (filesShort > 0) and fullShards:
+            extraPerShard = ceil(filesShort / len(fullShards))
+            list(executor.map(lambda index: topUpListing(s3Client, bucket, shards[index], listings[index],
+                                                         extraPerShard, pendingDeletes), fullShards))
+
+        # If files can be classified by their metadata then look that up for every file that we've found
+        if pcabulkscheduler.is_metadata_classification_enabled():
+            for listing in listings:
+                listing["classes"] = list(executor.map(
+                    lambda key: pcabulkscheduler.get_metadata_class(s3Client, bucket, key), listing["files"]))
+
+    # Pass on our listing to the move-files step - files whose deletes are still pending count as left to move
+    sfData["filesToMove"] = sum(len(listing["files"]) for listing in listings) + len(pendingDeletes)
+    saveListing(s3Client, sfData, {"bulkListing": listings} if sfData["filesToMove"] > 0 else None)
 
     # Return current event data
     return sfData
@@ -54,4 +263,3 @@ def lambda_handler(event, context):
 if __name__ == "__main__":
     event = {}
     print(lambda_handler(event, ""))
-
@@ -3,11 +3,203 @@ This python function is part of the bulk files workflow.  Based upon the queueSp
 move up to that many files into the PCA audio bucket, but only up to a maximum number as specified by
 the dripRate - this ensures that we don't overload they system
 
+The files to move are taken from the listing made by the files-count step, which is read from the output bucket,
+chosen by priority class and shared out between the classes and prefix shards by pcabulkscheduler, and each shard's
+cursor is then moved on past the files at the start of its listing that we have dealt with, so any file that was
+left waiting is listed again.  Files are copied concurrently, and the source files are then removed with batched
+deletes.  Any file that fails to move is reported back in the workflow data and left where it is to be retried on
+a later cycle.  If a file was copied but its source couldn't be deleted then the delete is retried next cycle without
+copying it again, as a second copy would start a second PCA workflow for that file
+
+If the workflow is working through a manifest then the files are copied, but their sources are not deleted as
+they are not in our staging bucket.  In in-place mode they are not copied at all, and instead each one is sent to
+the PCA ingestion queue to be processed where it is
+
 Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 import copy
+import json
+import os
+import time
 import boto3
+import pcabulkmanifest
+import pcabulkscheduler
+
+# Number of concurrent copies, the S3 limit on keys per delete request, and how many failures we report
+MOVE_THREADS = int(os.getenv("MOVE_THREADS", "32"))
+DELETE_BATCH_SIZE = 1000
+MAX_REPORTED_FAILURES = 25
+
+# PCA ingestion queue, used when processing manifest files in place, and its limit on messages per request
+INGESTION_QUEUE_URL = os.getenv("INGESTION_QUEUE_URL", "")
+QUEUE_BATCH_SIZE = 10
+
+
+def copyFile(s3Client, sourceBucket, sourceKey, targetBucket, targetKey):
+    """
+    Copies a single file between buckets, catching any failure so that it can be reported against just this file
+
+    :param s3Client: Boto3 client for S3
+    :param sourceBucket: Bucket holding the file
+    :param sourceKey: Key of the file in the source bucket
+    :param targetBucket: Bucket to copy the file to
+    :param targetKey: Key to give the file in the target bucket
+    :return: Failure details, or None if the file was copied
+    """
+    try:
+        print(f'Copying: Bucket={sourceBucket}, Key={sourceKey}, targetBucket={targetBucket}, targetKey={targetKey}')
+        s3Client.copy({'Bucket': sourceBucket, 'Key': sourceKey}, targetBucket, targetKey)
+        return None
+    except Exception as e:
+        print("Failed to copy audio file {}: {}".format(sourceKey, str(e)))
+        return {"key": sourceKey, "stage": "copy", "error": str(e)}
+
+
+def deleteFiles(s3Client, bucket, keys):
+    """
+    Deletes files from a bucket, using as few requests as possible
+
+    :param s3Client: Boto3 client for S3
+    :param bucket: Bucket holding the files
+    :param keys: List of keys to be deleted
+    :return: List of failure details for any keys that couldn't be deleted
+    """
+    failures = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        try:
+            response = s3Client.delete_objects(Bucket=bucket,
+                                               Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+            for error in response.get("Errors", []):
+                print("Failed to delete file {}: {}".format(error["Key"], error.get("Message", "")))
+                failures.append({"key": error["Key"], "stage": "delete", "error": error.get("Code", "")})
+        except Exception as e:
+            print("Failed to delete {} file(s): {}".format(len(batch), str(e)))
+            failures += [{"key": key, "stage": "delete", "error": str(e)} for key in batch]
+
+    return failures
+
+
+def classifyFiles(listings, classes):
+    """
+    Works out the priority class of every file in each shard's listing
+
+    :param listings: List of shard listings from the files-count step
+    :param classes: Dictionary of class name to priority class
+    :return: List of the class names of the files in each listing
+    """
+    fileClasses = []
+    for listing in listings:
+        metadataClasses = listing.get("classes", [None] * len(listing["files"]))
+        fileClasses.append([pcabulkscheduler.classify_file(classes, key, metadataClass)
+                            for key, metadataClass in zip(listing["files"], metadataClasses)])
+    return fileClasses
+
+
+def advanceCursors(shards, listings, taken):
+    """
+    Moves each shard's cursor on past the files at the start of its listing that we have taken.  If we took all
+    of them then the cursor moves to the last key that was listed, otherwise it stops before the first file that
+    we left, so that any file left waiting is listed again next cycle.  Files taken from beyond that point are
+    deleted once they are copied, so they won't be listed again
+
+    :param shards: List of shards, whose cursors are updated
+    :param listings: List of shard listings from the files-count step
+    :param taken: List of the sorted indexes of the files taken from each shard's listing
+    :return: Folder objects that are now behind the cursors, and so can be deleted
+    """
+    folders = []
+    for shard, listing, positions in zip(shards, listings, taken):
+        count = 0
+        while count < len(positions) and positions[count] == count:
+            count += 1
+        if count == len(listing["files"]):
+            shard["cursor"] = listing["lastKey"]
+        elif count > 0:
+            shard["cursor"] = listing["files"][count - 1]
+        folders += [folder for folder in listing["folders"] if folder <= shard["cursor"]]
+
+    return folders
+
+
+def queueFiles(sqsClient, entries):
+    """
+    Sends files to the PCA ingestion queue so that they are processed where they are, using as few requests
+    as possible
+
+    :param sqsClient: Boto3 client for SQS
+    :param entries: List of manifest entries for the files
+    :return: List of failure details for any files that couldn't be queued
+    """
+    failures = []
+    for start in range(0, len(entries), QUEUE_BATCH_SIZE):
+        batch = entries[start:start + QUEUE_BATCH_SIZE]
+        messages = [{"Id": str(index), "MessageBody": json.dumps({"bucket": entry[0], "key": entry[1]})}
+                    for index, entry in enumerate(batch)]
+        try:
+            response = sqsClient.send_message_batch(QueueUrl=INGESTION_QUEUE_URL, Entries=messages)
+            for failed in response.get("Failed", []):
+                entry = batch[int(failed["Id"])]
+                print("Failed to queue file {}/{}: {}".format(entry[0], entry[1], failed.get("Message", "")))
+                failures.append({"key": f"{entry[0]}/{entry[1]}", "stage": "queue", "error": failed["Code"]})
+        except Exception as e:
+            print("Failed to queue {} file(s): {}".format(len(batch), str(e)))
+            failures += [{"key": f"{entry[0]}/{entry[1]}", "stage": "queue", "error": str(e)} for entry in batch]
+
+    return failures
+
+
+def moveManifestFiles(sfData, s3Client, entries, maxMoves):
+    """
+    Deals with the next files from a manifest, either copying them into the PCA audio bucket or, in in-place
+    mode, sending them to the PCA ingestion queue.  Our position in the manifest is then moved on past them
+    and persisted, along with any failures, as these files won't be listed again
+
+    :param sfData: Workflow data, which is updated
+    :param s3Client: Boto3 client for S3
+    :param entries: List of the next manifest entries, as read by the files-count step
+    :param maxMoves: Maximum number of files to deal with
+    :return: Number of files moved
+    :return: List of failure details
+    """
+    manifest = sfData["bulkManifest"]
+    entries = entries[:maxMoves]
+    if manifest["inPlace"]:
+        if INGESTION_QUEUE_URL == "":
+            raise Exception("In-place manifest processing needs the PCA ingestion queue, which isn't configured")
+        failures = queueFiles(boto3.client("sqs"), entries)
+    else:
+        keyPrefix = sfData["targetAudioKey"]
+        if keyPrefix != "":
+            keyPrefix += "/"
+        with ThreadPoolExecutor(max_workers=max(1, min(MOVE_THREADS, len(entries)))) as executor:
+            copyResults = list(executor.map(lambda entry: copyFile(s3Client, entry[0], entry[1],
+                                                                   sfData["targetBucket"], keyPrefix + entry[1]),
+                                            entries))
+        failures = [dict(result, key=f"{entry[0]}/{entry[1]}")
+                    for entry, result in zip(entries, copyResults) if result is not None]
+
+    # Move on past these files and save our progress, so that the run can be resumed if it stops
+    movedFiles = len(entries) - len(failures)
+    pcabulkmanifest.advance_manifest(s3Client, manifest, entries, len(entries))
+    pcabulkmanifest.save_manifest_progress(manifest, sfData["filesProcessed"] + movedFiles,
+                                           [failure["key"] for failure in failures])
+    return movedFiles, failures
+
+
+def loadListing(s3Client, sfData):
+    """
+    Reads the listing that the files-count step wrote to the output bucket for this cycle
+
+    :param s3Client: Boto3 client for S3
+    :param sfData: Workflow data, holding the location of this run's listing
+    :return: Dictionary of listing data
+    """
+    response = s3Client.get_object(Bucket=sfData["listingBucket"], Key=sfData["listingKey"])
+    return json.loads(response["Body"].read().decode("utf-8"))
 
 
 def lambda_handler(event, context):
@@ -20,45 +212,94 @@ def lambda_handler(event, context):
     sourceBucket = sfData["sourceBucket"]
     targetBucket = sfData["targetBucket"]
     targetAudioKey = sfData["targetAudioKey"]
+    pendingDeletes = sfData.pop("pendingDeletes", [])
     movedFiles = 0
+    failures = []
+
+    # Our client is shared by all of our copy threads, so needs enough connections for them
+    s3Client = boto3.client('s3', config=Config(max_pool_connections=MOVE_THREADS))
+    listingData = loadListing(s3Client, sfData)
+
+    # Files from a manifest are handled separately, as they aren't in our staging bucket
+    if "bulkManifest" in sfData:
+        movedFiles, failures = moveManifestFiles(sfData, s3Client, listingData.get("manifestEntries", []),
+                                                 min(dripRate, queueSpace))
+        sfData["moveFailures"] = failures[:MAX_REPORTED_FAILURES]
+        sfData["moveFailureCount"] = len(failures)
+        sfData["filesProcessed"] += movedFiles
+        sfData.pop("queueSpace", None)
+        return sfData
 
-    # Get as many files from S3 as we can move this time (minimum of queueSpace and dripRate)
-    s3Client = boto3.client('s3')
-    s3 = boto3.resource('s3')
-    maxKeys = min(dripRate, queueSpace) + 10 # list a few additional keys to allow for some folder objects that won't be moved
-    response = s3Client.list_objects_v2(Bucket=sourceBucket, MaxKeys=maxKeys)
-    if "Contents" in response:
+    # Finish off any files that were copied last time but whose source couldn't be deleted - they have
+    # already been counted as moved, and any that still can't be deleted are tried again next time
+    if pendingDeletes:
+        failures += deleteFiles(s3Client, sourceBucket, pendingDeletes)
+    deleteFailedKeys = set(failure["key"] for failure in failures)
+    sfData["pendingDeletes"] = [key for key in pendingDeletes if key in deleteFailedKeys]
+
+    # Take as many files from our listing as we can move this time (minimum of queueSpace and dripRate), picking
+    # them by priority class, and only counting in-flight files if a class has a limit on them
+    maxMoves = min(dripRate, queueSpace)
+    listings = listingData.get("bulkListing", [])
+    classes = sfData.setdefault("priorityClasses", pcabulkscheduler.load_priority_classes())
+    inFlight = {}
+    if pcabulkscheduler.is_in_flight_tracking_needed(classes):
+        inFlight = pcabulkscheduler.load_in_flight_counts(classes)
+    fileClasses = classifyFiles(listings, classes)
+    taken, classTaken = pcabulkscheduler.schedule_files(fileClasses, classes, inFlight, maxMoves)
+    files = [listing["files"][position] for listing, positions in zip(listings, taken) for position in positions]
+    filesClass = [names[position] for names, positions in zip(fileClasses, taken) for position in positions]
+    filesModified = [listing["modified"][position] for listing, positions in zip(listings, taken)
+                     for position in positions]
+    folders = advanceCursors(sfData["bulkShards"], listings, taken)
+    movedClasses = []
+    if files or folders:
         # We now have a list of objects that we can use
         keyPrefix = targetAudioKey
         if keyPrefix != "":
             keyPrefix += "/"
-        files = [f for f in response["Contents"] if not f["Key"].endswith("/")][:dripRate]
-        folders = [f for f in response["Contents"] if f["Key"].endswith("/")]
-        for audioFile in files:
-            try:
-                # Copy and delete file
-                copyDestnKey = keyPrefix + audioFile["Key"]
-                copy_source = {
-                    'Bucket': sourceBucket,
-                    'Key': audioFile["Key"]
-                }
-                print(f'Copying: copy_source={copy_source}, targetBucket={targetBucket}, copyDestnKey={copyDestnKey}')
-                s3.meta.client.copy(copy_source, targetBucket, copyDestnKey)
-                deleteResponse = s3Client.delete_object(Bucket=sourceBucket, Key=audioFile["Key"])
-                movedFiles += 1
-            except Exception as e:
-                print("Failed to move audio file {}".format(audioFile["Key"]))
-                print(e)
-                raise
-        # Delete any folder objects so they do not appear in subsequent object lists - usually these are created in S3 console only
-        for folder in folders:
-            try:
-                print(f'Deleting folder object: Bucket={sourceBucket}, Key={folder["Key"]}')
-                deleteResponse = s3Client.delete_object(Bucket=sourceBucket, Key=folder["Key"])
-            except Exception as e:
-                print("Failed to delete folder file {}".format(folder["Key"]))
-                print(e)
-                raise        
+
+        # Copy all of our files concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(MOVE_THREADS, len(files)))) as executor:
+            copyResults = list(executor.map(lambda key: copyFile(s3Client, sourceBucket, key,
+                                                                 targetBucket, keyPrefix + key), files))
+        failures += [result for result in copyResults if result is not None]
+        copiedFiles = [key for key, result in zip(files, copyResults) if result is None]
+
+        # Note the class of each file that we copied and how long it waited, and track them if any class has a
+        # limit on its in-flight files
+        now = int(time.time())
+        movedClasses = [(name, now - modified) for name, modified, result in zip(filesClass, filesModified, copyResults)
+                        if result is None]
+        if pcabulkscheduler.is_in_flight_tracking_needed(classes):
+            pcabulkscheduler.register_in_flight([(name, targetBucket, keyPrefix + key) for key, name, result
+                                                 in zip(files, filesClass, copyResults) if result is None])
+
+        # Delete the files that we copied along with any folder objects, so they do not appear in subsequent
+        # object lists - folder objects are usually created in S3 console only
+        deleteFailures = deleteFiles(s3Client, sourceBucket, copiedFiles + folders)
+        failures += deleteFailures
+        deleteFailedKeys = set(failure["key"] for failure in deleteFailures)
+        movedFiles += len(copiedFiles)
+        sfData["pendingDeletes"] += [key for key in copiedFiles if key in deleteFailedKeys]
+
+        # If nothing at all could be moved then something is badly wrong, so fail as we always have
+        if files and not copiedFiles:
+            raise Exception(f"Failed to move any of {len(files)} file(s) from bucket {sourceBucket}: " +
+                            copyResults[0]["error"])
+
+    # Report our per-class statistics, including the files that we listed but left waiting
+    waiting = {}
+    for names, positions in zip(fileClasses, taken):
+        for name in names:
+            waiting[name] = waiting.get(name, 0) + 1
+        for position in positions:
+            waiting[names[position]] -= 1
+    pcabulkscheduler.update_class_stats(sfData, movedClasses, waiting, inFlight)
+
+    # Report any failures, although only a limited number of them as our workflow data has a size limit
+    sfData["moveFailures"] = failures[:MAX_REPORTED_FAILURES]
+    sfData["moveFailureCount"] = len(failures)
 
     # Increase our counter, remove the queue value and return
     sfData["filesProcessed"] += movedFiles
@@ -74,6 +315,10 @@ if __name__ == "__main__":
         "filesLimit": 250,
         "dripRate": 50,
         "filesProcessed": 0,
-        "queueSpace": 250
-    }   
+        "queueSpace": 250,
+        "priorityClasses": {"default": {"prefixes": [], "priority": 0, "weight": 1}},
+        "bulkShards": [{"prefix": "", "cursor": ""}],
+        "listingBucket": "pca-output-1234",
+        "listingKey": "bulkListings/example.json"
+    }
     lambda_handler(event, "")
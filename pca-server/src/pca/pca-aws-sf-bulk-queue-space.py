@@ -1,14 +1,20 @@
 """
 This python function is part of the bulk files workflow.  Checks the current state of the Transcribe job queue,
 taking into account running and queued jobs.  It then returns the calculated head-space in the queue that the
-Bulk process is able to use.  If any of the API calls to Transcribe or S3 get throttled then we say the queue
-is full this cycle and carry on
+Bulk process is able to use.  The number of in-flight jobs is normally read from the counters maintained by the
+main workflow, which is a single DynamoDB read, and only if they are not available do we count the jobs via the
+Transcribe list APIs.  If any of the API calls to Transcribe or S3 get throttled then we say the queue is full
+this cycle and carry on
+
+The drip rate is then adjusted for this cycle by the adaptive controller - see pcadripcontrol for the details
 
 Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
 import copy
 import boto3
+import pcajobcounter
+import pcadripcontrol
 
 
 def countTranscribeJobsInState(status, client, filesLimit):
@@ -35,24 +41,35 @@ def countTranscribeJobsInState(status, client, filesLimit):
 
 def lambda_handler(event, context):
 
-    # Load our event, but we no longer need "filesToMove"
+    # Load our event
     sfData = copy.deepcopy(event)
     filesLimit = sfData["filesLimit"]
-    sfData.pop("filesToMove", None)
+    queueThrottled = False
 
     # Count the number of IN_PROGRESS and QUEUED Transcribe jobs
     transcribeClient = boto3.client("transcribe")
     try:
-        inProgress = countTranscribeJobsInState("IN_PROGRESS", transcribeClient, filesLimit)
-        queued = countTranscribeJobsInState("QUEUED", transcribeClient, (filesLimit - inProgress))
-        found = inProgress + queued
+        if pcajobcounter.is_job_counter_enabled():
+            found = sum(pcajobcounter.get_in_flight_counts(transcribeClient).values())
+        else:
+            inProgress = countTranscribeJobsInState("IN_PROGRESS", transcribeClient, filesLimit)
+            queued = countTranscribeJobsInState("QUEUED", transcribeClient, (filesLimit - inProgress))
+            found = inProgress + queued
     except Exception as e:
         # This COULD exception through throttling - in which case
         # we just say that the queue is full this time and go round
         found = filesLimit
+        queueThrottled = pcadripcontrol.is_throttling_error(str(e))
 
-    # Return current event data with the headroom left in our queue limit
+    # Work out the headroom left in our queue limit, and adjust our drip rate for this cycle
     sfData["queueSpace"] = max(0, (filesLimit - found))
+    pcadripcontrol.adjust_drip_rate(sfData, queueThrottled, sfData["queueSpace"])
+
+    # Return current event data, but we no longer need "filesToMove", and the last move's failures have now been
+    # acted upon so they mustn't be seen again if we skip the next move
+    sfData.pop("filesToMove", None)
+    sfData.pop("moveFailures", None)
+    sfData.pop("moveFailureCount", None)
     return sfData
 
 
@@ -9,16 +9,16 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
 import os
-from pathlib import Path
 from datetime import datetime
 import boto3
-import json
 import pcaconfiguration as cf
 import pcaresults
+import pcatelephonyctr
 import copy
+import bisect
+import heapq
 
 # General constants
-TMP_DIR = "/tmp/"
 OFFLINE_MODE = True
 
 # Channel name constants
@@ -27,134 +27,36 @@ NON_TALK_LABEL = "NonTalkTime"
 AGENT_CHANNEL_LC_NAME = "agent"
 CUST_CHANNEL_LC_NAME = "customer"
 
-# SSM-derived configuration
-FILE_SUFFIX_CONVERSATION = ""
-FILE_SUFFIX_CALL = ""
-
 TIMESTAMP_BUFFER = 0.2
 
-def load_ctr_files(original_file):
-    """
-    Loads the matching CTR file for the specified audio file.  For Genesys the CTR file seems to be named
-    the same as the audio file with a "_metadata.json" suffix.  We assume that this metadata file is dropped
-    into the same S3 bucket/folder location as the matching audio file.  Additionally, we load in a file with
-    the "_call_metadata.json" suffix - this is the call-specific record which doesn't have a fixed Genesys
-    filename, but is necessary to identify where in a conversation this call came fits
-
-    :param original_file: Full S3 key for the call audio file
-    :return: JSON structures for the Conversation CTR and Call CTR files
+def convert_interval_to_seconds(interval, call_start_time):
     """
-    global OFFLINE_MODE
-
-    # Generate filenames for the metadata files
-    conv_ctr_filename = original_file + FILE_SUFFIX_CONVERSATION
-    conv_ctr_json = []
-    call_ctr_filename = original_file + FILE_SUFFIX_CALL
-    call_ctr_json = []
-
-    try:
-        # First, load in the conversation CTR file
-        conv_ctr_json = load_single_ctr_file(conv_ctr_filename)
-
-        # Now do the same for the call-specific CTR file
-        try:
-            call_ctr_json = load_single_ctr_file(call_ctr_filename)
-        except Exception as e:
-            # Exception, most likely file doesn't exist
-            print(f"Unable to load/parse Genesys call CTR file '{call_ctr_filename}'\n{e}")
-            conv_ctr_json = []
-
-    except Exception as e:
-        # Exception, most likely file doesn't exist
-        print(f"Unable to load/parse Genesys conversation CTR file '{conv_ctr_filename}'\n{e}")
-
-    return conv_ctr_json, call_ctr_json
-
-
-def load_single_ctr_file(ctr_filename):
-    """
-    Downloads a CTR file from S3, then loads the JSON data and returns it
-
-    :param ctr_filename: Name of S3 file for this specific CTR file
-    :return: JSON data from this file
-    """
-    global OFFLINE_MODE
-
-    # Check conv file exists
-    if not OFFLINE_MODE:
-        s3_client = boto3.client("s3")
-        response = s3_client.get_object(Bucket=cf.appConfig[cf.CONF_S3BUCKET_INPUT], Key=ctr_filename)
-
-    # Download to a tempfile
-    json_filepath = TMP_DIR + ctr_filename.split("/")[-1]
-    if not OFFLINE_MODE:
-        s3_client.download_file(cf.appConfig[cf.CONF_S3BUCKET_INPUT], ctr_filename, json_filepath)
-
-    # Load in the JSON file for processing
-    json_filepath = Path(json_filepath)
-    ctr_json = json.load(open(json_filepath.absolute(), "r", encoding="utf-8"))
-
-    return ctr_json
-
-
-def convert_times_to_seconds(start_time, end_time, call_start_time):
-    """
-    Converts a given call segment start- and end-time. as defined in the CTR file, to zero-offset times
+    Converts a call segment's start- and end-timestamps, as indexed from the CTR file, to zero-offset times
     based upon the start time of the call (as specified in the CTR file).  This is required as Genesys stores
     this information as 24-hour clock values, which PCA call segments are all offset from 0.00 seconds
 
-    :param start_time: Start time of call segment
-    :param end_time: End time of call segment
+    :param interval: [start, end] timestamps of call segment
     :param call_start_time: Start time of call
 
     :return: Zero-offset timings both start- and end-time
     """
-    segment_start = parse_genesys_ctr_datetime(start_time).timestamp() - call_start_time
-    segment_end = parse_genesys_ctr_datetime(end_time).timestamp() - call_start_time
-
-    return segment_start, segment_end
-
-
-def parse_genesys_ctr_datetime(call_time, conv_ctr=True):
-    """
-    Extracts the timestamp from a Genesys CTR datetime string.  Typically, the expression for this string format
-    is "%Y-%m-%dT%H:%M:%S.%fZ", but it has been seen in Genesys CTR files that some entries do not have a microsecond
-    component.  Hence, we may have to try several parse options.
-
-    :param call_time: CTR datetime string
-    :return: Datetime object representing the CTR datetime string
-    """
+    return interval[0] - call_start_time, interval[1] - call_start_time
 
-    # If there's a "+" in the time then go with that format
-    if "+" in call_time:
-        dt_text = call_time.split("+")[0]
-        genesys_call_time = datetime.strptime(dt_text, "%Y-%m-%dT%H:%M:%S.%f")
-    else:
-        # Otherwise try the standard "Z" style format
-        try:
-            # Try first with times that have a microsecond part (which is normal)
-            genesys_call_time = datetime.strptime(call_time, "%Y-%m-%dT%H:%M:%S.%fZ")
-        except ValueError:
-            # If that fails then try again without the microsecond (which is unusual, but happens)
-            genesys_call_time = datetime.strptime(call_time, "%Y-%m-%dT%H:%M:%SZ").replace(microsecond=1)
-
-    return genesys_call_time
 
-
-def set_customer_id(speaker_map, conv_ctr_json):
+def set_customer_id(speaker_map, ctr_index):
     """
     Finds the customer Participant ID and writes it to the PCA CUST label
 
     :param speaker_map: PCA speaker mapping
-    :param conv_ctr_json: Genesys conversation JSON data
+    :param ctr_index: Index of the Genesys CTR data
     """
     customer_id = None
 
     # Pick out the customer ID from the CTR file, and if there
     # was one defined (potentilly not) then update the speaker map
-    customer = list(filter(lambda participant: participant["purpose"] == "customer", conv_ctr_json["participants"]))
+    customer = ctr_index["customer"]
     if customer:
-        customer_id = customer[0]["participantId"]
+        customer_id = customer["participantId"]
         customer_lines = list(
             filter(lambda x: x["Speaker"] == get_speaker_channel(speaker_map, CUST_CHANNEL_LC_NAME), speaker_map))
         customer_lines[0]["UserId"] = customer_id
@@ -233,70 +135,104 @@ def split_ivr_speech_segment(segment, ivr_end_time, pca_results):
     the IVR had completed its segment.  This method will split the segment into two and
     allocate the correct text to the IVR segment and put any spillover text into the new
     segment for the agent.  It will also transfer metadata to the new agent segment if
-    appropriate, and generate a sentiment score for their text.
+    appropriate, and generate a sentiment score for their text.  The new segment is not
+    added to the speech segment list here, as the caller does that for all splits at once
 
     :param segment: Speech segment containing both IVR and agent text
     :param ivr_end_time: End time for the IVR's participation in the segment
-    :param pca_results: Handle to the overall PCA results so we can manipulate the speech segment results list
+    :param pca_results: Handle to the overall PCA results so we can find the agent's speaker channel
+    :return: New agent segment, or None if there was no agent text and so no need to split
     """
-    split_index = pca_results.speech_segments.index(segment)
-    if split_index > 0:
-        # Get the segments to the LHS and RHS of this matched one
-        # TODO Sort out when this is the first or last item in the list
-        lhs_segments = pca_results.speech_segments[0:split_index]
-        rhs_segments = pca_results.speech_segments[split_index+1:]
-        orig_segment = copy.deepcopy(segment)
-
-        # Create a duplicate of our source segment, mark as
-        # "Agent" and then work out which words were theirs
-        # TODO Actions, Categories, Issues
-        agent_segment = copy.deepcopy(segment)
-        agent_segment.segmentIVR = False
-        agent_segment.segmentInterruption = False
-        agent_segment.segmentSpeaker = get_speaker_channel(pca_results.analytics.speaker_labels, AGENT_CHANNEL_LC_NAME)
-
-        # Split the words up correctly for both segments - IVR first
-        segment.segmentConfidence = list(filter(lambda x: x["EndTime"] < (ivr_end_time + TIMESTAMP_BUFFER), segment.segmentConfidence))
-        segment.segmentEndTime = segment.segmentConfidence[-1]["EndTime"]
-        segment.segmentText = regenerate_segment_text(segment)
-
-        # Now get the words for the Agent half
-        agent_segment.segmentConfidence = list(filter(lambda x: x["StartTime"] > (ivr_end_time - TIMESTAMP_BUFFER), agent_segment.segmentConfidence))
-        if len(agent_segment.segmentConfidence) > 0:
-            agent_segment.segmentConfidence[0]["Text"] = agent_segment.segmentConfidence[0]["Text"].replace(" ", "")
-            agent_segment.segmentStartTime = agent_segment.segmentConfidence[0]["StartTime"]
-            agent_segment.segmentText = regenerate_segment_text(agent_segment)
+    # Work out which words belong to each half first, as if the agent has none then we leave the segment alone
+    ivr_words = list(filter(lambda x: x["EndTime"] < (ivr_end_time + TIMESTAMP_BUFFER), segment.segmentConfidence))
+    agent_positions = [position for position, word in enumerate(segment.segmentConfidence)
+                       if word["StartTime"] > (ivr_end_time - TIMESTAMP_BUFFER)]
+    if len(agent_positions) == 0:
+        return None
+
+    # Create a duplicate of our source segment, mark as
+    # "Agent" and then give it its own copy of its words
+    # TODO Actions, Categories, Issues
+    agent_segment = copy.deepcopy(segment)
+    agent_segment.segmentIVR = False
+    agent_segment.segmentInterruption = False
+    agent_segment.segmentSpeaker = get_speaker_channel(pca_results.analytics.speaker_labels, AGENT_CHANNEL_LC_NAME)
+    agent_segment.segmentConfidence = [agent_segment.segmentConfidence[position] for position in agent_positions]
+
+    # Split the words up correctly for both segments - IVR first
+    segment.segmentConfidence = ivr_words
+    segment.segmentEndTime = segment.segmentConfidence[-1]["EndTime"]
+    segment.segmentText = regenerate_segment_text(segment)
+
+    # Now the Agent half
+    agent_segment.segmentConfidence[0]["Text"] = agent_segment.segmentConfidence[0]["Text"].replace(" ", "")
+    agent_segment.segmentStartTime = agent_segment.segmentConfidence[0]["StartTime"]
+    agent_segment.segmentText = regenerate_segment_text(agent_segment)
+
+    # Work out which custom entities belong to the agent and the IVR
+    ivr_text_len = len(segment.segmentText)
+    ivr_entities = []
+    agent_entites = []
+    for entity in segment.segmentCustomEntities:
+        if entity["EndOffset"] > ivr_text_len:
+            # Add to agent segment, changing offset
+            entity["BeginOffset"] -= ivr_text_len + 1
+            entity["EndOffset"] -= ivr_text_len + 1
+            agent_entites.append(entity)
         else:
-            # we didnt really need to split this segment
-            pca_results.speech_segments = lhs_segments
-            pca_results.speech_segments.append(orig_segment)
-            pca_results.speech_segments.extend(rhs_segments)
-            return
-
-        # Work out which custom entities belong to the agent and the IVR
-        ivr_text_len = len(segment.segmentText)
-        ivr_entities = []
-        agent_entites = []
-        for entity in segment.segmentCustomEntities:
-            if entity["EndOffset"] > ivr_text_len:
-                # Add to agent segment, changing offset
-                entity["BeginOffset"] -= ivr_text_len + 1
-                entity["EndOffset"] -= ivr_text_len + 1
-                agent_entites.append(entity)
-            else:
-                # Add to IVR segment
-                ivr_entities.append(entity)
+            # Add to IVR segment
+            ivr_entities.append(entity)
 
-        # Assign our entity lists back to the correct segments
-        # TODO Need to add in a new scaled sentiment score
-        segment.segmentCustomEntities = ivr_entities
-        agent_segment.segmentCustomEntities = agent_entites
+    # Assign our entity lists back to the correct segments
+    # TODO Need to add in a new scaled sentiment score
+    segment.segmentCustomEntities = ivr_entities
+    agent_segment.segmentCustomEntities = agent_entites
+    return agent_segment
 
-        # Now stitch everything back together again and store it back in our results
-        pca_results.speech_segments = lhs_segments
-        pca_results.speech_segments.append(segment)
-        pca_results.speech_segments.append(agent_segment)
-        pca_results.speech_segments.extend(rhs_segments)
+
+def rebuild_speech_segments(speech_segments, inserted_after):
+    """
+    Rebuilds the speech segment list in a single pass once segments have been split, placing each new segment
+    straight after the one that it was split from.  A segment that was split more than once has its newest
+    split immediately after it, and any segment split from a new one follows that new one
+
+    :param speech_segments: Current list of speech segments
+    :param inserted_after: Dictionary of segment id to the list of segments split from it, newest first
+    :return: New list of speech segments
+    """
+    rebuilt = []
+    pending = list(reversed(speech_segments))
+    while pending:
+        segment = pending.pop()
+        rebuilt.append(segment)
+        pending.extend(reversed(inserted_after.get(id(segment), [])))
+    return rebuilt
+
+
+def find_window_matches(windows, speech_segments):
+    """
+    Finds the speech segments that start inside any of a set of time windows, where the window also runs until
+    at least the end of the segment's first word.  Windows and segments are both swept in start-time order, and
+    a running maximum of the window end times says whether any window that has opened by a segment's start is
+    still open far enough
+
+    :param windows: List of windows, each with a "Start" and "End" time
+    :param speech_segments: List of speech segments
+    :return: Segments that match a window, in list order
+    """
+    sorted_windows = sorted(windows, key=lambda window: window["Start"])
+    window_starts = [window["Start"] for window in sorted_windows]
+    latest_ends = []
+    for window in sorted_windows:
+        latest_ends.append(max(window["End"], latest_ends[-1]) if latest_ends else window["End"])
+
+    matches = []
+    for segment in speech_segments:
+        opened = bisect.bisect_right(window_starts, segment.segmentStartTime)
+        if (opened > 0) and (latest_ends[opened - 1] >= segment.segmentStartTime) and \
+                (latest_ends[opened - 1] >= segment.segmentConfidence[0]["EndTime"]):
+            matches.append(segment)
+    return matches
 
 
 def calculate_start_time(call_ctr_json, conv_ctr=True):
@@ -309,9 +245,9 @@ def calculate_start_time(call_ctr_json, conv_ctr=True):
 
     # Pick out the official conversation time from the JSON
     if conv_ctr:
-        return str(parse_genesys_ctr_datetime(call_ctr_json["conversationStart"], conv_ctr))
+        return str(pcatelephonyctr.parse_genesys_ctr_datetime(call_ctr_json["conversationStart"], conv_ctr))
     else:
-        return str(parse_genesys_ctr_datetime(call_ctr_json["startTime"], conv_ctr))
+        return str(pcatelephonyctr.parse_genesys_ctr_datetime(call_ctr_json["startTime"], conv_ctr))
 
 
 def regenerate_segment_text(segment):
@@ -341,7 +277,7 @@ def get_filtered_json_data(json_data, key_term, key_value):
     return list(filter(lambda x: x[key_term] == key_value, json_data))
 
 
-def extract_ivr_lines(agent_channel, call_start_time, ctr_json, pca_analytics, pca_results):
+def extract_ivr_lines(agent_channel, call_start_time, ctr_index, pca_analytics, pca_results):
     """
     This goes through each of our speech segments and compares the timings with the IVR entries
     in the Genesys CTR file.  If a speech assigned to an agent starts within a Genesys IVR window
@@ -350,114 +286,107 @@ def extract_ivr_lines(agent_channel, call_start_time, ctr_json, pca_analytics, p
 
     :param agent_channel: Speaker channel for our Agent segments
     :param call_start_time: Start time for the call
-    :param ctr_json: CTR JSON data for this audio file
+    :param ctr_index: Index of the CTR data for this audio file
     :param pca_analytics: Analytics patt of PCA results
     :param pca_results: Entire PCA results set
     """
 
-    # Extract all the IVR lines - these are those where the
-    # "participant" entry has a "purpose" tag is set to "ivr"
-    # ivr_lines = get_filtered_json_data(ctr_json["participants"], "purpose", "ivr")
-    # acd_lines = get_filtered_json_data(ctr_json["participants"], "purpose", "acd")
-    ivr_lines = list(filter(lambda x: x["purpose"] == "ivr", ctr_json["participants"]))
-    acd_lines = list(filter(lambda x: x["purpose"] == "acd", ctr_json["participants"]))
-
-    # If we found any IVR lines then update the relevant speech segments
-    if ivr_lines or acd_lines:
+    # If the CTR had any IVR or ACD participants then update the relevant speech segments
+    if ctr_index["hasIvr"]:
 
         # We  need to know what the speaker number should be for the IVR entries
         ivr_speaker_name = cf.appConfig[cf.CONF_TELEPHONY_CTR].capitalize() + " " + IVR_CHANNEL_NAME
         ivr_speaker_channel, known_channel = add_speaker_to_map(pca_results.analytics, ivr_speaker_name,
                                                                 fixed_channel=IVR_CHANNEL_NAME)
 
-        # Go through and extract all do the IVR times when it was speaking
-        # sessions / segments / segmentType == "ivr" (not system) implies voice
-        # sessions / segments / segmentStart/End time
+        # Go through all of the IVR times when it was speaking, which are its "ivr" segments (not "system")
         ivr_times = []
-        for ivr_entry in ivr_lines:
-            for session in ivr_entry["sessions"]:
-                for segment in session["segments"]:
-                    if segment["segmentType"] == "ivr":
-                        # Work out this IVR entry's start/end time in seconds relative to the start of the call
-                        segment_start, segment_end = convert_times_to_seconds(segment["segmentStart"],
-                                                                              segment["segmentEnd"],
-                                                                              call_start_time)
-
-                        # If it starts BEFORE zero seconds then it's part of the conversation, but NOT this call
-                        if segment_start >= (-1 * TIMESTAMP_BUFFER): # round to half a second to account for system time differences
-                            ivr_times.append({"Start": segment_start, "End": segment_end})
+        for interval in ctr_index["ivrIntervals"]:
+            # Work out this IVR entry's start/end time in seconds relative to the start of the call
+            segment_start, segment_end = convert_interval_to_seconds(interval, call_start_time)
+
+            # If it starts BEFORE zero seconds then it's part of the conversation, but NOT this call
+            if segment_start >= (-1 * TIMESTAMP_BUFFER): # round to half a second to account for system time differences
+                ivr_times.append({"Start": segment_start, "End": segment_end})
 
         # We now need to do the same with ACD times - whilst these strictly-speaking aren't IVR entries
         # the caller is still in the automated call distribution system.  The customer has been routed,
         # so are out of the root of the IVR, but it's still an automated voice
-        # sessions / segments / segmentType == "interact"
-        # sessions / segments / segmentStart/End time
-        for acd_entry in acd_lines:
-            for session in acd_entry["sessions"]:
-                for segment in session["segments"]:
-                    if segment["segmentType"] == "interact":
-                        # Work out this IVR entry's start/end time in seconds relative to the start of the call
-                        segment_start, segment_end = convert_times_to_seconds(segment["segmentStart"],
-                                                                              segment["segmentEnd"],
-                                                                              call_start_time)
-
-                        # If it starts BEFORE zero seconds then it's part of the conversation, but NOT this call
-                        if segment_start >= 0.00:
-                            ivr_times.append({"Start": segment_start, "End": segment_end})
+        for interval in ctr_index["acdIntervals"]:
+            # Work out this IVR entry's start/end time in seconds relative to the start of the call
+            segment_start, segment_end = convert_interval_to_seconds(interval, call_start_time)
+
+            # If it starts BEFORE zero seconds then it's part of the conversation, but NOT this call
+            if segment_start >= 0.00:
+                ivr_times.append({"Start": segment_start, "End": segment_end})
 
         # Now go through each speech segment, and if it STARTS within
         # a start/end point of an agent segment, and its first word ENDS
-        # before the end of the IVR tine, then flag as IVR
-        segments_to_split = []
+        # before the end of the IVR tine, then flag as IVR.  Segments are
+        # indexed by start time so each IVR window only looks at the ones
+        # that start inside it, and the windows are taken in their original
+        # order, as a segment split by one window may be split again by a
+        # later one.  The first segment in the list is never split
+        speech_segments = pca_results.speech_segments
+        indexed_segments = sorted(speech_segments, key=lambda x: x.segmentStartTime)
+        indexed_starts = [segment.segmentStartTime for segment in indexed_segments]
+        inserted_after = {}
+        changed_segments = []
         for ivr in ivr_times:
-            for segment in pca_results.speech_segments:
+            new_segments = []
+            for segment in indexed_segments[bisect.bisect_left(indexed_starts, ivr["Start"]):
+                                            bisect.bisect_right(indexed_starts, ivr["End"])]:
                 # If this IVR block starts inside the segment, and it doesn't end before the
                 # first word in the segment, and it's an agent channel, then we have an IVR overlap
-                if (ivr["Start"] <= segment.segmentStartTime <= ivr["End"]) and \
-                        (ivr["End"] >= segment.segmentConfidence[0]["EndTime"]) and \
+                if (ivr["End"] >= segment.segmentConfidence[0]["EndTime"]) and \
                         (segment.segmentSpeaker == agent_channel):
                     # If this segment has speech after the IVR has finished then this
                     # MIGHT be agent speech, so we need to split this segment up before
                     # marking segments
-                    if segment.segmentEndTime > ivr["End"]:
-                        # If we found any segments that we need to split then do that now
-                        split_ivr_speech_segment(segment, ivr["End"], pca_results)
-
-        # Run through one more time but without splitting
-        for ivr in ivr_times:
-            for segment in pca_results.speech_segments:
-                # If this IVR block starts inside the segment, and it doesn't end before the
-                # first word in the segment, and it's an agent channel, then we have an IVR overlap
-                if (ivr["Start"] <= segment.segmentStartTime <= ivr["End"]) and \
-                        (ivr["End"] >= segment.segmentConfidence[0]["EndTime"]) and \
-                        (segment.segmentSpeaker == agent_channel):
-                    # Mark this segment as an IVR segment
-                    segment.segmentIVR = True
-                    segment.segmentSpeaker = ivr_speaker_channel
-
-                    # Erase the segment's sentiment
-                    segment.segmentIsNegative = False
-                    segment.segmentIsPositive = False
-                    segment.segmentAllSentiments = {"Positive": 0.0, "Negative": 0.0, "Neutral": 1.0}
-
-        # Run through our IVR segments calculate the time that the IVR was speaking, and
-        # whilst we're there remove any found entities (as they aren't relevant for BI)
+                    if (segment.segmentEndTime > ivr["End"]) and (segment is not speech_segments[0]):
+                        agent_segment = split_ivr_speech_segment(segment, ivr["End"], pca_results)
+                        if agent_segment is not None:
+                            inserted_after.setdefault(id(segment), []).insert(0, agent_segment)
+                            new_segments.append(agent_segment)
+                            changed_segments += [segment, agent_segment]
+
+            # New segments are only seen by later windows
+            for agent_segment in new_segments:
+                position = bisect.bisect_right(indexed_starts, agent_segment.segmentStartTime)
+                indexed_starts.insert(position, agent_segment.segmentStartTime)
+                indexed_segments.insert(position, agent_segment)
+
+        # Put any segments that we split into the results in a single pass
+        if inserted_after:
+            pca_results.speech_segments = rebuild_speech_segments(speech_segments, inserted_after)
+
+        # Now mark every segment that still matches an IVR window, with no more splitting
+        for segment in find_window_matches(ivr_times, pca_results.speech_segments):
+            if segment.segmentSpeaker == agent_channel:
+                # Mark this segment as an IVR segment
+                segment.segmentIVR = True
+                segment.segmentSpeaker = ivr_speaker_channel
+
+                # Erase the segment's sentiment
+                segment.segmentIsNegative = False
+                segment.segmentIsPositive = False
+                segment.segmentAllSentiments = {"Positive": 0.0, "Negative": 0.0, "Neutral": 1.0}
+                changed_segments.append(segment)
+
+        # Move the speaking time of the changed segments from the "Agent" speaking total to the IVR
+        # one, and (in Standard mode) update the Agent sentiment trend now that the IVR's segments aren't part of it
+        pca_results.update_speaker_analytics(changed_segments)
+
+        # Run through our IVR segments and remove any found entities (as they aren't relevant for BI)
         regenerate_entities = False
-        ivr_speaking_time = 0.0
         if ivr_times:
             for segment in pca_results.speech_segments:
                 if segment.segmentIVR:
-                    # Increment the IVR speaking time by this segment and wipe the entities
-                    ivr_speaking_time += segment.segmentEndTime - segment.segmentStartTime
                     segment.segmentCustomEntities = []
                     regenerate_entities = True
 
-        # Remove that speaking time from the "Agent" speaking total, and add an IVR one
-        if ivr_speaking_time > 0.0:
-            pca_analytics.speaker_time[ivr_speaker_channel] = {"TotalTimeSecs": ivr_speaking_time}
-            new_agent_speaking_time = pca_analytics.speaker_time[agent_channel]["TotalTimeSecs"] - ivr_speaking_time
-            pca_analytics.speaker_time[agent_channel] = {"TotalTimeSecs": new_agent_speaking_time}
-        else:
+        # Only keep the IVR in the speaker map if it did some speaking
+        if pca_analytics.speaker_time[ivr_speaker_channel]["TotalTimeSecs"] <= 0.0:
             # No IVR lines, so we should remove that from the speaker map
             pca_analytics.speaker_time.pop("IVR")
             pca_analytics.speaker_labels.pop()
@@ -467,7 +396,47 @@ def extract_ivr_lines(agent_channel, call_start_time, ctr_json, pca_analytics, p
             pca_results.regenerate_header_entities()
 
 
-def handle_multiple_agents(agent_channel, call_start_time, ctr_json, pca_results, conv_offset):
+def find_agent_speakers(agent_slots, speech_segments, agent_channel):
+    """
+    Works out which agent slots claim each agent speech segment, where a slot claims a segment that starts inside
+    it.  Slots are tried in their original order, and each claim re-tags the segment, so once a slot whose speaker
+    isn't the original agent channel claims it no later slot can - but every slot up to then that claimed it is
+    credited with its speaking time.  Segments and slots are swept in start-time order, keeping the set of slots
+    that are open at each segment's start time, so each segment only looks at the slots that overlap it
+
+    :param agent_slots: List of agent slots, each with a "SpeakerID" and "Start" and "End" times
+    :param speech_segments: List of speech segments
+    :param agent_channel: Speaker channel for our Agent segments
+    :return: List holding, for each speech segment in list order, the speakers of the slots that claimed it
+    """
+    slot_order = sorted(range(len(agent_slots)), key=lambda index: agent_slots[index]["Start"])
+    segment_order = sorted((index for index, segment in enumerate(speech_segments)
+                            if segment.segmentSpeaker == agent_channel),
+                           key=lambda index: speech_segments[index].segmentStartTime)
+    claims = [[] for segment in speech_segments]
+    open_slots = []
+    slot_ends = []
+    next_slot = 0
+    for segment_index in segment_order:
+        start_time = speech_segments[segment_index].segmentStartTime
+
+        # Open every slot that has started, and close any that have ended, keeping the open ones in original order
+        while (next_slot < len(slot_order)) and (agent_slots[slot_order[next_slot]]["Start"] <= start_time):
+            bisect.insort(open_slots, slot_order[next_slot])
+            heapq.heappush(slot_ends, (agent_slots[slot_order[next_slot]]["End"], slot_order[next_slot]))
+            next_slot += 1
+        while slot_ends and (slot_ends[0][0] < start_time):
+            open_slots.remove(heapq.heappop(slot_ends)[1])
+
+        # Each open slot claims the segment in turn until it has been re-tagged away from the agent channel
+        for slot_index in open_slots:
+            claims[segment_index].append(agent_slots[slot_index]["SpeakerID"])
+            if agent_slots[slot_index]["SpeakerID"] != agent_channel:
+                break
+    return claims
+
+
+def handle_multiple_agents(agent_channel, call_start_time, ctr_index, pca_results, conv_offset):
     """
     This picks out the various Agent interactions from the Genesys CTR file, walks through our speech
     segments and re-allocates everything after the first agent to a new speaker channel.  We also add in
@@ -475,24 +444,21 @@ def handle_multiple_agents(agent_channel, call_start_time, ctr_json, pca_results
 
     :param agent_channel: Speaker channel for our Agent segments
     :param call_start_time: Start time for the call
-    :param ctr_json: CTR JSON data for this audio file
+    :param ctr_index: Index of the CTR data for this audio file
     :param pca_results: Entire PCA results set
     :param conv_offset: Offset of this call's start time in the wider Genesys conversation
     :return Number of unique agents on the call
     """
     # Extract all the agent speaking lines
-    agent_lines = list(filter(lambda x: x["purpose"] == AGENT_CHANNEL_LC_NAME, ctr_json["participants"]))
+    agent_lines = ctr_index["agents"]
     agent_index = 0
 
     # Extract the timings for each agent speech segment, tracking the agent-id
     if agent_lines:
         agent_slots = []
-        call_timings = {}
 
-        # Get the timings for each agent's speech segment
-        # sessions / segments / segmentType == "interact" implies agent voice
-        # sessions / segments / segmentStart/End time
-        # userId => system id for user
+        # Get the timings for each agent's speech segment, which are the "interact" segments of
+        # their voice sessions, and the userId is the system id for that user
         for agent in agent_lines:
             # Update our agent index tracker and add this to the
             agent_index += 1
@@ -513,42 +479,25 @@ def handle_multiple_agents(agent_channel, call_start_time, ctr_json, pca_results
                     # This agent was already known, so roll back our agent counter
                     agent_index -= 1
 
-            # We need to sum their individual speaking times later, so start tracking at zero
-            call_timings[agent_speaker] = 0.0
-
-            # Work through this agent's sessions/segments - there could be multiple,
-            # and we need to ignore any session that doesn't have mediatype=voice
-            for session in agent["sessions"]:
-                if session["mediaType"] == "voice":
-                    for segment in session["segments"]:
-                        if segment["segmentType"] == "interact":
-                            # Start with the basic agent information
-                            next_agent = {"SpeakerID": agent_speaker}
-
-                            # Work out our start / end times for speaking
-                            agent_start, agent_end = convert_times_to_seconds(segment["segmentStart"],
-                                                                              segment["segmentEnd"],
-                                                                              call_start_time)
-
-                            # Record the speaking timestamps and add this one to our list
-                            next_agent["Start"] = agent_start
-                            next_agent["End"] = agent_end
-                            agent_slots.append(next_agent)
-
-        # Now work through the speech segments and re-tag any segments with the correct speaker tag
-        for segment in pca_results.speech_segments:
-            for agent in agent_slots:
-                if (agent["Start"] <= segment.segmentStartTime <= agent["End"]) and \
-                        segment.segmentSpeaker == agent_channel:
-                    # Mark this segment as being from this agent
-                    segment.segmentSpeaker = agent["SpeakerID"]
-
-                    # Update the speaking time for this agent
-                    call_timings[agent["SpeakerID"]] += (segment.segmentEndTime - segment.segmentStartTime)
-
-        # Write in our updated speaker timings
-        for timing in call_timings:
-            pca_results.analytics.speaker_time[timing]["TotalTimeSecs"] = call_timings[timing]
+            # Work through this agent's speaking times - there could be multiple
+            for interval in agent["intervals"]:
+                # Work out our start / end times for speaking
+                agent_start, agent_end = convert_interval_to_seconds(interval, call_start_time)
+
+                # Record the speaking timestamps and add this one to our list
+                agent_slots.append({"SpeakerID": agent_speaker, "Start": agent_start, "End": agent_end})
+
+        # Now work through the speech segments and re-tag any segments with the correct speaker tag,
+        # where the last agent to claim a segment is the one that it is marked as being from
+        changed_segments = []
+        for segment, speakers in zip(pca_results.speech_segments,
+                                     find_agent_speakers(agent_slots, pca_results.speech_segments, agent_channel)):
+            if speakers:
+                segment.segmentSpeaker = speakers[-1]
+                changed_segments.append(segment)
+
+        # Move the speaking times and sentiment of the re-tagged segments over to their agents
+        pca_results.update_speaker_analytics(changed_segments)
 
         # Return the number of distinct agents that we found
         return agent_index
@@ -559,8 +508,6 @@ def lambda_handler(event, context):
     Lambda function entrypoint
     """
     global OFFLINE_MODE
-    global FILE_SUFFIX_CONVERSATION
-    global FILE_SUFFIX_CALL
 
     # Setup some offline data
     OFFLINE_MODE = "offline" in event
@@ -576,18 +523,15 @@ def lambda_handler(event, context):
     if not OFFLINE_MODE:
         cf.loadConfiguration()
 
-    # Extract out the call suffix filenames, which may or may not exist
-    suffixes = cf.appConfig[cf.CONF_TELEPHONY_CTR_SUFFIX]
-    if len(suffixes) > 0:
-        FILE_SUFFIX_CONVERSATION = cf.appConfig[cf.CONF_TELEPHONY_CTR_SUFFIX][0]
-        if len(suffixes) > 1:
-            FILE_SUFFIX_CALL = cf.appConfig[cf.CONF_TELEPHONY_CTR_SUFFIX][1]
-
-    # Load in any associated CTR files
-    conv_ctr_json, call_ctr_json = load_ctr_files(event["key"])
+    # Use the CTR index if the transcript step prefetched it, otherwise load in any associated CTR files
+    ctr_index = event.pop("ctrIndex", None)
+    if ctr_index is None:
+        conv_ctr_json, call_ctr_json = pcatelephonyctr.load_ctr_files(event["key"], offline=OFFLINE_MODE)
+        if conv_ctr_json:
+            ctr_index = pcatelephonyctr.build_genesys_ctr_index(conv_ctr_json, call_ctr_json)
 
     # Only continue if we managed to load matching CTR files
-    if conv_ctr_json:
+    if ctr_index is not None:
         # Load in our existing interim CCA results
         pca_results = pcaresults.PCAResults()
         pca_analytics = pca_results.get_conv_analytics()
@@ -596,9 +540,9 @@ def lambda_handler(event, context):
 
         # Pick out the official call start time from the call metadata, and get the timestamp too.
         # Then get the call start time for the conversation as a whole
-        pca_analytics.conversationTime = calculate_start_time(call_ctr_json, conv_ctr=False)
+        pca_analytics.conversationTime = calculate_start_time(ctr_index["call"], conv_ctr=False)
         call_start_time = datetime.strptime(pca_analytics.conversationTime, "%Y-%m-%d %H:%M:%S.%f").timestamp()
-        conv_start_time = datetime.strptime(calculate_start_time(conv_ctr_json), "%Y-%m-%d %H:%M:%S.%f").timestamp()
+        conv_start_time = datetime.strptime(calculate_start_time(ctr_index), "%Y-%m-%d %H:%M:%S.%f").timestamp()
         conv_stat_time_offset = call_start_time - conv_start_time
 
         # Get the speaker channel for the AGENT, as that's where the IVR will be
@@ -613,11 +557,15 @@ def lambda_handler(event, context):
             pca_analytics.sentiment_trends[agent_channel]["NameOverride"] = \
                 cf.appConfig[cf.CONF_SPEAKER_NAMES][channel_index]
 
+            # Cache the speaker sentiment totals, so that the speaker times and trends can be updated
+            # for just the segments that are changed as we extract the IVR lines and multiple agents
+            pca_results.cache_speaker_accumulators()
+
             # Extract all the IVR lines and update the segments
-            extract_ivr_lines(agent_channel, call_start_time, conv_ctr_json, pca_analytics, pca_results)
+            extract_ivr_lines(agent_channel, call_start_time, ctr_index, pca_analytics, pca_results)
 
             # Split up our single agent tag to multiple tags if there is more than one agent on the call
-            unique_agents = handle_multiple_agents(agent_channel, call_start_time, conv_ctr_json, pca_results,
+            unique_agents = handle_multiple_agents(agent_channel, call_start_time, ctr_index, pca_results,
                                                    conv_stat_time_offset)
 
             # Now that we potentially have multiple agents we should update the result header's
@@ -643,31 +591,18 @@ def lambda_handler(event, context):
                         if speaker_details[0]["Speaker"] == sorted_speakers[0][0]:
                             pca_analytics.agent = speaker_details[0]["DisplayText"]
 
-            # TODO Recalculate the various sentiment trends to cater for IVR and split segments
-
             # Finally, write some of the CTR data back into the main results - note
             # that some comes from the call metatdata file, some from the conversation
-            telephony = {"conversationStart": conv_ctr_json["conversationStart"],
-                         "originatingDirection": conv_ctr_json["originatingDirection"]}
+            telephony = {"conversationStart": ctr_index["conversationStart"],
+                         "originatingDirection": ctr_index["originatingDirection"]}
 
-            # We may not hava a call-specific file, and some of this info comes from that file
+            # Some of this info comes from the call-specific file
             # TODO Some of the call-file values could be inferred from the conversation file
-            if call_ctr_json:
-                telephony["id"] = call_ctr_json["id"]
-                telephony["conversationId"] = call_ctr_json["conversationId"]
-                telephony["startTime"] = call_ctr_json["startTime"]
-                telephony["endTime"] = call_ctr_json["endTime"]
-
-            # Extract unique queueId values
-            queue_ids = []
-            for participant in conv_ctr_json["participants"]:
-                for session in participant["sessions"]:
-                    # TODO Could pick out ani and dnis values here
-                    for segment in session["segments"]:
-                        if "queueId" in segment:
-                            if segment["queueId"] not in queue_ids:
-                                queue_ids.append(segment["queueId"])
-            telephony["queueIds"] = queue_ids
+            telephony.update(ctr_index["call"])
+
+            # Add the unique queueId values
+            # TODO Could pick out ani and dnis values here
+            telephony["queueIds"] = ctr_index["queueIds"]
 
             # Write this all into the Analytics header
             pca_analytics.telephony = {
@@ -678,7 +613,7 @@ def lambda_handler(event, context):
             print("No AGENT channel defined or present in transcription output")
 
         # Now ensure that the Customer ID is set if it is defined in the CTR
-        customer_id = set_customer_id(pca_analytics.speaker_labels, conv_ctr_json)
+        customer_id = set_customer_id(pca_analytics.speaker_labels, ctr_index)
         if customer_id:
             pca_analytics.cust = customer_id
 
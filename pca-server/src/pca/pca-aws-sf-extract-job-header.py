@@ -126,6 +126,12 @@ def load_transcribe_job_header(event):
     populate_job_info(job_results_header, transcribe_job_info, api_mode, transcribe_job_info["LanguageCode"])
     job_results_header.redacted_transcript = is_redacted
 
+    # A job that was submitted with a unique suffix is still reported under the name derived from the audio
+    # file, as our filename-parsing rules and the results file name are based upon that
+    base_job_name = event.get("jobBaseName", job_name)
+    if base_job_name != job_name:
+        job_results_header.transcribe_job_name = base_job_name
+
     # Pass the location of any redacted audio to the next step - it isn't
     # needed in the results, but the next step in the workflow may need it
     if "RedactedMediaFileUri" in transcribe_job_info["Media"]:
@@ -161,6 +167,7 @@ def lambda_handler(event, context):
 
     # Now write it out to our interim results location
     json_output_filename = sf_event["transcriptUri"].split("/")[-1]
+    json_output_filename = json_output_filename.replace(job_name, sf_event.get("jobBaseName", job_name))
     json_output, output_filename = interim_results.write_results_to_s3(object_key=json_output_filename, interim=True)
     sf_event["interimResultsFile"] = output_filename
 
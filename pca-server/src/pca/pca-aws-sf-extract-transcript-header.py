@@ -12,6 +12,7 @@ from datetime import datetime
 from pathlib import Path
 import pcaconfiguration as cf
 import pcacommon
+import pcaaudioprobe
 import boto3
 import json
 import time
@@ -56,32 +57,25 @@ def update_audio_file_metadata(sf_event, interim_results):
     :param sf_event: Step Function input event data
     :param interim_results:
     """
-    # First, we need to download the original audio file, which for streaming analytics
-    # will be in the playbackAudio folder, named after the transcript, and will be a WAV
+    # The original audio file for streaming analytics will be in the playbackAudio folder,
+    # named after the transcript, and will be a WAV
     ts_info = interim_results.get_conv_analytics().get_transcribe_job()
     base_filename = (sf_event["key"].split('/')[-1]).split('.json')[0] + '.wav'
-    output_filename = TMP_DIR + "/" + base_filename
     input_filename = cf.appConfig[cf.CONF_PREFIX_AUDIO_PLAYBACK] + "/" + base_filename
 
-    # Now download and process that audio file
+    # Now process that audio file, which only needs to read its headers
     try:
-        # Download
-        s3Client = boto3.client('s3')
-        s3Client.download_file(cf.appConfig[cf.CONF_S3BUCKET_INPUT], input_filename, output_filename)
-
         # Extract some stream-based metadata from the audio file
-        ts_info.media_sample_rate = int(pcacommon.ffprobe_get_stream_entries("stream=sample_rate", output_filename))
-        ts_info.media_format = pcacommon.ffprobe_get_stream_entries("format=format_name", output_filename)
+        audio_info = pcaaudioprobe.probe_s3_audio(cf.appConfig[cf.CONF_S3BUCKET_INPUT], input_filename)
+        ts_info.media_sample_rate = audio_info.sample_rate
+        ts_info.media_format = audio_info.media_format
 
         # Update our audio file locations
         ts_info.media_original_uri = "s3://" + cf.appConfig[cf.CONF_S3BUCKET_INPUT] + "/" + input_filename
         ts_info.media_playback_uri = ts_info.media_original_uri
-
-        # Remove any temp tile
-        pcacommon.remove_temp_file(output_filename)
     except Exception as e:
         print(e)
-        print(f"Unable to download/process audio file associated with transcript {sf_event['key']}")
+        print(f"Unable to process audio file associated with transcript {sf_event['key']}")
 
 
 def create_participant_map(sf_event, asr_output):
@@ -24,9 +24,15 @@ def lambda_handler(event, context):
 
     # --------- Do any post processing here ----------
 
-    # Write out back to interim file
-    pca_results.write_results_to_s3(bucket=cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
-                                    object_key=event["interimResultsFile"])
+    # Write out back to interim file if summarization still needs it, otherwise we're the last step to change the
+    # results, so write them straight to the final location and mark that as done for the final processing step
+    if event.get("summarize", "false") == "true":
+        pca_results.write_results_to_s3(bucket=cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                        object_key=event["interimResultsFile"])
+    else:
+        event["parsedResultsFile"] = pca_results.write_final_results_to_s3(bucket=cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                                                           interim_key=event["interimResultsFile"],
+                                                                           keep_interim="debug" in event)
 
     return event
 
@@ -1,13 +1,18 @@
 """
 This python function is part of the main processing workflow.  It performs any final processing steps required
 when the main processing has completed, along with any additional optional processing carried out by the
-telephony-specific Contract Trace Record handling
+telephony-specific Contract Trace Record handling.  The final results file will normally have already been written
+by the last step that changed it, so this is usually just the clean-up of the interim results file
 
 Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
 import boto3
 import pcaconfiguration as cf
+import pcabulkscheduler
+import pcacontentdedup
+import pcaresults
+import pcasearchindex
 
 
 def lambda_handler(event, context):
@@ -19,14 +24,35 @@ def lambda_handler(event, context):
     cf.loadConfiguration()
     results_bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
 
-    # This function just has to move the interim results file to the full results file
-    s3_resource = boto3.resource("s3")
-    dest_key = cf.appConfig[cf.CONF_PREFIX_PARSED_RESULTS] + "/" + event["interimResultsFile"].split("/")[-1]
-    copy_source = {
-        'Bucket': results_bucket,
-        'Key': event["interimResultsFile"]
-    }
-    s3_resource.meta.client.copy(copy_source, results_bucket, dest_key)
+    # The last step that changed the results should have written them straight to the final location,
+    # in which case this is all we have to do.  If not then we have to create the final results file here
+    if "parsedResultsFile" not in event:
+        word_sidecar = pcaresults.is_word_confidence_sidecar_enabled()
+        paged_output = pcaresults.is_paged_output_enabled()
+        search_index = pcasearchindex.is_search_index_enabled()
+        if word_sidecar or paged_output or search_index:
+            # We need to re-write the results rather than copy them if any optional output layouts are enabled
+            pca_results = pcaresults.PCAResults()
+            pca_results.read_results_from_s3(bucket=results_bucket, object_key=event["interimResultsFile"])
+            event["parsedResultsFile"] = pca_results.write_final_results_to_s3(bucket=results_bucket,
+                                                                               interim_key=event["interimResultsFile"])
+        else:
+            s3_resource = boto3.resource("s3")
+            dest_key = pcaresults.get_parsed_results_key(event["interimResultsFile"])
+            copy_source = {
+                'Bucket': results_bucket,
+                'Key': event["interimResultsFile"]
+            }
+            s3_resource.meta.client.copy(copy_source, results_bucket, dest_key)
+            event["parsedResultsFile"] = dest_key
+
+    # If this file claimed a content fingerprint then link it to our results, so that any duplicates can find them
+    if "contentFingerprint" in event:
+        pcacontentdedup.record_content_results(event["contentFingerprint"], event["parsedResultsFile"],
+                                               event.get("conversationDuration", 0.0))
+
+    # If this file came from the bulk workflow then it's no longer in flight
+    pcabulkscheduler.finish_in_flight(event["bucket"], event["key"])
 
     # Then delete the interim file if we're not debugging
     if "debug" not in event:
@@ -9,10 +9,12 @@ from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlparse
 from math import floor
-from pcakendrasearch import prepare_transcript, put_kendra_document
-from pcaresults import SpeechSegment, PCAResults
+from concurrent.futures import ThreadPoolExecutor
+from pcakendrasearch import prepare_transcript_parts, put_kendra_document, is_kendra_queue_enabled, queue_kendra_document
+from pcaresults import SpeechSegment, PCAResults, TimelineIndex
 import pcaconfiguration as cf
 import pcacommon
+import pcatelephonyctr
 import subprocess
 import copy
 import re
@@ -20,6 +22,7 @@ import json
 import csv
 import boto3
 import time
+import os
 
 # Sentiment helpers
 MIN_SENTIMENT_LENGTH = 8
@@ -32,6 +35,14 @@ PII_PLACEHOLDER_MASK = "*" * len(PII_PLACEHOLDER)
 TMP_DIR = "/tmp"
 BAR_CHART_WIDTH = 1.0
 
+# Number of independent I/O stages that can run at once whilst parsing a call
+PROCESSING_THREADS = int(os.getenv("PROCESSING_THREADS", "4"))
+
+# Playback audio conversion settings - 0 threads lets FFMPEG decide
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "0"))
+STREAM_CHUNK_SIZE = 1024 * 1024
+PLAYBACK_SOURCE_ETAG = "source-etag"
+
 
 class TranscribeParser:
 
@@ -725,8 +736,10 @@ class TranscribeParser:
             for channel_def in sf_event["channelDefinitions"]:
                 self.analytics_channel_map[channel_def["ParticipantRole"]] = channel_def["ChannelId"]
 
-            # Lookup shortcuts
+            # Lookup shortcuts, with each interrupter's interruptions indexed by their start time
             interrupts = self.asr_output["ConversationCharacteristics"]["Interruptions"]
+            interrupt_timelines = {role: TimelineIndex([entry["BeginOffsetMillis"] for entry in entries])
+                                   for role, entries in interrupts["InterruptionsByInterrupter"].items()}
 
             # Each turn has already been processed by Transcribe, so the outputs are in order
             for turn in self.asr_output["Transcript"]:
@@ -746,14 +759,11 @@ class TranscribeParser:
                 nextSpeechSegment.segmentConfidence = confidenceList
                 skipLeadingSpace = True
 
-                # Check if this block is within an interruption block for the speaker
-                if turn["ParticipantRole"] in interrupts["InterruptionsByInterrupter"]:
-                    turnStart = turn["BeginOffsetMillis"]
-                    turnEnd = turn["EndOffsetMillis"]
-                    for entry in interrupts["InterruptionsByInterrupter"][turn["ParticipantRole"]]:
-                        if (entry["BeginOffsetMillis"] >= turnStart) and (entry["BeginOffsetMillis"] < turnEnd):
-                            nextSpeechSegment.segmentInterruption = True
-                            break
+                # Check if an interruption by the speaker starts within this block
+                if turn["ParticipantRole"] in interrupt_timelines:
+                    if interrupt_timelines[turn["ParticipantRole"]].find_starting_between(turn["BeginOffsetMillis"],
+                                                                                          turn["EndOffsetMillis"]):
+                        nextSpeechSegment.segmentInterruption = True
 
                 # Process each word in this turn
                 if "Items" in turn:
@@ -1051,57 +1061,127 @@ class TranscribeParser:
                 # Remove our temporary in case of Lambda container re-use
                 pcacommon.remove_temp_file(mapFilepath)
 
+    def stream_audio_to_ffmpeg(self, source_body, ffmpeg_process):
+        """
+        Feeds an S3 object body into the stdin of an FFMPEG process in chunks, and then closes stdin so that
+        FFMPEG knows the input has finished.  This runs on its own thread whilst the output is being uploaded
+
+        @param source_body: StreamingBody of the source S3 object
+        @param ffmpeg_process: Running FFMPEG process
+        @return: Number of bytes sent to FFMPEG
+        """
+        bytes_sent = 0
+        try:
+            for chunk in source_body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE):
+                ffmpeg_process.stdin.write(chunk)
+                bytes_sent += len(chunk)
+        except BrokenPipeError:
+            # FFMPEG has stopped reading, so it will have failed - that gets reported by its exit code
+            pass
+        finally:
+            try:
+                ffmpeg_process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        return bytes_sent
+
     def create_playback_mp3_audio(self, audio_uri):
         """
         Creates and MP3-version of the audio file used in the Transcribe job, as the HTML5 <audio> playback
         controller cannot play them back if they are GSM-encoded 8Khz WAV files.  Still need to work out how
         to check for then encoding type via FFMPEG, but we do get the other info from Transcribe.
 
+        Rather than downloading the file and converting it locally the source audio is streamed from S3 through
+        FFMPEG and straight into a multipart upload, so nothing is written to local storage.  Once FFMPEG has
+        finished cleanly the output is tagged with the ETag of the source audio, so if the same audio is
+        re-processed then the conversion is skipped; an output that was never tagged is always re-created.
+
         @param audio_uri: URI of the audio file to be potentially dowloaded and converted
         """
 
         # Get some info on the audio file before continuing
         s3Object = urlparse(audio_uri)
         bucket = s3Object.netloc
-
-        # 8Khz WAV audio gets converted - first, we need to download the original audio file
         fileObject = s3Object.path.lstrip('/')
-        inputFilename = TMP_DIR + '/' + fileObject.split('/')[-1]
-        outputFilename = inputFilename.split('.wav')[0] + '.mp3'
+        outputFilename = fileObject.split('/')[-1].split('.wav')[0] + '.mp3'
+        s3FileKey = cf.appConfig[cf.CONF_PREFIX_AUDIO_PLAYBACK] + '/' + outputFilename
+        playbackUri = "s3://" + cf.appConfig[cf.CONF_S3BUCKET_INPUT] + "/" + s3FileKey
         s3Client = boto3.client('s3')
-        s3Client.download_file(bucket, fileObject, inputFilename)
 
-        # Transform the file via FFMPEG - this will exception if not installed
+        # If we've already converted this exact source audio then there's nothing to do
+        source_etag = s3Client.head_object(Bucket=bucket, Key=fileObject)["ETag"].strip('"')
+        try:
+            existing = s3Client.head_object(Bucket=cf.appConfig[cf.CONF_S3BUCKET_INPUT], Key=s3FileKey)
+            if existing["Metadata"].get(PLAYBACK_SOURCE_ETAG) == source_etag:
+                self.audioPlaybackUri = playbackUri
+                print(f"Re-using existing MP3 playback audio {playbackUri} for source ETag {source_etag}")
+                return
+        except Exception:
+            # No existing conversion, so carry on
+            pass
+
+        # Transform the file via FFMPEG, piping S3 -> FFMPEG -> S3 - this will exception if not installed
+        start_time = time.time()
+        source = None
+        ffmpeg_process = None
         try:
-            # Just convert from source to destination format
-            subprocess.call(['ffmpeg', '-nostats', '-loglevel', '0', '-y', '-i', inputFilename, outputFilename],
-                            stdin=subprocess.DEVNULL)
-
-            # Now upload the output file to the configured playback folder in the main input bucket
-            s3FileKey = cf.appConfig[cf.CONF_PREFIX_AUDIO_PLAYBACK] + '/' + outputFilename.split('/')[-1]
-            s3Client.upload_file(outputFilename, cf.appConfig[cf.CONF_S3BUCKET_INPUT], s3FileKey,
-                                 ExtraArgs={'ContentType': 'audio/mp3'})
-            self.audioPlaybackUri = "s3://" + cf.appConfig[cf.CONF_S3BUCKET_INPUT] + "/" + s3FileKey
+            source = s3Client.get_object(Bucket=bucket, Key=fileObject, IfMatch=source_etag)
+            ffmpeg_process = subprocess.Popen(['ffmpeg', '-nostats', '-loglevel', '0', '-y',
+                                               '-threads', str(FFMPEG_THREADS), '-i', 'pipe:0', '-f', 'mp3', 'pipe:1'],
+                                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                              stderr=subprocess.DEVNULL)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                feeder = executor.submit(self.stream_audio_to_ffmpeg, source["Body"], ffmpeg_process)
+
+                # Upload what FFMPEG produces to the configured playback folder in the main input bucket
+                bytes_uploaded = [0]
+                def upload_progress(bytes_transferred):
+                    bytes_uploaded[0] += bytes_transferred
+                try:
+                    s3Client.upload_fileobj(ffmpeg_process.stdout, cf.appConfig[cf.CONF_S3BUCKET_INPUT], s3FileKey,
+                                            ExtraArgs={'ContentType': 'audio/mp3'}, Callback=upload_progress)
+                except Exception:
+                    # Stop FFMPEG, as otherwise the feeder thread stays blocked writing to it and we'd never
+                    # get out of the executor
+                    ffmpeg_process.kill()
+                    ffmpeg_process.wait()
+                    ffmpeg_process.stdout.close()
+                    raise
+                bytes_read = feeder.result()
+
+            # Only use the output if FFMPEG was happy with the input, otherwise remove it - it is never re-used, as
+            # it's only tagged with the source ETag once we know that it's good
+            if ffmpeg_process.wait() != 0:
+                s3Client.delete_object(Bucket=cf.appConfig[cf.CONF_S3BUCKET_INPUT], Key=s3FileKey)
+                raise Exception(f"FFMPEG failed with exit code {ffmpeg_process.returncode}")
+            s3Client.copy_object(Bucket=cf.appConfig[cf.CONF_S3BUCKET_INPUT], Key=s3FileKey,
+                                 CopySource={'Bucket': cf.appConfig[cf.CONF_S3BUCKET_INPUT], 'Key': s3FileKey},
+                                 MetadataDirective='REPLACE', ContentType='audio/mp3',
+                                 Metadata={PLAYBACK_SOURCE_ETAG: source_etag})
+            self.audioPlaybackUri = playbackUri
+            print(f"Created MP3 playback audio {playbackUri} from {bytes_read} to {bytes_uploaded[0]} bytes "
+                  f"in {time.time() - start_time:.2f} seconds")
         except Exception as e:
             print(e)
             print("Unable to create MP3 version of original audio file - could not find FFMPEG libraries")
         finally:
-            # Remove our temporary files in case of Lambda container re-use
-            pcacommon.remove_temp_file(inputFilename)
-            pcacommon.remove_temp_file(outputFilename)
-
-    def parse_transcribe_file(self, sf_event):
-        """
-        Parses the output from the specified Transcribe job
+            if ffmpeg_process is not None:
+                if ffmpeg_process.poll() is None:
+                    ffmpeg_process.kill()
+                    ffmpeg_process.wait()
+                ffmpeg_process.stdout.close()
+            if source is not None:
+                source["Body"].close()
+
+    def copy_playback_audio(self, sf_event):
         """
+        Puts a playback audio file in the correct folder - this can have multiple sources, but nothing here
+        depends upon the transcript parsing, so this can run alongside it
 
-        # First, load in what interim results we have so far
-        output_bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+        @param sf_event: Step Functions event data for this call
+        """
         input_bucket = cf.appConfig[cf.CONF_S3BUCKET_INPUT]
-        self.pca_results.read_results_from_s3(output_bucket, sf_event["interimResultsFile"])
-        self.api_mode = self.pca_results.analytics.transcribe_job.api_mode
-
-        # Put a playback audio file in the correct folder - this can have multiple sources
         if "redactedMediaFileUri" in sf_event:
             # If we have redacted audio output from TCA then copy that to the playback folder
             redacted_url = "s3://" + "/".join(sf_event["redactedMediaFileUri"].split("/")[3:])
@@ -1115,25 +1195,25 @@ class TranscribeParser:
                 # Certain type of WAV don't play nicely with the HTML playback control
                 self.create_playback_mp3_audio(self.analytics.transcribe_job.media_playback_uri)
         else:
-            # Copy the original input file to the playback folder
+            # Copy the original input file to the playback folder, which may not be in our input bucket
+            # if it is being processed in-place from a bulk ingestion manifest
             s3_client = boto3.resource("s3")
-            source = {"Bucket": input_bucket, "Key": sf_event["key"]}
+            source = {"Bucket": sf_event.get("bucket", input_bucket), "Key": sf_event["key"]}
             dest_key = cf.appConfig[cf.CONF_PREFIX_AUDIO_PLAYBACK] + '/' + sf_event["key"].split('/')[-1]
             s3_client.meta.client.copy(source, input_bucket, dest_key)
             self.audioPlaybackUri = "s3://" + input_bucket + "/" + dest_key
 
-        # Pick out the config parameters that we need
+    def download_transcript(self, sf_event, json_filepath):
+        """
+        Downloads the Transcribe job JSON results file to a local temp file and loads it in for processing
 
-        # Parse various fields from the Transcribe job name if possible
-        job_name = self.analytics.transcribe_job.transcribe_job_name
-        self.set_guid(job_name)
-        self.set_agent(job_name)
-        self.set_cust(job_name)
-        self.calculate_transcribe_conversation_time(job_name)
+        @param sf_event: Step Functions event data for this call
+        @param json_filepath: Local filename to download the transcript to
+        """
 
-        # Download the job JSON results file to a local temp file - different Transcribe modes put the files in
-        # different folder structures, so strip everything past the bucket name to be the location of the tmp file
-        json_filepath = TMP_DIR + '/' + sf_event["transcriptUri"].split("/")[-1]
+        # Different Transcribe modes put the files in different folder structures, so strip
+        # everything past the bucket name to be the location of the tmp file
+        output_bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
         if sf_event["transcriptUri"].startswith("https"):
             # HTTPS URI came from Transcribe, so https://<region>/<bucket>/<key>
             transcriptResultsKey = "/".join(sf_event["transcriptUri"].split("/")[4:])
@@ -1150,42 +1230,140 @@ class TranscribeParser:
             time.sleep(3)
             s3Client.download_file(output_bucket, transcriptResultsKey, json_filepath)
 
-        # Load in the JSON file for processing, and set our language codes for the file and Comprehend
+        # Load in the JSON file for processing
         self.asr_output = json.load(open(Path(json_filepath).absolute(), "r", encoding="utf-8"))
 
-        # Before we process, let's load up any required simply entity map, which needs the base language code
+    def load_language_resources(self):
+        """
+        Sets the Comprehend language code for the call, and then loads up any required simple entity map,
+        which needs that base language code
+        """
         self.set_comprehend_language_code()
         self.load_simple_entity_string_map()
 
-        # Now create turn-by-turn diarisation, with associated sentiments and entities
-        self.speechSegmentList = self.create_turn_by_turn_segments(sf_event)
+    def index_transcript_in_kendra(self, results_filename, conversation_analytics):
+        """
+        Indexes the transcript in Kendra, if transcript search is enabled.  If the Kendra indexing queue is
+        defined then the document is just queued, and the indexer submits it in a batch along with other calls
 
-        # Update our results data structures, generate JSON results and save them to S3
-        self.push_turn_by_turn_results()
+        @param results_filename: Filename of the PCA results file, which is named after the Transcribe job's base name
+        @param conversation_analytics: [ConversationAnalytics] JSON block of the results
+        """
+        kendraIndexId = cf.appConfig[cf.CONF_KENDRA_INDEX_ID]
+        if kendraIndexId != "None":
+            analysisUri = f"{cf.appConfig[cf.CONF_WEB_URI]}dashboard/parsedFiles/{results_filename}"
+            transcript_parts = prepare_transcript_parts(self.pca_results)
+            if is_kendra_queue_enabled():
+                queue_kendra_document(kendraIndexId, analysisUri, conversation_analytics, transcript_parts,
+                                      cf.appConfig[cf.CONF_S3BUCKET_OUTPUT])
+            else:
+                put_kendra_document(kendraIndexId, analysisUri, conversation_analytics, transcript_parts)
 
-        # Update summary structures
-        self.process_tca_summary()
+    def wait_for_stages(self, stages):
+        """
+        Waits for a set of concurrently running processing stages to complete.  Every stage is allowed to finish,
+        and every failure is logged against its stage name, before the first failure is raised to the caller
 
-        # Write out the JSON data back to our interim S3 location
-        json_output, output_filename = self.pca_results.write_results_to_s3(bucket=output_bucket,
-                                                                            object_key=sf_event["interimResultsFile"])
+        @param stages: Dictionary of stage name to the Future running that stage
+        @return: Dictionary of stage name to the result of that stage
+        """
+        results = {}
+        failures = []
+        for stage_name, stage in stages.items():
+            try:
+                results[stage_name] = stage.result()
+            except Exception as e:
+                print(f"Processing stage '{stage_name}' failed: {e}")
+                failures.append((stage_name, e))
 
-        # Index transcript in Kendra, if transcript search is enable
-        kendraIndexId = cf.appConfig[cf.CONF_KENDRA_INDEX_ID]
-        if kendraIndexId != "None":
-            analysisUri = f"{cf.appConfig[cf.CONF_WEB_URI]}dashboard/parsedFiles/{json_filepath.split('/')[-1]}"
-            transcript_with_markers = prepare_transcript(self.pca_results)
-            conversationAnalytics = json_output["ConversationAnalytics"]
-            put_kendra_document(kendraIndexId, analysisUri, conversationAnalytics, transcript_with_markers)
+        if failures:
+            stage_name, error = failures[0]
+            raise Exception(f"Processing stage '{stage_name}' failed for this call") from error
+
+        return results
+
+    def parse_transcribe_file(self, sf_event):
+        """
+        Parses the output from the specified Transcribe job.  The I/O-bound stages that do not depend upon each
+        other are run concurrently, with the dependencies between the stages being:
+
+            read-results ----+--> playback-audio ---------------------+
+                             +--> language-resources --+               +--> push-results --+--> write-results
+            download-transcript -----------------------+--> parse-nlp -+                   +--> kendra-index
+            ctr-prefetch -------------------------------------------------------------------------------------->
+
+        The ctr-prefetch stage only runs for Genesys calls, and loads and indexes the CTR files for the Genesys
+        CTR step that follows, passing on the index in "ctrIndex".  It never fails, as if it doesn't produce an
+        index then that step simply loads the CTR files itself
+        """
+        output_bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+
+        # The transcript is often named the same as our interim results file, and they are downloaded at the
+        # same time, so give the local copy of the transcript a distinct name
+        json_filepath = TMP_DIR + '/transcript-' + sf_event["transcriptUri"].split("/")[-1]
+
+        # boto3's default session is not thread-safe until it has created a client, so do that here first
+        boto3.client("s3")
+        try:
+            with ThreadPoolExecutor(max_workers=PROCESSING_THREADS) as executor:
+                # Start prefetching any telephony CTR files, as nothing here depends upon them
+                ctr_stage = None
+                if cf.appConfig[cf.CONF_TELEPHONY_CTR] == "genesys":
+                    ctr_stage = executor.submit(pcatelephonyctr.prefetch_genesys_ctr_index, sf_event["key"])
+
+                # First, load in what interim results we have so far, and download the transcript at the same time
+                transcript_stage = executor.submit(self.download_transcript, sf_event, json_filepath)
+                self.wait_for_stages({"read-results": executor.submit(self.pca_results.read_results_from_s3,
+                                                                      output_bucket, sf_event["interimResultsFile"])})
+                self.api_mode = self.pca_results.analytics.transcribe_job.api_mode
+
+                # Now we know the media details and language we can create the playback audio and load our entity map
+                audio_stage = executor.submit(self.copy_playback_audio, sf_event)
+                language_stage = executor.submit(self.load_language_resources)
+
+                # Parse various fields from the Transcribe job name if possible
+                job_name = self.analytics.transcribe_job.transcribe_job_name
+                self.set_guid(job_name)
+                self.set_agent(job_name)
+                self.set_cust(job_name)
+                self.calculate_transcribe_conversation_time(job_name)
+
+                # Now create turn-by-turn diarisation, with associated sentiments and entities
+                self.wait_for_stages({"download-transcript": transcript_stage, "language-resources": language_stage})
+                self.speechSegmentList = self.create_turn_by_turn_segments(sf_event)
+
+                # Update our results data structures, which needs the playback audio location, and summary structures
+                self.wait_for_stages({"playback-audio": audio_stage})
+                self.push_turn_by_turn_results()
+                self.process_tca_summary()
+
+                # Write out the JSON data back to our interim S3 location, and index it in Kendra (or queue it
+                # for the Kendra indexer) at the same time
+                self.wait_for_stages({
+                    "write-results": executor.submit(self.pca_results.write_results_to_s3,
+                                                     bucket=output_bucket, object_key=sf_event["interimResultsFile"]),
+                    "kendra-index": executor.submit(self.index_transcript_in_kendra,
+                                                    sf_event["interimResultsFile"].split("/")[-1],
+                                                    self.analytics.create_json_output())})
+
+                # Pass on the CTR index if we managed to build one
+                if ctr_stage is not None:
+                    ctr_index = self.wait_for_stages({"ctr-prefetch": ctr_stage})["ctr-prefetch"]
+                    if ctr_index is not None:
+                        sf_event["ctrIndex"] = ctr_index
+        finally:
+            # delete the local file
+            pcacommon.remove_temp_file(json_filepath)
+
+        # Pass on the call duration if final processing needs to record it against this file's content fingerprint
+        if "contentFingerprint" in sf_event:
+            sf_event["conversationDuration"] = self.analytics.duration
 
         # Finally, remove any Step Functions data that we don't need to pass on (they won't all exist)
         sf_event.pop("transcriptUri", None)
         sf_event.pop("channelDefinitions", None)
         sf_event.pop("redactedMediaFileUri", None)
 
-        # delete the local file
-        pcacommon.remove_temp_file(json_filepath)
-
 
 def lambda_handler(event, context):
     # Load our configuration data
@@ -0,0 +1,28 @@
+"""
+This python function is part of the main processing workflow.  It handles the clean-up for when the workflow fails
+unexpectedly in one of its processing steps, releasing anything that this execution was holding on to so that the
+file doesn't block the processing of any others.  The original audio is left where it is.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import pcabulkscheduler
+import pcacontentdedup
+
+
+def lambda_handler(event, context):
+    """
+    When a processing step has failed then we need to release this file's hold on any shared resources
+    """
+    # The failing step's error is in the event, but the file location is as it was when the workflow started
+    print(f"Processing failed for s3://{event['bucket']}/{event['key']}: {event.get('error', {})}")
+
+    # If this file came from the bulk workflow then it's no longer in flight
+    pcabulkscheduler.finish_in_flight(event["bucket"], event["key"])
+
+    # If this file claimed its content fingerprint then release it, as any copy of it should now be processed
+    if "contentFingerprint" in event:
+        pcacontentdedup.release_content_fingerprint(event["contentFingerprint"], event["bucket"], event["key"])
+
+    # Return our input data as the final result
+    return event
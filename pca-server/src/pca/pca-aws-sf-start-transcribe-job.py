@@ -8,16 +8,23 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
 import copy
+import hashlib
+import json
+import uuid
 import boto3
 from botocore.config import Config
-import subprocess
 import pcaconfiguration as cf
 import pcacommon
+import pcaaudioprobe
+import pcatranscribecatalog
+import pcajobcounter
 import os
-import time
 
-# Local temporary folder for file-based operations
-TMP_DIR = "/tmp/"
+# Policy for jobs that already exist, and the tracking table that holds our job settings fingerprints
+REUSE_COMPLETED_JOBS = os.getenv("REUSE_COMPLETED_JOBS", "true")
+JOB_TABLE_NAME = os.getenv("TableName", "")
+JOB_TABLE_SK = "job-fingerprint"
+MAX_JOB_NAME_LENGTH = 200
 
 config = Config(
    retries = {
@@ -52,7 +59,8 @@ def check_existing_job_status(job_name, transcribe, api_mode):
 
 def delete_existing_job(job_name, transcribe, api_mode):
     """
-    Deletes the specified transcription job from either the Standard or Call Analytics APIs
+    Deletes the specified transcription job from either the Standard or Call Analytics APIs.  Its transcript is
+    left where it is in our output bucket
 
     @param job_name: Name of the transcription job to delete
     @param transcribe: Boto3 client for the Transcribe service
@@ -63,17 +71,97 @@ def delete_existing_job(job_name, transcribe, api_mode):
             transcribe.delete_call_analytics_job(CallAnalyticsJobName=job_name)
         else:
             transcribe.delete_transcription_job(TranscriptionJobName=job_name)
-        # let the job process for a few seconds
-        time.sleep(5) 
     except Exception as e:
         # If the job has already been deleted then we don't need to take any action
         print(f"Unable to delete previous Transcribe job {job_name}: {e}")
 
 
+def is_job_reuse_enabled():
+    """
+    Returns flag to indicate if a completed job with matching settings should be reused rather than resubmitted
+    """
+    return REUSE_COMPLETED_JOBS.lower() == "true"
+
+
+def create_settings_fingerprint(api_mode, job_request, source_etag):
+    """
+    Generates a fingerprint of the settings that a Transcribe job request will use, which covers the API mode,
+    languages, vocabularies, CLMs, redaction and channel settings, along with the identity of the source audio.
+    The job name is excluded, as is anything that does not affect the transcript, such as the IAM role
+
+    @param api_mode: Transcribe API mode being used
+    @param job_request: Parameters for the Transcribe start-job API call
+    @param source_etag: ETag of the audio file in S3, so a replaced file is never treated as a match
+    @return: Hex digest of the fingerprint
+    """
+    ignored_params = ["TranscriptionJobName", "CallAnalyticsJobName", "DataAccessRoleArn", "JobExecutionSettings"]
+    settings = {k: v for k, v in job_request.items() if (v is not None) and (k not in ignored_params)}
+    settings["ApiMode"] = api_mode
+    settings["SourceETag"] = source_etag
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_job_fingerprint(base_job_name):
+    """
+    Loads the details of the last job that we submitted for this audio file from our tracking table
+
+    @param base_job_name: Job name generated from the audio file name
+    @return: Dictionary holding "JobName", "ApiMode" and "Fingerprint", or None if there isn't one
+    """
+    if JOB_TABLE_NAME == "":
+        return None
+
+    try:
+        table = boto3.resource("dynamodb").Table(JOB_TABLE_NAME)
+        response = table.get_item(Key={"PKJobId": base_job_name, "SKApiMode": JOB_TABLE_SK})
+        if "Item" in response:
+            return response["Item"]
+    except Exception as e:
+        print(f"Unable to load previous job settings for {base_job_name}: {str(e)}")
+
+    return None
+
+
+def save_job_fingerprint(base_job_name, job_name, api_mode, fingerprint):
+    """
+    Records the job that we have submitted for this audio file, and its settings fingerprint, in our tracking table
+
+    @param base_job_name: Job name generated from the audio file name
+    @param job_name: Name of the Transcribe job that was started, which may carry a unique suffix
+    @param api_mode: Transcribe API mode being used
+    @param fingerprint: Settings fingerprint of the job
+    """
+    if JOB_TABLE_NAME == "":
+        return
+
+    try:
+        table = boto3.resource("dynamodb").Table(JOB_TABLE_NAME)
+        table.put_item(Item={"PKJobId": base_job_name,
+                             "SKApiMode": JOB_TABLE_SK,
+                             "JobName": job_name,
+                             "ApiMode": api_mode,
+                             "Fingerprint": fingerprint})
+    except Exception as e:
+        print(f"Unable to save job settings for {base_job_name}: {str(e)}")
+
+
+def generate_unique_job_name(base_job_name):
+    """
+    Generates a new job name by adding a unique suffix to the base name, which lets us submit a new job without
+    first having to delete the existing one that has the same name
+
+    @param base_job_name: Job name generated from the audio file name
+    @return: Unique job name
+    """
+    suffix = "-" + uuid.uuid4().hex[:8]
+    return base_job_name[:MAX_JOB_NAME_LENGTH - len(suffix)] + suffix
+
+
 def extract_audio_metadata(bucket, key):
     """
-    Examines an audio file using the FFPROBE utility to determine (1) the number of audio channels in the file, and
-    (2) if the audio is a NarrowBand audio file < 16000 Hz sample rate.  If errors occur these will default to
+    Examines the headers of an audio file to determine (1) the number of audio channels in the file, and
+    (2) if the audio is a NarrowBand audio file < 16000 Hz sample rate.  Only the start of the file is read
+    unless the headers cannot be parsed, in which case FFPROBE is used.  If errors occur these will default to
     1 (mono audio) and True (NarrowBand) respectively
 
     @param bucket: Bucket holding the audio file to be tested
@@ -81,36 +169,14 @@ def extract_audio_metadata(bucket, key):
     @return: Number of audio channels found in the file
     @return: Flag indicating if audio is sub-8khz/NarrowBand (True) or 16khz+/WideBand (False)
     """
-
-    # First, we need to download the original audio file
-    ffmpegInputFilename = TMP_DIR + key.split('/')[-1]
-    s3Client = boto3.client('s3')
-    s3Client.download_file(bucket, key, ffmpegInputFilename)
-
-    # Use ffprobe to count the number of channels in the audio file
     try:
-        command = ['ffprobe', '-i', ffmpegInputFilename, '-show_entries', 'stream=channels', '-select_streams',
-                   'a:0', '-of', 'compact=p=0:nk=1', '-v', '0']
-        probResult = subprocess.check_output(command, stderr=subprocess.STDOUT).decode()
-        channels_found = int(probResult)
+        audio_info = pcaaudioprobe.probe_s3_audio(bucket, key)
+        channels_found = audio_info.channels
+        is_narrowband = (audio_info.sample_rate < 16000)
     except Exception as e:
-        print(f'Failed to get number of audio streams from input file: {str(e)}')
+        print(f'Failed to get audio stream properties from input file: {str(e)}')
         channels_found = 1
-
-
-    # Use ffprobe to get the sample rate and decide if it's wideband or narrowband
-    try:
-        command = ['ffprobe', '-i', ffmpegInputFilename, '-show_entries', 'stream=sample_rate', '-select_streams',
-                   'a:0', '-of', 'compact=p=0:nk=1', '-v', '0']
-        probResult = subprocess.check_output(command, stderr=subprocess.STDOUT).decode()
-        sample_rate = int(probResult)
-        is_narrowband = (sample_rate < 16000)
-    except Exception as e:
-        print(f'Failed to get number of audio streams from input file: {str(e)}')
         is_narrowband = True
-    finally:
-        # Delete our downloaded audio
-        pcacommon.remove_temp_file(ffmpegInputFilename)
 
     return channels_found, is_narrowband
 
@@ -160,20 +226,10 @@ def submitTranscribeJob(bucket, key):
     transcribe = boto3.client('transcribe', config=config)
     api_mode, channel_ident, base_model_name = evaluate_transcribe_mode(bucket, key)
 
-    # Generate job-name - delete if it already exists
-    job_name = pcacommon.generate_job_name(key)
-    current_job_status = check_existing_job_status(job_name, transcribe, api_mode)
+    # Generate our base job-name - the actual job name is decided once we know our job settings
+    base_job_name = pcacommon.generate_job_name(key)
     uri = 's3://' + bucket + '/' + key
 
-    # If there's a job already running then the input file may have been copied - quit
-    if (current_job_status == "IN_PROGRESS") or (current_job_status == "QUEUED"):
-        # Return empty job name
-        print("A Transcription job named \'{}\' is already in progress - cannot continue.".format(job_name))
-        return ""
-    elif current_job_status != "":
-        # But if an old one exists we can delete it
-        delete_existing_job(job_name, transcribe, api_mode)
-
     # Setup the structures common to both Standard and Call Analytics
     model_settings = None
     job_settings = {}
@@ -181,11 +237,9 @@ def submitTranscribeJob(bucket, key):
         'MediaFileUri': uri
     }
 
-    # Get a list of potential CLMs for use in this call
-    clm_list = transcribe.list_language_models(
-        StatusEquals="COMPLETED",
-        NameContains=cf.appConfig[cf.CONF_CLMNAME]
-    )["Models"]
+    # Get our catalog of Transcribe resources, which gives us a list of potential CLMs for use in this call
+    catalog = pcatranscribecatalog.get_catalog(transcribe)
+    clm_list = catalog.models
 
     # Add our vocab filter method, then check on our language requirements
     job_settings["VocabularyFilterMethod"] = cf.appConfig[cf.CONF_FILTER_MODE]
@@ -193,8 +247,8 @@ def submitTranscribeJob(bucket, key):
     if len(cf.appConfig[cf.CONF_TRANSCRIBE_LANG]) == 1:
         # Specific language, so dd a CV and Vocab Filter to our job_setting if either exists for this language
         lang_code = cf.appConfig[cf.CONF_TRANSCRIBE_LANG][0]
-        add_custom_vocabulary(job_settings, lang_code, transcribe)
-        add_vocabulary_filter(job_settings, lang_code, transcribe)
+        add_custom_vocabulary(job_settings, lang_code, catalog)
+        add_vocabulary_filter(job_settings, lang_code, catalog)
 
         # Check for a matching CLM - add it to our request params if so
         clm_name = add_custom_language_model(None, clm_list, lang_code, base_model_name)
@@ -216,8 +270,8 @@ def submitTranscribeJob(bucket, key):
         for language in cf.appConfig[cf.CONF_TRANSCRIBE_LANG]:
             # First add custom vocab and filtering
             lang_id_options = {}
-            add_custom_vocabulary(lang_id_options, language, transcribe)
-            add_vocabulary_filter(lang_id_options, language, transcribe)
+            add_custom_vocabulary(lang_id_options, language, catalog)
+            add_vocabulary_filter(lang_id_options, language, catalog)
             add_custom_language_model(lang_id_options, clm_list, language, base_model_name)
             language_id_settings[language] = lang_id_options
             language_options.append(language)
@@ -271,7 +325,7 @@ def submitTranscribeJob(bucket, key):
             }
 
         # Should have a clear run at doing the job now
-        kwargs = {'CallAnalyticsJobName': job_name,
+        kwargs = {'CallAnalyticsJobName': None,
                   'Media': media_settings,
                   'OutputLocation': f"s3://{cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]}/{cf.appConfig[cf.CONF_PREFIX_TRANSCRIBE_RESULTS]}/",
                   'DataAccessRoleArn': role_arn,
@@ -279,10 +333,8 @@ def submitTranscribeJob(bucket, key):
                   'ChannelDefinitions': [chan_def_agent, chan_def_cust]
         }
 
-        # Start the Transcribe job, removing any params that are "None"
-        response = transcribe.start_call_analytics_job(
-            **{k: v for k, v in kwargs.items() if v is not None}
-        )
+        job_name_param = 'CallAnalyticsJobName'
+        start_job_method = transcribe.start_call_analytics_job
     else:
         # STANDARD TRANSCRIBE JOB MODE - start with some simple flags
         job_settings['ShowSpeakerLabels'] = not channel_ident
@@ -299,7 +351,7 @@ def submitTranscribeJob(bucket, key):
         }
 
         # Should have a clear run at doing the job now
-        kwargs = {'TranscriptionJobName': job_name,
+        kwargs = {'TranscriptionJobName': None,
                   'IdentifyLanguage': lang_code is None,
                   'LanguageIdSettings': language_id_settings,
                   'LanguageCode': lang_code,
@@ -313,59 +365,110 @@ def submitTranscribeJob(bucket, key):
                   'ContentRedaction': content_redaction
         }
 
-        # Start the Transcribe job, removing any params that are "None"
-        response = transcribe.start_transcription_job(
-            **{k: v for k, v in kwargs.items() if v is not None}
-        )
+        job_name_param = 'TranscriptionJobName'
+        start_job_method = transcribe.start_transcription_job
+
+    # See if we've already got a job for this file, and if we can reuse it or need a new job name
+    source_etag = boto3.client('s3').head_object(Bucket=bucket, Key=key)["ETag"]
+    fingerprint = create_settings_fingerprint(api_mode, kwargs, source_etag)
+    previous_job = load_job_fingerprint(base_job_name)
+    job_name, reuse_job = select_job_name(base_job_name, api_mode, fingerprint, transcribe, previous_job)
+    if reuse_job:
+        return job_name, api_mode, base_job_name, True
+    elif job_name == "":
+        return "", api_mode, base_job_name, False
+
+    # Start the Transcribe job, removing any params that are "None"
+    kwargs[job_name_param] = job_name
+    response = start_job_method(
+        **{k: v for k, v in kwargs.items() if v is not None}
+    )
+    save_job_fingerprint(base_job_name, job_name, api_mode, fingerprint)
+    pcajobcounter.update_in_flight_count(api_mode, 1)
+
+    # Our last job for this file is now superseded, so if it had a unique suffix then delete it, otherwise
+    # they would pile up - the job under the base name is left, as it is replaced rather than added to
+    if (previous_job is not None) and (previous_job["JobName"] not in [base_job_name, job_name]):
+        delete_existing_job(previous_job["JobName"], transcribe, previous_job["ApiMode"])
 
     # Return our job name and api mode, as we need to track them
-    return job_name, api_mode
+    return job_name, api_mode, base_job_name, False
 
 
-def add_vocabulary_filter(tag_structure, lang_code, transcribe_client):
+def select_job_name(base_job_name, api_mode, fingerprint, transcribe, previous_job):
+    """
+    Decides which Transcribe job to use for this file.  If the last job that we submitted for it has completed
+    and was submitted with identical settings then it is reused, and if any job for it is still running then
+    we cannot continue.  Otherwise we need a new job - if the base job name is already taken then a unique
+    suffix is added to it, as deleting the old job and waiting for Transcribe to release the name is slow
+
+    @param base_job_name: Job name generated from the audio file name
+    @param api_mode: Transcribe API mode being used
+    @param fingerprint: Settings fingerprint of the job that we want to run
+    @param transcribe: Boto3 client for the Transcribe service
+    @param previous_job: Details of the last job that we submitted for this file, or None if there isn't one
+    @return: Job name to use, empty string means that we cannot continue
+    @return: Flag indicating if that name belongs to an existing completed job that should be reused
+    """
+    # Check the last job that we submitted for this file, which may have had a unique suffix
+    if previous_job is not None:
+        previous_status = check_existing_job_status(previous_job["JobName"], transcribe, previous_job["ApiMode"])
+        if (previous_status == "IN_PROGRESS") or (previous_status == "QUEUED"):
+            print(f"A Transcription job named '{previous_job['JobName']}' is already in progress - cannot continue.")
+            return "", False
+        elif (previous_status == "COMPLETED") and is_job_reuse_enabled() and \
+                (previous_job["ApiMode"] == api_mode) and (previous_job["Fingerprint"] == fingerprint):
+            print(f"Reusing completed Transcription job '{previous_job['JobName']}' as its settings are unchanged.")
+            return previous_job["JobName"], True
+
+    # If there's a job already running then the input file may have been copied - quit
+    current_job_status = check_existing_job_status(base_job_name, transcribe, api_mode)
+    if (current_job_status == "IN_PROGRESS") or (current_job_status == "QUEUED"):
+        print(f"A Transcription job named '{base_job_name}' is already in progress - cannot continue.")
+        return "", False
+    elif current_job_status != "":
+        # But if an old one exists then we need a different name for our new job
+        job_name = generate_unique_job_name(base_job_name)
+        print(f"A Transcription job named '{base_job_name}' already exists - submitting job as '{job_name}'.")
+        return job_name, False
+
+    return base_job_name, False
+
+
+def add_vocabulary_filter(tag_structure, lang_code, catalog):
     """
     Checks to see if our defined vocabulary base name has an instance defined within Transcribe
     for the given language code.  If it does then it is added as a tag to the provided structure
 
     :param tag_structure: Dictionary to hold the filter field tag
     :param lang_code: Language that we're searching for a filter for
-    :param transcribe_client: Boto3 client
+    :param catalog: Catalog of our Transcribe resources
     """
 
-    # Ensure we at least have something to log if there's an exception
-    vocab_filter_name = ""
-
-    try:
-        # Look for a vocabulary filter variant defined for this language code
-        vocab_filter_name = cf.appConfig[cf.CONF_FILTER_NAME] + '-' + lang_code.lower()
-        transcribe_client.get_vocabulary_filter(VocabularyFilterName=vocab_filter_name)
+    # Look for a vocabulary filter variant defined for this language code
+    vocab_filter_name = cf.appConfig[cf.CONF_FILTER_NAME] + '-' + lang_code.lower()
+    if catalog.has_vocabulary_filter(vocab_filter_name):
         tag_structure["VocabularyFilterName"] = vocab_filter_name
-    except:
+    else:
         # Doesn't exist for this language code - quietly exit
         print(f"No vocabulary filter defined named {vocab_filter_name}")
 
 
-def add_custom_vocabulary(tag_structure, lang_code, transcribe_client):
+def add_custom_vocabulary(tag_structure, lang_code, catalog):
     """
     Checks to see if our defined vocabulary base name has an instance defined within Transcribe
     for the given language code.  If it does then it is added as a tag to the provided structure
 
     :param tag_structure: Dictionary to hold a "VocabularyName" field if ours exist
     :param lang_code: Language that we're searching for a vocabulary for
-    :param transcribe_client: Boto3 client
+    :param catalog: Catalog of our Transcribe resources, which only holds vocabularies that are ready for use
     """
 
-    # Ensure we at least have something to log if there's an exception
-    vocab_name = ""
-
-    try:
-        # Look for a custom vocabulary variant defined for this language code
-        vocab_name = cf.appConfig[cf.CONF_VOCABNAME] + '-' + lang_code.lower()
-        our_vocab = transcribe_client.get_vocabulary(VocabularyName=vocab_name)
-        if our_vocab["VocabularyState"] == "READY":
-            # It exists, but we can only use it if it is ready for use
-            tag_structure["VocabularyName"] = vocab_name
-    except:
+    # Look for a custom vocabulary variant defined for this language code
+    vocab_name = cf.appConfig[cf.CONF_VOCABNAME] + '-' + lang_code.lower()
+    if catalog.has_vocabulary(vocab_name):
+        tag_structure["VocabularyName"] = vocab_name
+    else:
         # Doesn't exist for this language code - quietly exit
         print(f"No custom vocabulary defined named {vocab_name}")
 
@@ -437,9 +540,15 @@ def lambda_handler(event, context):
     key = sfData["key"]
 
     try:
-        job_name, api_mode = submitTranscribeJob(event["bucket"], key)
+        job_name, api_mode, base_job_name, reuse_job = submitTranscribeJob(event["bucket"], key)
         sfData["jobName"] = job_name
+        sfData["jobBaseName"] = base_job_name
+        sfData["jobReused"] = reuse_job
         sfData["apiMode"] = api_mode
+
+        # A reused job has already completed, so the workflow can move straight on to processing it
+        if reuse_job:
+            sfData["transcribeStatus"] = "COMPLETED"
         return sfData
     except Exception as e:
         print(e)
@@ -318,9 +318,10 @@ def lambda_handler(event, context):
         pca_results.analytics.summary['Summary'] = summary
         print("Summary: " + summary)
     
-    # Write out back to interim file
-    pca_results.write_results_to_s3(bucket=cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
-                                    object_key=event["interimResultsFile"])
+    # We're the last step to change the results, so write them straight to the final location
+    event["parsedResultsFile"] = pca_results.write_final_results_to_s3(bucket=cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                                                       interim_key=event["interimResultsFile"],
+                                                                       keep_interim="debug" in event)
 
     return event
 
@@ -8,6 +8,8 @@ SPDX-License-Identifier: Apache-2.0
 """
 import boto3
 import pcaconfiguration as cf
+import pcabulkscheduler
+import pcacontentdedup
 
 def lambda_handler(event, context):
     """
@@ -34,6 +36,13 @@ def lambda_handler(event, context):
         print(e)
         raise
 
+    # If this file came from the bulk workflow then it's no longer in flight
+    pcabulkscheduler.finish_in_flight(origBucket, origFileKey)
+
+    # If this file claimed its content fingerprint then release it, as any copy of it should now be processed
+    if "contentFingerprint" in event:
+        pcacontentdedup.release_content_fingerprint(event["contentFingerprint"], origBucket, origFileKey)
+
     # Return our input data as the final result
     return event
 
@@ -1,7 +1,12 @@
 """
 This python function is part of the main processing workflow.  It is called by Event Bridge once a Transcribe job
-has completed.  It will look up that job record in DynamoDB, including the Step Functions task token associated with
-that job, extract the job-status from the relevant Transcribe API and then resume the Step Function execution
+has completed.  It will take that job record out of DynamoDB, including the Step Functions task token associated with
+that job, and then resume the Step Function execution with the job-status from the event.
+
+The record is read and deleted in a single request, so no other invocation can resume the same execution, and the
+Transcribe API is only called if the event doesn't tell us the job's status or the reason that it failed.  If the
+record isn't there yet, which can happen if the job finishes before its task token was written, we try again a few
+times on a short backoff - events for Transcribe jobs started outside of PCA will never have a record
 
 Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
@@ -11,85 +16,128 @@ import boto3
 import time
 import os
 import pcaconfiguration as cf
+import pcajobcounter
 
 # Total number of retry attempts to make
 RETRY_LIMIT = 2
 
+# Delays between attempts to find a tracking record that hasn't been written yet
+TRACKING_RETRY_DELAYS = [0.25, 0.5, 1.0, 2.0]
+
+# Clients are created once per Lambda container, as each one takes time to create
+ddbClient = boto3.client("dynamodb")
+sfnClient = boto3.client("stepfunctions")
+transcribeClient = boto3.client("transcribe")
+
+# Mapping of event type to Transcribe API type, which defines the tags in the event detail
+# and the Transcribe call method and tags to use if we have to look up the job's status
+TRANSCRIBE_API_MAP = {
+    "Transcribe Job State Change": {
+        "mode": cf.API_STANDARD,
+        "eb_job_name": "TranscriptionJobName",
+        "eb_status": "TranscriptionJobStatus",
+        "get_job_method": transcribeClient.get_transcription_job,
+        "api_key": "TranscriptionJobName",
+        "job_tag": "TranscriptionJob",
+        "status_tag": "TranscriptionJobStatus"
+    },
+    "Call Analytics Job State Change": {
+        "mode": cf.API_ANALYTICS,
+        "eb_job_name": "JobName",
+        "eb_status": "JobStatus",
+        "get_job_method": transcribeClient.get_call_analytics_job,
+        "api_key": "CallAnalyticsJobName",
+        "job_tag": "CallAnalyticsJob",
+        "status_tag": "CallAnalyticsJobStatus"
+    }
+}
+
+
+def take_tracking_record(job_name, api_mode, table_name):
+    """
+    Reads and deletes the tracking record for a job in a single request, retrying on a short backoff if it
+    isn't there yet
+
+    :param job_name: Name of the Transcribe job
+    :param api_mode: Transcribe API mode of the job
+    :param table_name: Name of our tracking table
+    :return: The record's attributes, or None if there isn't one
+    """
+    for delay in [0] + TRACKING_RETRY_DELAYS:
+        time.sleep(delay)
+        response = ddbClient.delete_item(Key={'PKJobId': {'S': job_name}, 'SKApiMode': {'S': api_mode}},
+                                         TableName=table_name, ReturnValues="ALL_OLD")
+        if "Attributes" in response:
+            return response["Attributes"]
+
+    return None
+
+
+def get_job_status(event_detail, job_name, api_map):
+    """
+    Gets a job's status from its event, and for a failed job its failure reason, only calling Transcribe
+    if the event doesn't have them
+
+    :param event_detail: Detail section of the EventBridge event
+    :param job_name: Name of the Transcribe job
+    :param api_map: Transcribe API mapping for this event type
+    :return: Job status
+    :return: Failure reason, which is only set for a failed job
+    """
+    job_status = event_detail.get(api_map["eb_status"])
+    failure_reason = event_detail.get("FailureReason", "")
+    if (job_status is None) or ((job_status == "FAILED") and (failure_reason == "")):
+        kwargs = {api_map["api_key"]: job_name}
+        response = api_map["get_job_method"](**kwargs)[api_map["job_tag"]]
+        job_status = response[api_map["status_tag"]]
+        failure_reason = response.get("FailureReason", "")
+
+    return job_status, failure_reason
+
 
 def lambda_handler(event, context):
     # Our tracking table name is an environment variable
     DDB_TRACKING_TABLE = os.environ["TableName"]
 
-    # Mapping of event type to Transcribe API type, which defines the
-    # Transcribe call method and tags to use when looking up the jobs status
-    transcribe = boto3.client("transcribe")
-    TRANSCRIBE_API_MAP = {
-        "Transcribe Job State Change": {
-            "mode": cf.API_STANDARD,
-            "eb_job_name": "TranscriptionJobName",
-            "get_job_method": transcribe.get_transcription_job,
-            "api_key": "TranscriptionJobName",
-            "job_tag": "TranscriptionJob",
-            "status_tag": "TranscriptionJobStatus"
-        },
-        "Call Analytics Job State Change": {
-            "mode": cf.API_ANALYTICS,
-            "eb_job_name": "JobName",
-            "get_job_method": transcribe.get_call_analytics_job,
-            "api_key": "CallAnalyticsJobName",
-            "job_tag": "CallAnalyticsJob",
-            "status_tag": "CallAnalyticsJobStatus"
-        }
-    }
-
     # Work out what Transcribe API mode this is - if it's
     # an event type that we don't support then quietly exit
     if TRANSCRIBE_API_MAP.get(event["detail-type"], False):
         api_map = TRANSCRIBE_API_MAP[event["detail-type"]]
         api_mode = api_map["mode"]
 
-        # Lookup our job metadata and results, then find out DDB matching entry
+        # Take our tracking entry between Transcribe job and its Step Function - there's no
+        # way we'll be processing this again - and then find the job status
         try:
-            # Lookup the job status
             job_name = event["detail"][api_map["eb_job_name"]]
-            kwargs = {api_map["api_key"]: job_name}
-            response = api_map["get_job_method"](**{k: v for k, v in kwargs.items()})[api_map["job_tag"]]
-            job_status = response[api_map["status_tag"]]
-
-            # Read tracking entry between Transcribe job and its Step Function
-            ddbClient = boto3.client("dynamodb")
-            tracking = ddbClient.get_item(Key={'PKJobId': {'S': job_name}, 'SKApiMode': {'S': api_mode}},
-                                          TableName=DDB_TRACKING_TABLE)
-
-            # It's unlikely, but if we didn't get a value due to some race condition
-            # meaning that the job finishes before the token was written then wait
-            # for 5 seconds and try again.  Just once.  This may never happen
-            if "Item" not in tracking:
-                # Just sleep for a few seconds and try again
-                time.sleep(5)
-                tracking = ddbClient.get_item(Key={'PKJobId': {'S': job_name}, 'SKApiMode': {'S': api_mode}},
-                                              TableName=DDB_TRACKING_TABLE)
-        except:
-            # If the job status lookup failed (unlikely) or DDB threw an exception,
-            # then just say we didn't find a matching record and carry on
-            tracking = {}
+            tracking = take_tracking_record(job_name, api_mode, DDB_TRACKING_TABLE)
+        except Exception as e:
+            # If DDB threw an exception then just say we didn't find a matching record and carry on
+            print(f"Unable to read tracking record for job: {str(e)}")
+            tracking = None
+
+        if tracking is not None:
+            try:
+                job_status, failure_reason = get_job_status(event["detail"], job_name, api_map)
+            except Exception:
+                # The job status lookup failed (unlikely), so put our record back for when
+                # Lambda retries this event, as otherwise our workflow would never resume
+                ddbClient.put_item(Item=tracking, TableName=DDB_TRACKING_TABLE)
+                raise
 
         # Did we have a result?
-        if "Item" in tracking:
-            # Delete entry in DDB table - there's no way we'll be processing this again
-            ddbClient.delete_item(Key={'PKJobId': {'S': job_name}, 'SKApiMode': {'S': api_mode}},
-                                  TableName=DDB_TRACKING_TABLE)
+        if tracking is not None:
+            # This job is no longer in-flight, which frees up space in the Transcribe queue
+            pcajobcounter.update_in_flight_count(api_mode, -1)
 
             # Extract the Step Functions task and previous event status
-            taskToken = tracking["Item"]["taskToken"]['S']
-            eventStatus = json.loads(tracking["Item"]["taskState"]['S'])
+            taskToken = tracking["taskToken"]['S']
+            eventStatus = json.loads(tracking["taskState"]['S'])
 
             # If the job has FAILED then we need to check if it's a service failure,
             # as this can happen, then we want to re-try the job another time
             finalResponse = job_status
             if job_status == "FAILED":
-                errorMesg = response["FailureReason"]
-                if errorMesg.startswith("Internal"):
+                if failure_reason.startswith("Internal"):
                     # Internal failure - we want to retry a few times, but only once
                     retryCount = eventStatus.pop("retryCount", 0)
 
@@ -100,7 +148,6 @@ def lambda_handler(event, context):
 
             # All complete - continue our workflow with this status/retry count
             eventStatus["transcribeStatus"] = finalResponse
-            sfnClient = boto3.client("stepfunctions")
             sfnClient.send_task_success(taskToken=taskToken,
                                         output=json.dumps(eventStatus))
 
@@ -0,0 +1,357 @@
+"""
+This python function is part of the main processing workflow.  It determines the basic stream properties of an audio
+file held in S3 - format, number of channels and sample rate - by reading just the start of the file with a ranged
+GET and parsing the container headers directly.  WAV, MP3, FLAC, OGG (Vorbis and Opus) and MP4/M4A are understood;
+anything else falls back to a single FFPROBE call that is fed the file as a stream.
+
+Format names match those reported by FFPROBE, as other parts of the workflow compare against them.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import struct
+import subprocess
+import boto3
+
+# Number of bytes read from the start of the file, which is enough for all but unusually large headers
+PROBE_HEADER_BYTES = 64 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# MP4 atom walking limits, as we may need to do additional ranged reads to find the [moov] atom
+MP4_MAX_TOP_LEVEL_ATOMS = 32
+MP4_MAX_MOOV_BYTES = 16 * 1024 * 1024
+MP4_CONTAINER_ATOMS = [b"moov", b"trak", b"mdia", b"minf", b"stbl"]
+
+# MP3 frame header lookup tables - bitrates are in kbps, indexed by MPEG 1 or not, then by layer
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000],   # MPEG 1
+                    2: [22050, 24000, 16000],   # MPEG 2
+                    0: [11025, 12000, 8000]}    # MPEG 2.5
+MP3_BITRATES = {True: {3: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],    # Layer I
+                       2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],      # Layer II
+                       1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]},      # Layer III
+                False: {3: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+                        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+                        1: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}}
+
+# Formats as reported by FFPROBE
+FORMAT_WAV = "wav"
+FORMAT_MP3 = "mp3"
+FORMAT_FLAC = "flac"
+FORMAT_OGG = "ogg"
+FORMAT_MP4 = "mov,mp4,m4a,3gp,3g2,mj2"
+
+
+class AudioInfo:
+    """ Class to hold the basic stream properties of an audio file """
+    def __init__(self, media_format, channels, sample_rate):
+        self.media_format = media_format
+        self.channels = channels
+        self.sample_rate = sample_rate
+
+    def __repr__(self):
+        return f"AudioInfo(format={self.media_format}, channels={self.channels}, sample_rate={self.sample_rate})"
+
+
+class S3RangeReader:
+    """ Helper class that reads byte ranges of an S3 object, caching the first block of the file """
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.header = b""
+        self.header = self.read(0, PROBE_HEADER_BYTES)
+
+    def read(self, offset, length):
+        """
+        Reads up to length bytes from the given offset, returning fewer if the file is shorter than that
+
+        :param offset: Start offset in the file
+        :param length: Number of bytes to read
+        :return: Bytes read
+        """
+        if offset + length <= len(self.header):
+            return self.header[offset:offset + length]
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key,
+                                                  Range=f"bytes={offset}-{offset + length - 1}")
+            return response["Body"].read()
+        except self.s3_client.exceptions.ClientError as e:
+            # Reading past the end of the file gives a 416 error
+            if e.response["Error"]["Code"] == "InvalidRange":
+                return b""
+            raise
+
+
+def parse_wav_header(reader):
+    """
+    Parses a RIFF/RF64 WAVE header, walking the chunks until the [fmt ] chunk is found
+
+    :param reader: S3RangeReader for the audio file
+    :return: AudioInfo, or None if this is not a WAV file
+    """
+    data = reader.header
+    if (data[0:4] not in [b"RIFF", b"RF64"]) or (data[8:12] != b"WAVE"):
+        return None
+
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        chunk_size = struct.unpack_from("<I", data, offset + 4)[0]
+        if chunk_id == b"fmt ":
+            if offset + 16 > len(data):
+                break
+            channels, sample_rate = struct.unpack_from("<HI", data, offset + 10)
+            return AudioInfo(FORMAT_WAV, channels, sample_rate)
+
+        # Chunks are word-aligned
+        offset += 8 + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def decode_mp3_frame_header(header):
+    """
+    Decodes an MPEG audio frame header, rejecting anything that isn't a fully valid one
+
+    :param header: The 4 bytes of the frame header
+    :return: Tuple of (version, layer, channels, sample rate, frame length), or None if this is not a frame header
+    """
+    if (len(header) < 4) or (header[0] != 0xFF) or ((header[1] & 0xE0) != 0xE0):
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    channel_mode = (header[3] >> 6) & 0x03
+    if (version not in MP3_SAMPLE_RATES) or (layer == 0) or (bitrate_index in [0, 15]) or (rate_index == 3):
+        return None
+
+    # Frame length in bytes depends on the layer, and Layer III frames are half the size after MPEG 1
+    bitrate = MP3_BITRATES[version == 3][layer][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    if layer == 3:
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    elif (layer == 1) and (version != 3):
+        frame_length = 72 * bitrate // sample_rate + padding
+    else:
+        frame_length = 144 * bitrate // sample_rate + padding
+    return version, layer, 1 if channel_mode == 3 else 2, sample_rate, frame_length
+
+
+def parse_mp3_header(reader):
+    """
+    Parses the first MPEG audio frame header, which must be at the start of the file or straight after any ID3v2
+    tag.  There is no magic number for MP3 and frame syncs are common in other data, so this is the last parser to
+    be tried, and it also insists on a matching second frame header where the first frame says that it ends
+
+    :param reader: S3RangeReader for the audio file
+    :return: AudioInfo, or None if this is not an MP3 file
+    """
+    data = reader.header
+    offset = 0
+    if data[0:3] == b"ID3" and len(data) >= 10:
+        # ID3v2 tag size is a 28-bit syncsafe integer, and there may also be a footer
+        tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        offset = 10 + tag_size + (10 if data[5] & 0x10 else 0)
+
+    first_frame = decode_mp3_frame_header(reader.read(offset, 4))
+    if first_frame is None:
+        return None
+    version, layer, channels, sample_rate, frame_length = first_frame
+    second_frame = decode_mp3_frame_header(reader.read(offset + frame_length, 4))
+    if (second_frame is None) or (second_frame[0:2] != (version, layer)) or (second_frame[3] != sample_rate):
+        return None
+
+    return AudioInfo(FORMAT_MP3, channels, sample_rate)
+
+
+def parse_flac_header(reader):
+    """
+    Parses the mandatory STREAMINFO metadata block at the start of a FLAC file
+
+    :param reader: S3RangeReader for the audio file
+    :return: AudioInfo, or None if this is not a FLAC file
+    """
+    data = reader.header
+    if (data[0:4] != b"fLaC") or (len(data) < 26) or ((data[4] & 0x7F) != 0):
+        return None
+
+    # STREAMINFO: 20 bits of sample rate then 3 bits of (channels - 1), after 10 bytes of block/frame sizes
+    packed = int.from_bytes(data[18:21], "big")
+    return AudioInfo(FORMAT_FLAC, ((packed >> 1) & 0x07) + 1, packed >> 4)
+
+
+def parse_ogg_header(reader):
+    """
+    Parses the identification header in the first page of an OGG file, which may hold Vorbis or Opus audio
+
+    :param reader: S3RangeReader for the audio file
+    :return: AudioInfo, or None if this is not an OGG file that we understand
+    """
+    data = reader.header
+    if (data[0:4] != b"OggS") or (len(data) < 27):
+        return None
+
+    # First packet starts after the page header and its segment table
+    packet = data[27 + data[26]:]
+    if packet[0:7] == b"\x01vorbis" and len(packet) >= 16:
+        channels, sample_rate = struct.unpack_from("<BI", packet, 11)
+        return AudioInfo(FORMAT_OGG, channels, sample_rate)
+    elif packet[0:8] == b"OpusHead" and len(packet) >= 16:
+        # Opus always decodes at 48kHz, but the header records the rate of the original audio
+        channels = packet[9]
+        sample_rate = struct.unpack_from("<I", packet, 12)[0] or 48000
+        return AudioInfo(FORMAT_OGG, channels, sample_rate)
+
+    return None
+
+
+def find_mp4_audio_entry(data, start, end, is_audio_track=False):
+    """
+    Recursively walks MP4 atoms looking for the sample description of the first audio track
+
+    :param data: Bytes holding the atoms
+    :param start: Offset of the first atom to examine
+    :param end: Offset of the end of the atoms to examine
+    :param is_audio_track: Flag indicating that an enclosing atom has declared this to be an audio track
+    :return: Tuple of (channels, sample rate), or None if there is no audio track in these atoms
+    """
+    offset = start
+    while offset + 8 <= end:
+        atom_size, atom_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = end - offset
+        if atom_size < header_size:
+            return None
+        atom_end = min(offset + atom_size, end)
+
+        if atom_type == b"hdlr":
+            # Handler type follows version/flags and pre-defined fields
+            is_audio_track = data[offset + header_size + 8:offset + header_size + 12] == b"soun"
+        elif atom_type == b"stsd" and is_audio_track:
+            # Skip version/flags and entry count, then the first sample entry's size, type and reserved fields
+            entry = offset + header_size + 8
+            channels = struct.unpack_from(">H", data, entry + 24)[0]
+            sample_rate = struct.unpack_from(">I", data, entry + 32)[0] >> 16
+            return channels, sample_rate
+        elif atom_type in MP4_CONTAINER_ATOMS:
+            # The audio handler is declared inside [mdia], so a new track starts off with no handler
+            result = find_mp4_audio_entry(data, offset + header_size, atom_end,
+                                          is_audio_track and (atom_type != b"trak"))
+            if result is not None:
+                return result
+
+        offset += atom_size
+
+    return None
+
+
+def parse_mp4_header(reader):
+    """
+    Parses an MP4/M4A file by walking the top-level atoms to find the [moov] atom, which may be at the end
+    of the file, and then reading just that atom to find the audio track's sample description
+
+    :param reader: S3RangeReader for the audio file
+    :return: AudioInfo, or None if this is not an MP4 file
+    """
+    if reader.header[4:8] != b"ftyp":
+        return None
+
+    # Walk the top-level atoms, reading just their headers, until we hit [moov]
+    offset = 0
+    for _ in range(MP4_MAX_TOP_LEVEL_ATOMS):
+        atom_header = reader.read(offset, 16)
+        if len(atom_header) < 8:
+            return None
+        atom_size, atom_type = struct.unpack_from(">I4s", atom_header)
+        if atom_size == 1:
+            atom_size = struct.unpack_from(">Q", atom_header, 8)[0]
+        if atom_size < 8:
+            return None
+
+        if atom_type == b"moov":
+            if atom_size > MP4_MAX_MOOV_BYTES:
+                return None
+            moov = reader.read(offset, atom_size)
+            result = find_mp4_audio_entry(moov, 0, len(moov))
+            return AudioInfo(FORMAT_MP4, result[0], result[1]) if result else None
+
+        offset += atom_size
+
+    return None
+
+
+def probe_with_ffprobe(s3_client, bucket, key):
+    """
+    Falls back to FFPROBE to get all of the stream properties in a single call.  The file is streamed into
+    FFPROBE's stdin, and we stop sending it data as soon as FFPROBE has seen enough to make its decision
+
+    :param s3_client: Boto3 client for S3
+    :param bucket: Bucket holding the audio file
+    :param key: Key of the audio file
+    :return: AudioInfo
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries',
+               'stream=channels,sample_rate:format=format_name', '-of', 'json', '-i', 'pipe:0']
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        try:
+            for chunk in body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE):
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # FFPROBE has all that it needs
+            pass
+        finally:
+            body.close()
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        probe_result = json.loads(process.stdout.read().decode())
+        process.wait()
+    finally:
+        # Never leave FFPROBE running if streaming the file to it failed
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+    stream = probe_result["streams"][0]
+    return AudioInfo(probe_result["format"]["format_name"], int(stream["channels"]), int(stream["sample_rate"]))
+
+
+def probe_s3_audio(bucket, key, s3_client=None):
+    """
+    Determines the format, channel count and sample rate of an audio file in S3 by parsing the headers
+    at the start of the file, only falling back to FFPROBE if none of our header parsers recognise it.
+    Note that this could exception, so the caller should be prepared for failure
+
+    :param bucket: Bucket holding the audio file
+    :param key: Key of the audio file
+    :param s3_client: Pre-initialised boto3 client for S3, but a new one will be created if required
+    :return: AudioInfo for the file
+    """
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+
+    reader = S3RangeReader(s3_client, bucket, key)
+    for parser in [parse_wav_header, parse_flac_header, parse_ogg_header, parse_mp4_header, parse_mp3_header]:
+        try:
+            audio_info = parser(reader)
+        except Exception as e:
+            print(f"Header parsing by {parser.__name__} failed for s3://{bucket}/{key}: {str(e)}")
+            audio_info = None
+        if audio_info is not None:
+            print(f"Probed audio headers of s3://{bucket}/{key}: {audio_info}")
+            return audio_info
+
+    print(f"Unable to parse audio headers of s3://{bucket}/{key}, falling back to FFPROBE")
+    return probe_with_ffprobe(s3_client, bucket, key)
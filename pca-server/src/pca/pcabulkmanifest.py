@@ -0,0 +1,386 @@
+"""
+This python module is part of the bulk files workflow.  Rather than listing the bulk upload bucket, the workflow can
+be driven by a manifest of the files to be ingested, which is either an S3 Inventory report (its manifest.json file,
+with CSV or Parquet data files) or a plain CSV file of bucket,key rows.
+
+The manifest is read in chunks, and the position of the last file that has been dealt with is held in the workflow
+data and persisted to the DynamoDB tracking table, so an interrupted run can be resumed by starting the workflow
+again with the same manifest.  No chunk is read by going back to the start of its data file:
+
+- positions are byte offsets for plain CSV files, so a chunk can be read with a ranged request
+- gzipped S3 Inventory CSV files can't be read from the middle, so each one is decompressed just once into a staged
+  copy in S3, which is then read like a plain CSV file and removed once we have finished with it
+- positions are row counts for Parquet files, which the file's footer maps to a row group and a row within it, and
+  only the row groups that we need are fetched, with ranged requests
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import urllib.parse
+import boto3
+from botocore.exceptions import ClientError
+
+# Tracking table used to persist our progress through a manifest
+MANIFEST_TABLE_NAME = os.getenv("TableName", "")
+MANIFEST_TABLE_SK = "bulk-manifest-progress"
+MAX_FAILED_ENTRIES = 1000
+
+# Manifest data file formats that we can read
+FORMAT_PLAIN_CSV = "PLAIN_CSV"
+FORMAT_INVENTORY_CSV = "CSV"
+FORMAT_INVENTORY_PARQUET = "Parquet"
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_s3_uri(s3_uri):
+    """
+    Splits an S3 URI into its bucket and key
+
+    :param s3_uri: URI in the form s3://bucket/key
+    :return: Bucket and key
+    """
+    parsed = urllib.parse.urlparse(s3_uri)
+    return parsed.netloc, parsed.path[1:]
+
+
+def create_manifest_state(s3_client, manifest_uri, in_place=False, staging_bucket=None, staging_prefix=""):
+    """
+    Reads a manifest's location and format and creates the workflow data that tracks our progress through it.
+    An S3 Inventory manifest.json lists the data files of the report, whereas a plain CSV file is its own data
+
+    :param s3_client: Boto3 client for S3
+    :param manifest_uri: S3 URI of the manifest
+    :param in_place: Flag indicating that files should be processed where they are rather than copied
+    :param staging_bucket: Bucket for the decompressed copies of gzipped S3 Inventory CSV files
+    :param staging_prefix: Key prefix for those copies
+    :return: Manifest state, positioned at its start
+    """
+    bucket, key = parse_s3_uri(manifest_uri)
+    if key.endswith(".json"):
+        inventory = json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+        data_format = inventory["fileFormat"]
+        if data_format not in [FORMAT_INVENTORY_CSV, FORMAT_INVENTORY_PARQUET]:
+            raise Exception(f"S3 Inventory manifest {manifest_uri} has unsupported file format '{data_format}'")
+        data_bucket = inventory["destinationBucket"].split(":::")[-1]
+        schema = [field.strip() for field in inventory["fileSchema"].split(",")]
+        files = [{"bucket": data_bucket, "key": data_file["key"]} for data_file in inventory["files"]]
+    else:
+        data_format = FORMAT_PLAIN_CSV
+        schema = None
+        files = [{"bucket": bucket, "key": key}]
+
+    manifest = {"uri": manifest_uri, "format": data_format, "schema": schema, "files": files,
+                "fileIndex": 0, "offset": 0, "inPlace": in_place, "done": False}
+    if staging_bucket is not None:
+        manifest_id = hashlib.sha1(manifest_uri.encode("utf-8")).hexdigest()
+        manifest["staging"] = {"bucket": staging_bucket, "prefix": f"{staging_prefix}{manifest_id}/"}
+    return manifest
+
+
+def iterate_lines(body, start_offset=0):
+    """
+    Reads a stream of lines, tracking the byte offset that follows each one
+
+    :param body: Readable stream of bytes
+    :param start_offset: Byte offset in the file that the stream starts at
+    :return: Generator of (line, offset after the line) tuples
+    """
+    offset = start_offset
+    remainder = b""
+    while True:
+        chunk = body.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            yield line, offset
+    if remainder:
+        yield remainder, offset + len(remainder)
+
+
+def read_csv_rows(s3_client, data_file, offset):
+    """
+    Reads the rows of an uncompressed CSV file, starting at a byte offset
+
+    :return: Generator of (row, offset after the row) tuples
+    """
+    kwargs = {"Bucket": data_file["bucket"], "Key": data_file["key"]}
+    if offset > 0:
+        kwargs["Range"] = f"bytes={offset}-"
+    try:
+        body = s3_client.get_object(**kwargs)["Body"]
+    except ClientError as e:
+        # We were already at the end of the file
+        if e.response["Error"]["Code"] == "InvalidRange":
+            return
+        raise
+    try:
+        for line, next_offset in iterate_lines(body, offset):
+            yield next(csv.reader([line.decode("utf-8").strip()]), []), next_offset
+    finally:
+        body.close()
+
+
+def read_plain_csv_rows(s3_client, data_file, offset):
+    """
+    Reads bucket,key rows from a plain CSV file, starting at a byte offset.  A header row is ignored
+
+    :return: Generator of (bucket, key, offset after the row) tuples
+    """
+    for row, next_offset in read_csv_rows(s3_client, data_file, offset):
+        if (len(row) >= 2) and not ((row[0].lower() == "bucket") and (row[1].lower() == "key")):
+            yield row[0], row[1], next_offset
+
+
+def get_staged_file(manifest, file_index):
+    """
+    Returns the location of the decompressed copy of one of a manifest's gzipped data files
+
+    :param manifest: Manifest state
+    :param file_index: Index of the data file in the manifest
+    :return: Staged data file
+    """
+    if "staging" not in manifest:
+        raise Exception(f"Manifest {manifest['uri']} has gzipped data files, but no staging location for them")
+    return {"bucket": manifest["staging"]["bucket"], "key": f"{manifest['staging']['prefix']}{file_index}.csv"}
+
+
+def stage_inventory_csv(s3_client, data_file, staged_file):
+    """
+    Makes sure that a gzipped S3 Inventory CSV file has a decompressed copy that can be read from any offset.  The
+    copy is streamed straight from one object to the other, and a copy left by an earlier run is re-used, as the
+    offsets within it are the same
+
+    :param s3_client: Boto3 client for S3
+    :param data_file: Gzipped data file
+    :param staged_file: Location of its decompressed copy
+    """
+    try:
+        s3_client.head_object(Bucket=staged_file["bucket"], Key=staged_file["key"])
+        return
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ["404", "NoSuchKey", "NotFound"]:
+            raise
+
+    body = s3_client.get_object(Bucket=data_file["bucket"], Key=data_file["key"])["Body"]
+    try:
+        with gzip.GzipFile(fileobj=body) as data:
+            s3_client.upload_fileobj(data, staged_file["bucket"], staged_file["key"])
+    finally:
+        body.close()
+
+
+def remove_staged_file(s3_client, manifest, file_index):
+    """
+    Removes the decompressed copy of a data file that we have finished with, if it has one.  Failures are only
+    logged, as the copy is just left behind
+
+    :param s3_client: Boto3 client for S3
+    :param manifest: Manifest state
+    :param file_index: Index of the data file in the manifest
+    """
+    if (manifest["format"] == FORMAT_INVENTORY_CSV) and ("staging" in manifest):
+        staged_file = get_staged_file(manifest, file_index)
+        try:
+            s3_client.delete_object(Bucket=staged_file["bucket"], Key=staged_file["key"])
+        except Exception as e:
+            print(f"Unable to remove staged manifest data file {staged_file['key']}: {str(e)}")
+
+
+def read_inventory_csv_rows(s3_client, manifest, file_index, offset):
+    """
+    Reads rows from a gzipped S3 Inventory CSV file, via its decompressed copy, starting at a byte offset in that
+    copy.  Keys in these files are URL-encoded
+
+    :return: Generator of (bucket, key, offset after the row) tuples
+    """
+    bucket_column = manifest["schema"].index("Bucket")
+    key_column = manifest["schema"].index("Key")
+    staged_file = get_staged_file(manifest, file_index)
+    stage_inventory_csv(s3_client, manifest["files"][file_index], staged_file)
+    for row, next_offset in read_csv_rows(s3_client, staged_file, offset):
+        if len(row) > max(bucket_column, key_column):
+            yield row[bucket_column], urllib.parse.unquote_plus(row[key_column]), next_offset
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    Class to give seekable, read-only file access to an S3 object, where each read is a ranged request, so that
+    a Parquet reader only fetches the parts of the file that it needs
+    """
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key,
+                                             Range=f"bytes={self.position}-{self.position + length - 1}")
+        data = response["Body"].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def read_inventory_parquet_rows(s3_client, data_file, offset):
+    """
+    Reads rows from an S3 Inventory Parquet file, starting after the number of rows given by the offset.  The
+    file's footer tells us which row group that row is in, so only that row group and the ones after it are read,
+    one at a time.  This needs the pyarrow library, which isn't in the standard Lambda runtime, so must be added
+    via a layer
+
+    :return: Generator of (bucket, key, offset after the row) tuples
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Reading Parquet S3 Inventory reports needs the pyarrow library - use a CSV report instead")
+
+    reader = io.BufferedReader(S3ObjectReader(s3_client, data_file["bucket"], data_file["key"]),
+                               buffer_size=READ_CHUNK_SIZE)
+    try:
+        parquet_file = pq.ParquetFile(reader)
+        group_start = 0
+        for group in range(parquet_file.metadata.num_row_groups):
+            group_rows = parquet_file.metadata.row_group(group).num_rows
+            if group_start + group_rows > offset:
+                rows = parquet_file.read_row_group(group, columns=["bucket", "key"])
+                first_row = max(0, offset - group_start)
+                buckets = rows.column("bucket").to_pylist()[first_row:]
+                keys = rows.column("key").to_pylist()[first_row:]
+                for row_number, (bucket, key) in enumerate(zip(buckets, keys), start=group_start + first_row + 1):
+                    yield bucket, key, row_number
+            group_start += group_rows
+    finally:
+        reader.close()
+
+
+def read_manifest_chunk(s3_client, manifest, max_entries):
+    """
+    Reads the next entries from a manifest, starting at its current position, moving across data files as
+    required.  Folder objects are skipped.  The manifest's position isn't changed here, as that only happens
+    once the entries have been dealt with; if the manifest has no more entries then it is marked as done
+
+    :param s3_client: Boto3 client for S3
+    :param manifest: Manifest state
+    :param max_entries: Maximum number of entries to read
+    :return: List of [bucket, key, fileIndex, offset] entries, where the position is that following the entry
+    """
+    entries = []
+    file_index = manifest["fileIndex"]
+    offset = manifest["offset"]
+    while (len(entries) < max_entries) and (file_index < len(manifest["files"])):
+        data_file = manifest["files"][file_index]
+        if manifest["format"] == FORMAT_PLAIN_CSV:
+            rows = read_plain_csv_rows(s3_client, data_file, offset)
+        elif manifest["format"] == FORMAT_INVENTORY_CSV:
+            rows = read_inventory_csv_rows(s3_client, manifest, file_index, offset)
+        else:
+            rows = read_inventory_parquet_rows(s3_client, data_file, offset)
+
+        for bucket, key, next_offset in rows:
+            if not key.endswith("/"):
+                entries.append([bucket, key, file_index, next_offset])
+                if len(entries) == max_entries:
+                    break
+        rows.close()
+
+        # If we didn't fill our chunk then this data file is finished, so move on to the next one
+        if len(entries) < max_entries:
+            file_index += 1
+            offset = 0
+
+    if not entries:
+        manifest["done"] = True
+        remove_staged_file(s3_client, manifest, manifest["fileIndex"])
+    return entries
+
+
+def advance_manifest(s3_client, manifest, entries, taken):
+    """
+    Moves a manifest's position on past the entries that we have dealt with, removing the staged copies of any
+    data files that we have now finished with
+
+    :param s3_client: Boto3 client for S3
+    :param manifest: Manifest state, which is updated
+    :param entries: Entries from read_manifest_chunk()
+    :param taken: Number of those entries that have been dealt with
+    """
+    if taken > 0:
+        for file_index in range(manifest["fileIndex"], entries[taken - 1][2]):
+            remove_staged_file(s3_client, manifest, file_index)
+        manifest["fileIndex"] = entries[taken - 1][2]
+        manifest["offset"] = entries[taken - 1][3]
+
+
+def load_manifest_progress(manifest):
+    """
+    Updates a new manifest state with any progress persisted by an earlier run through the same manifest
+
+    :param manifest: Manifest state, which is updated
+    :return: Number of files processed by the earlier run
+    """
+    if MANIFEST_TABLE_NAME == "":
+        return 0
+
+    table = boto3.resource("dynamodb").Table(MANIFEST_TABLE_NAME)
+    response = table.get_item(Key={"PKJobId": manifest["uri"], "SKApiMode": MANIFEST_TABLE_SK}, ConsistentRead=True)
+    if "Item" not in response:
+        return 0
+
+    manifest["fileIndex"] = int(response["Item"]["FileIndex"])
+    manifest["offset"] = int(response["Item"]["DataOffset"])
+    print(f"Resuming manifest {manifest['uri']} at data file {manifest['fileIndex']}, offset {manifest['offset']}")
+    return int(response["Item"]["FilesProcessed"])
+
+
+def save_manifest_progress(manifest, files_processed, failed_entries):
+    """
+    Persists our position in a manifest, and records any entries that failed to be processed
+
+    :param manifest: Manifest state
+    :param files_processed: Total number of files processed so far
+    :param failed_entries: List of "bucket/key" strings for entries that failed this cycle
+    """
+    if MANIFEST_TABLE_NAME == "":
+        return
+
+    update_expression = "SET FileIndex = :fileIndex, DataOffset = :offset, FilesProcessed = :processed"
+    values = {":fileIndex": manifest["fileIndex"], ":offset": manifest["offset"], ":processed": files_processed}
+    if failed_entries:
+        update_expression += " ADD FailedEntries :failed"
+        values[":failed"] = set(failed_entries[:MAX_FAILED_ENTRIES])
+
+    table = boto3.resource("dynamodb").Table(MANIFEST_TABLE_NAME)
+    table.update_item(Key={"PKJobId": manifest["uri"], "SKApiMode": MANIFEST_TABLE_SK},
+                      UpdateExpression=update_expression, ExpressionAttributeValues=values)
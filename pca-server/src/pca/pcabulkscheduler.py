@@ -0,0 +1,261 @@
+"""
+This python module is part of the bulk files workflow, and decides which of the files found by the files-count step
+are moved into PCA each cycle.  Files belong to priority classes, which are defined in the workflow's input or in
+the BULK_PRIORITY_CLASSES setting, and a file's class comes from its key prefix or, optionally, from a metadata
+value on the object.  Each cycle the waiting files from the most urgent classes are moved first, and classes of
+the same priority share the drip rate in proportion to their weights, so a large backfill in one class cannot
+starve a small urgent batch in another.  A class can also have a limit on the number of its files that are in
+flight in PCA at once.
+
+In-flight files are tracked with an item per file in the DynamoDB tracking table, which is removed when the PCA
+workflow for that file finishes, or when the file never starts a workflow; items also expire, and are then deleted by
+the table's TTL, so a workflow that dies part way through can't block its class forever.  Per-class throughput and wait times are reported in the workflow data.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+import time
+import boto3
+from boto3.dynamodb.conditions import Key, Attr
+
+# Class definitions, and the name of the class for files that don't match any other
+BULK_PRIORITY_CLASSES = os.getenv("BULK_PRIORITY_CLASSES", "")
+BULK_PRIORITY_METADATA_KEY = os.getenv("BULK_PRIORITY_METADATA_KEY", "")
+DEFAULT_CLASS = "default"
+
+# In-flight file tracking in our tracking table
+SCHEDULER_TABLE_NAME = os.getenv("TableName", "")
+IN_FLIGHT_CLASS_PK_PREFIX = "bulk-class#"
+IN_FLIGHT_FILE_PK_PREFIX = "bulk-file#"
+IN_FLIGHT_FILE_SK = "bulk-class"
+IN_FLIGHT_TIMEOUT_SECONDS = int(os.getenv("BULK_IN_FLIGHT_TIMEOUT_SECONDS", "21600"))
+
+
+def load_priority_classes(class_definitions=None):
+    """
+    Builds the priority classes for this run from the workflow's input, or from our setting if the input has none.
+    Each class has a "name", and optionally "prefixes", a "priority" (higher numbers are more urgent, default 0),
+    a "weight" (default 1) and a "maxInFlight" limit.  There is always a default class for unmatched files
+
+    :param class_definitions: Optional list of class definitions from the workflow's input
+    :return: Dictionary of class name to class
+    """
+    if class_definitions is None:
+        class_definitions = json.loads(BULK_PRIORITY_CLASSES) if BULK_PRIORITY_CLASSES != "" else []
+
+    classes = {DEFAULT_CLASS: {"prefixes": [], "priority": 0, "weight": 1}}
+    for definition in class_definitions:
+        priority_class = {"prefixes": definition.get("prefixes", []),
+                          "priority": int(definition.get("priority", 0)),
+                          "weight": max(1, int(definition.get("weight", 1)))}
+        if "maxInFlight" in definition:
+            priority_class["maxInFlight"] = max(0, int(definition["maxInFlight"]))
+        classes[definition["name"]] = priority_class
+    return classes
+
+
+def get_top_level_prefixes(classes):
+    """
+    Returns the class prefixes that aren't nested inside another class prefix, which are the ones that get their
+    own listing shard - files under nested prefixes are found by the shard of the enclosing prefix
+
+    :param classes: Dictionary of class name to class
+    :return: Sorted list of prefixes
+    """
+    prefixes = set(prefix for priority_class in classes.values() for prefix in priority_class["prefixes"])
+    return sorted(prefix for prefix in prefixes
+                  if not any(prefix.startswith(other) and prefix != other for other in prefixes))
+
+
+def is_metadata_classification_enabled():
+    """
+    Returns flag to indicate if a file's class should be read from its object metadata
+    """
+    return BULK_PRIORITY_METADATA_KEY != ""
+
+
+def get_metadata_class(s3_client, bucket, key):
+    """
+    Reads the class of a file from its object metadata.  Failures are only logged, as the file then just falls
+    back to being classified by its prefix
+
+    :param s3_client: Boto3 client for S3
+    :param bucket: Bucket holding the file
+    :param key: Key of the file
+    :return: Class name from the metadata, or None if there isn't one
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+        return response.get("Metadata", {}).get(BULK_PRIORITY_METADATA_KEY.lower())
+    except Exception as e:
+        print(f"Unable to read priority metadata for file {key}: {str(e)}")
+        return None
+
+
+def classify_file(classes, key, metadata_class=None):
+    """
+    Works out a file's class - a known class in its metadata wins, otherwise it is the class with the longest
+    prefix that matches the key, otherwise it is the default class
+
+    :param classes: Dictionary of class name to class
+    :param key: Key of the file
+    :param metadata_class: Optional class name read from the file's metadata
+    :return: Class name
+    """
+    if metadata_class in classes:
+        return metadata_class
+
+    best_name = DEFAULT_CLASS
+    best_length = -1
+    for name, priority_class in classes.items():
+        for prefix in priority_class["prefixes"]:
+            if key.startswith(prefix) and len(prefix) > best_length:
+                best_name = name
+                best_length = len(prefix)
+    return best_name
+
+
+def schedule_files(file_classes, classes, in_flight, max_files):
+    """
+    Picks the files to move this cycle.  Every listed file competes, not just the next one in each listing, so a
+    file can be taken from behind files of a less urgent class or of a class that is at its in-flight limit, which
+    are left for a later cycle.  The most urgent class with a file waiting and room under its in-flight limit goes
+    first; classes of equal priority are served so that the files that each has taken stay in proportion to its
+    weight, and a class's listings are served in turn, each giving up its files of that class in listing order
+
+    :param file_classes: List of the class names of the files in each listing
+    :param classes: Dictionary of class name to class
+    :param in_flight: Dictionary of class name to number of files in flight, for classes with a limit
+    :param max_files: Maximum number of files to take
+    :return: List of the sorted indexes of the files to take from each listing
+    :return: Dictionary of class name to number of files taken
+    """
+    # Queue up the files of each class in each listing, in listing order
+    waiting = [{} for names in file_classes]
+    for index, names in enumerate(file_classes):
+        for position, name in reversed(list(enumerate(names))):
+            waiting[index].setdefault(name, []).append(position)
+
+    taken = [[] for names in file_classes]
+    class_taken = {name: 0 for name in classes}
+    total_taken = 0
+    while total_taken < max_files:
+        candidates = set(name for listing_waiting in waiting for name in listing_waiting
+                         if ("maxInFlight" not in classes[name]) or
+                         (in_flight.get(name, 0) + class_taken[name] < classes[name]["maxInFlight"]))
+        if not candidates:
+            break
+
+        top_priority = max(classes[name]["priority"] for name in candidates)
+        chosen = min((name for name in candidates if classes[name]["priority"] == top_priority),
+                     key=lambda name: ((class_taken[name] + 1) / classes[name]["weight"], name))
+        index = min((index for index, listing_waiting in enumerate(waiting) if chosen in listing_waiting),
+                    key=lambda index: (len(taken[index]), index))
+        taken[index].append(waiting[index][chosen].pop())
+        if not waiting[index][chosen]:
+            del waiting[index][chosen]
+        class_taken[chosen] += 1
+        total_taken += 1
+
+    return [sorted(positions) for positions in taken], class_taken
+
+
+def is_in_flight_tracking_needed(classes):
+    """
+    Returns flag to indicate if we need to track in-flight files, which is only the case if a class has a limit
+    """
+    return (SCHEDULER_TABLE_NAME != "") and any("maxInFlight" in priority_class for priority_class in classes.values())
+
+
+def load_in_flight_counts(classes):
+    """
+    Counts the in-flight files of every class that has a limit, ignoring any whose tracking item has expired
+
+    :param classes: Dictionary of class name to class
+    :return: Dictionary of class name to number of files in flight
+    """
+    table = boto3.resource("dynamodb").Table(SCHEDULER_TABLE_NAME)
+    now = int(time.time())
+    counts = {}
+    for name, priority_class in classes.items():
+        if "maxInFlight" in priority_class:
+            kwargs = {"KeyConditionExpression": Key("PKJobId").eq(IN_FLIGHT_CLASS_PK_PREFIX + name),
+                      "FilterExpression": Attr("ExpiresAt").gt(now), "Select": "COUNT"}
+            counts[name] = 0
+            while True:
+                response = table.query(**kwargs)
+                counts[name] += response["Count"]
+                if "LastEvaluatedKey" not in response:
+                    break
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return counts
+
+
+def register_in_flight(files):
+    """
+    Records files as being in flight.  Each gets an item under its class, which is what we count, and an item
+    under its own location, so that the PCA workflow can find its class when it finishes
+
+    :param files: List of (class name, bucket, key) tuples, where the location is that of the file given to PCA
+    """
+    expires_at = int(time.time()) + IN_FLIGHT_TIMEOUT_SECONDS
+    with boto3.resource("dynamodb").Table(SCHEDULER_TABLE_NAME).batch_writer() as batch:
+        for name, bucket, key in files:
+            location = f"{bucket}/{key}"
+            batch.put_item(Item={"PKJobId": IN_FLIGHT_CLASS_PK_PREFIX + name, "SKApiMode": location,
+                                 "ExpiresAt": expires_at})
+            batch.put_item(Item={"PKJobId": IN_FLIGHT_FILE_PK_PREFIX + location, "SKApiMode": IN_FLIGHT_FILE_SK,
+                                 "BulkClass": name, "ExpiresAt": expires_at})
+
+
+def finish_in_flight(bucket, key):
+    """
+    Called by the PCA workflow when it has finished with a file, which releases its in-flight slot if it came
+    from the bulk workflow.  Failures are only logged, as the slot will still expire
+
+    :param bucket: Bucket holding the file that PCA processed
+    :param key: Key of that file
+    """
+    if SCHEDULER_TABLE_NAME == "":
+        return
+
+    location = f"{bucket}/{key}"
+    try:
+        table = boto3.resource("dynamodb").Table(SCHEDULER_TABLE_NAME)
+        response = table.delete_item(Key={"PKJobId": IN_FLIGHT_FILE_PK_PREFIX + location,
+                                          "SKApiMode": IN_FLIGHT_FILE_SK}, ReturnValues="ALL_OLD")
+        if "Attributes" in response:
+            table.delete_item(Key={"PKJobId": IN_FLIGHT_CLASS_PK_PREFIX + response["Attributes"]["BulkClass"],
+                                   "SKApiMode": location})
+    except Exception as e:
+        print(f"Unable to release bulk in-flight slot for {location}: {str(e)}")
+
+
+def update_class_stats(sf_data, moved_files, waiting, in_flight):
+    """
+    Adds this cycle's moves to the per-class statistics in the workflow data, and logs them
+
+    :param sf_data: Workflow data, which is updated
+    :param moved_files: List of (class name, wait in seconds) tuples for the files moved this cycle
+    :param waiting: Dictionary of class name to number of listed files that were left waiting
+    :param in_flight: Dictionary of class name to number of files in flight before this cycle's moves
+    """
+    now = int(time.time())
+    elapsed_minutes = max(1, now - sf_data.get("runStartTime", now)) / 60
+    stats = sf_data.setdefault("classStats", {})
+    for name in sf_data["priorityClasses"]:
+        class_stats = stats.setdefault(name, {"moved": 0, "totalWaitSeconds": 0, "maxWaitSeconds": 0})
+        waits = [wait for file_class, wait in moved_files if file_class == name]
+        class_stats["moved"] += len(waits)
+        class_stats["movedLastCycle"] = len(waits)
+        class_stats["totalWaitSeconds"] += sum(waits)
+        class_stats["maxWaitSeconds"] = max([class_stats["maxWaitSeconds"]] + waits)
+        class_stats["averageWaitSeconds"] = round(class_stats["totalWaitSeconds"] / max(1, class_stats["moved"]))
+        class_stats["throughputPerMinute"] = round(class_stats["moved"] / elapsed_minutes, 2)
+        class_stats["waiting"] = waiting.get(name, 0)
+        if name in in_flight:
+            class_stats["inFlight"] = in_flight[name] + len(waits)
+
+    print(json.dumps({"BulkClassStats": stats}))
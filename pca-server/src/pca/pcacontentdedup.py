@@ -0,0 +1,177 @@
+"""
+This python module is used by the file-drop trigger and the main processing workflow to detect audio files that
+have been delivered more than once under different keys, so that each recording is only processed once.
+
+A content fingerprint is built from the object's size and ETag along with a hash of a few small samples taken from
+the start, middle and end of the file, so the audio never has to be downloaded in full.  The first file to arrive
+with a given fingerprint claims it in the DynamoDB tracking table, and once it has been processed the location of
+its parsed results and its duration are added to that entry.  Any later copy is linked to that entry rather than
+being processed again, but a copy that arrives while the original is still being processed is deferred until we know
+whether the original succeeded.  If the original fails, or its workflow can't be started, then its claim is released
+so that a copy can be processed instead.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import hashlib
+import os
+import time
+from decimal import Decimal
+import boto3
+from botocore.exceptions import ClientError
+
+# Deduplication settings
+CONTENT_DEDUP = os.getenv("CONTENT_DEDUP", "false")
+DEDUP_TABLE_NAME = os.getenv("TableName", "")
+DEDUP_TABLE_SK = "content-fingerprint"
+DEDUP_SAMPLE_BYTES = int(os.getenv("DEDUP_SAMPLE_BYTES", "65536"))
+DEDUP_PENDING_TIMEOUT_SECONDS = int(os.getenv("DEDUP_PENDING_TIMEOUT_SECONDS", "21600"))
+DEDUP_COST_PER_MINUTE = float(os.getenv("DEDUP_COST_PER_MINUTE", "0.024"))
+DEDUP_DEFER_SECONDS = min(int(os.getenv("DEDUP_DEFER_SECONDS", "900")), 900)
+
+
+def is_content_dedup_enabled():
+    """
+    Returns flag to indicate if duplicate audio files should be detected, which needs our tracking table
+    """
+    return (CONTENT_DEDUP.lower() == "true") and (DEDUP_TABLE_NAME != "")
+
+
+def get_sample_ranges(object_size):
+    """
+    Works out the byte ranges that are sampled for a file's fingerprint - small files are read in full
+
+    :param object_size: Size of the S3 object
+    :return: List of (start, end) inclusive byte ranges
+    """
+    if object_size <= 3 * DEDUP_SAMPLE_BYTES:
+        return [(0, object_size - 1)] if object_size > 0 else []
+
+    middle = (object_size - DEDUP_SAMPLE_BYTES) // 2
+    return [(0, DEDUP_SAMPLE_BYTES - 1),
+            (middle, middle + DEDUP_SAMPLE_BYTES - 1),
+            (object_size - DEDUP_SAMPLE_BYTES, object_size - 1)]
+
+
+def create_content_fingerprint(s3_client, bucket, key, head_response):
+    """
+    Creates the content fingerprint of an S3 object from its size, ETag and a hash of sampled byte ranges
+
+    :param s3_client: Boto3 client for S3
+    :param bucket: Bucket holding the object
+    :param key: Key of the object
+    :param head_response: Response from head_object() for this object
+    :return: Hex digest of the fingerprint
+    """
+    object_size = head_response["ContentLength"]
+    fingerprint = hashlib.sha256(f"{object_size}:{head_response['ETag']}".encode("utf-8"))
+    for start, end in get_sample_ranges(object_size):
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+        fingerprint.update(response["Body"].read())
+
+    return fingerprint.hexdigest()
+
+
+def claim_content_fingerprint(fingerprint, bucket, key):
+    """
+    Attempts to register this object as the original copy of its content.  This succeeds if the fingerprint is
+    new, if it already belongs to this same object, or if the original copy never finished processing within
+    our pending timeout.  Otherwise the existing entry is returned, as this object is a duplicate of it
+
+    :param fingerprint: Content fingerprint of the object
+    :param bucket: Bucket holding the object
+    :param key: Key of the object
+    :return: None if this object now owns the fingerprint, otherwise the existing fingerprint entry
+    """
+    table = boto3.resource("dynamodb").Table(DEDUP_TABLE_NAME)
+    now = int(time.time())
+    try:
+        table.put_item(Item={"PKJobId": fingerprint,
+                             "SKApiMode": DEDUP_TABLE_SK,
+                             "OriginalBucket": bucket,
+                             "OriginalKey": key,
+                             "ClaimedAt": now},
+                       ConditionExpression="attribute_not_exists(PKJobId) OR "
+                                           "(OriginalBucket = :bucket AND OriginalKey = :key) OR "
+                                           "(attribute_not_exists(ParsedResultsFile) AND ClaimedAt < :stale)",
+                       ExpressionAttributeValues={":bucket": bucket,
+                                                  ":key": key,
+                                                  ":stale": now - DEDUP_PENDING_TIMEOUT_SECONDS},
+                       ReturnValuesOnConditionCheckFailure="ALL_OLD")
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return e.response["Item"]
+
+
+def release_content_fingerprint(fingerprint, bucket, key):
+    """
+    Gives up an object's claim on its content fingerprint when it isn't going to produce any results, so that a
+    deferred or later copy of the content can be processed instead.  Only an unfinished claim that is still held by
+    this same object is removed
+
+    :param fingerprint: Content fingerprint of the object
+    :param bucket: Bucket holding the object
+    :param key: Key of the object
+    """
+    table = boto3.resource("dynamodb").Table(DEDUP_TABLE_NAME)
+    try:
+        table.delete_item(Key={"PKJobId": fingerprint, "SKApiMode": DEDUP_TABLE_SK},
+                          ConditionExpression="OriginalBucket = :bucket AND OriginalKey = :key AND "
+                                              "attribute_not_exists(ParsedResultsFile)",
+                          ExpressionAttributeValues={":bucket": bucket, ":key": key})
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+def has_content_results(fingerprint_entry):
+    """
+    Returns flag to indicate if the original copy of some content has finished processing
+
+    :param fingerprint_entry: Fingerprint entry of the original copy
+    """
+    return "ParsedResultsFile" in fingerprint_entry
+
+
+def link_duplicate(fingerprint, bucket, key):
+    """
+    Records an object against the fingerprint entry of the original copy of its content
+
+    :param fingerprint: Content fingerprint of the object
+    :param bucket: Bucket holding the duplicate object
+    :param key: Key of the duplicate object
+    """
+    table = boto3.resource("dynamodb").Table(DEDUP_TABLE_NAME)
+    table.update_item(Key={"PKJobId": fingerprint, "SKApiMode": DEDUP_TABLE_SK},
+                      UpdateExpression="ADD DuplicateKeys :duplicate, DuplicateCount :one",
+                      ExpressionAttributeValues={":duplicate": {f"{bucket}/{key}"}, ":one": 1})
+
+
+def record_content_results(fingerprint, parsed_results_file, duration):
+    """
+    Records the location of the parsed results for the original copy of some content, along with the duration
+    of the call, which lets duplicates be linked to those results and their cost savings estimated
+
+    :param fingerprint: Content fingerprint of the original object
+    :param parsed_results_file: Key of the parsed results file in the output bucket
+    :param duration: Duration of the call in seconds
+    """
+    table = boto3.resource("dynamodb").Table(DEDUP_TABLE_NAME)
+    table.update_item(Key={"PKJobId": fingerprint, "SKApiMode": DEDUP_TABLE_SK},
+                      UpdateExpression="SET ParsedResultsFile = :results, DurationSeconds = :duration",
+                      ExpressionAttributeValues={":results": parsed_results_file,
+                                                 ":duration": Decimal(str(round(duration, 3)))})
+
+
+def estimate_cost_saved(fingerprint_entry):
+    """
+    Estimates the processing cost that was saved by not processing a duplicate of the given content.  If the
+    original copy is still being processed then its duration is not yet known, so no saving is counted
+
+    :param fingerprint_entry: Fingerprint entry of the original copy
+    :return: Estimated cost saved, in US dollars
+    """
+    duration = float(fingerprint_entry.get("DurationSeconds", 0))
+    return (duration / 60.0) * DEDUP_COST_PER_MINUTE
@@ -0,0 +1,196 @@
+"""
+This python module is part of the bulk files workflow, and adjusts the drip rate - the number of files moved into
+PCA each cycle - using additive increase and multiplicative decrease (AIMD).  The configured BulkUploadMaxDripRate
+is the ceiling.  Each cycle the rate is cut by a factor if there are signs of overload, which are throttling seen
+by the bulk workflow itself, a high failure rate or throttled executions in the main PCA workflow, or that workflow
+running much slower than the best we have seen; otherwise, if the rate was what limited the last cycle, it is
+raised by a fixed step.  Signals from CloudWatch lag behind, so after a decrease the rate is held for a few cycles
+to give it time to take effect before it is changed again.
+
+The controller's state, the signals that it saw and the reason for its decision are all held in the workflow data,
+so they appear in the state output of each cycle for tuning.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from math import floor
+import boto3
+
+# Controller settings
+ADAPTIVE_DRIP_RATE = os.getenv("ADAPTIVE_DRIP_RATE", "true")
+DRIP_RATE_INCREASE = int(os.getenv("DRIP_RATE_INCREASE", "5"))
+DRIP_RATE_DECREASE_FACTOR = float(os.getenv("DRIP_RATE_DECREASE_FACTOR", "0.5"))
+DRIP_DECREASE_HOLD_CYCLES = int(os.getenv("DRIP_DECREASE_HOLD_CYCLES", "5"))
+DRIP_FAILURE_RATE_LIMIT = float(os.getenv("DRIP_FAILURE_RATE_LIMIT", "0.1"))
+DRIP_FAILURE_MIN_EXECUTIONS = 5
+DRIP_LATENCY_TOLERANCE = float(os.getenv("DRIP_LATENCY_TOLERANCE", "2.0"))
+
+# Main PCA workflow, whose CloudWatch metrics we watch, and the window that we look at
+PCA_STATE_MACHINE_ARN = os.getenv("PCA_STATE_MACHINE_ARN", "")
+METRIC_WINDOW_SECONDS = 300
+THROTTLE_ERROR_MARKERS = ["throttl", "slowdown", "toomanyrequests", "rate exceeded", "limitexceeded"]
+
+
+def is_adaptive_drip_rate_enabled():
+    """
+    Returns flag to indicate if the drip rate should be adjusted each cycle
+    """
+    return ADAPTIVE_DRIP_RATE.lower() == "true"
+
+
+def is_throttling_error(message):
+    """
+    Decides whether an error message looks like it came from an AWS service throttling us
+
+    :param message: Error message or code
+    :return: True if the error was throttling
+    """
+    message = message.lower()
+    return any(marker in message for marker in THROTTLE_ERROR_MARKERS)
+
+
+def get_workflow_metrics():
+    """
+    Reads the recent execution metrics of the main PCA workflow from CloudWatch with a single request.  Failures
+    are only logged, as the controller can still work from the signals that it sees itself
+
+    :return: Dictionary of metric values, which is empty if there are no metrics
+    """
+    if PCA_STATE_MACHINE_ARN == "":
+        return {}
+
+    queries = {"succeeded": ("ExecutionsSucceeded", "Sum"), "failed": ("ExecutionsFailed", "Sum"),
+               "timedOut": ("ExecutionsTimedOut", "Sum"), "throttled": ("ExecutionThrottled", "Sum"),
+               "latencyMs": ("ExecutionTime", "Average")}
+    metric_queries = [{"Id": query_id.lower(),
+                       "MetricStat": {"Metric": {"Namespace": "AWS/States", "MetricName": metric_name,
+                                                 "Dimensions": [{"Name": "StateMachineArn",
+                                                                 "Value": PCA_STATE_MACHINE_ARN}]},
+                                      "Period": METRIC_WINDOW_SECONDS, "Stat": stat}}
+                      for query_id, (metric_name, stat) in queries.items()]
+
+    end_time = datetime.now(timezone.utc)
+    try:
+        response = boto3.client("cloudwatch").get_metric_data(MetricDataQueries=metric_queries,
+                                                              StartTime=end_time - timedelta(seconds=METRIC_WINDOW_SECONDS),
+                                                              EndTime=end_time)
+    except Exception as e:
+        print(f"Unable to read PCA workflow metrics: {str(e)}")
+        return {}
+
+    metrics = {}
+    ids = {query_id.lower(): query_id for query_id in queries}
+    for result in response["MetricDataResults"]:
+        if result["Values"]:
+            metrics[ids[result["Id"]]] = result["Values"][0]
+    return metrics
+
+
+def collect_signals(sf_data, queue_throttled, queue_space):
+    """
+    Gathers the signals that drive the controller for this cycle
+
+    :param sf_data: Workflow data, holding the results of the last move cycle
+    :param queue_throttled: Flag to say that our queue-space check was throttled
+    :param queue_space: Space in the Transcribe queue for this cycle
+    :return: Dictionary of signals
+    """
+    move_throttled = sum(1 for failure in sf_data.get("moveFailures", []) if is_throttling_error(failure["error"]))
+    signals = {"queueThrottled": queue_throttled, "moveThrottled": move_throttled,
+               "queueSpace": queue_space, "filesToMove": sf_data.get("filesToMove", 0)}
+
+    metrics = get_workflow_metrics()
+    if metrics:
+        signals["workflowThrottled"] = int(metrics.get("throttled", 0))
+        finished = metrics.get("succeeded", 0) + metrics.get("failed", 0) + metrics.get("timedOut", 0)
+        signals["workflowFinished"] = int(finished)
+        if finished > 0:
+            signals["workflowFailureRate"] = round((metrics.get("failed", 0) + metrics.get("timedOut", 0)) / finished, 3)
+        if "latencyMs" in metrics:
+            signals["workflowLatencySeconds"] = round(metrics["latencyMs"] / 1000, 1)
+    return signals
+
+
+def find_overload(signals, control):
+    """
+    Checks the signals for any sign that PCA is overloaded
+
+    :param signals: Signals for this cycle
+    :param control: Controller state
+    :return: Reason why we are overloaded, or None if we are not
+    """
+    if signals["queueThrottled"]:
+        return "Transcribe queue check was throttled"
+    if signals["moveThrottled"] > 0:
+        return f"{signals['moveThrottled']} file move(s) were throttled"
+    if signals.get("workflowThrottled", 0) > 0:
+        return f"{signals['workflowThrottled']} PCA workflow execution(s) were throttled"
+    if (signals.get("workflowFinished", 0) >= DRIP_FAILURE_MIN_EXECUTIONS) and \
+            (signals.get("workflowFailureRate", 0) > DRIP_FAILURE_RATE_LIMIT):
+        return f"PCA workflow failure rate {signals['workflowFailureRate']} is above {DRIP_FAILURE_RATE_LIMIT}"
+    latency = signals.get("workflowLatencySeconds")
+    if (latency is not None) and (control.get("bestLatencySeconds") is not None) and \
+            (latency > control["bestLatencySeconds"] * DRIP_LATENCY_TOLERANCE):
+        return f"PCA workflow latency {latency}s is over {DRIP_LATENCY_TOLERANCE}x the best " + \
+               f"of {control['bestLatencySeconds']}s"
+    return None
+
+
+def adjust_drip_rate(sf_data, queue_throttled, queue_space):
+    """
+    Runs one cycle of the controller, updating the drip rate in the workflow data and recording the decision
+    and the reasoning behind it under "dripControl"
+
+    :param sf_data: Workflow data, which is updated
+    :param queue_throttled: Flag to say that our queue-space check was throttled
+    :param queue_space: Space in the Transcribe queue for this cycle
+    """
+    if not is_adaptive_drip_rate_enabled():
+        return
+
+    # The configured rate is our ceiling, and is where we start
+    control = sf_data.setdefault("dripControl", {"maxRate": sf_data["dripRate"], "bestLatencySeconds": None,
+                                                 "cyclesSinceDecrease": DRIP_DECREASE_HOLD_CYCLES})
+    rate = sf_data["dripRate"]
+    signals = collect_signals(sf_data, queue_throttled, queue_space)
+    overload = find_overload(signals, control)
+    control["cyclesSinceDecrease"] += 1
+
+    if (overload is not None) and (control["cyclesSinceDecrease"] > DRIP_DECREASE_HOLD_CYCLES):
+        decision = "decrease"
+        rate = max(1, floor(rate * DRIP_RATE_DECREASE_FACTOR))
+        control["cyclesSinceDecrease"] = 0
+        reason = overload
+    elif overload is not None:
+        decision = "hold"
+        reason = f"{overload}, but waiting for the last decrease to take effect"
+    elif control["cyclesSinceDecrease"] <= DRIP_DECREASE_HOLD_CYCLES:
+        decision = "hold"
+        reason = "Waiting for the last decrease to take effect"
+    elif rate >= control["maxRate"]:
+        decision = "hold"
+        reason = "Already at the maximum drip rate"
+    elif queue_space < rate:
+        decision = "hold"
+        reason = f"Transcribe queue space of {queue_space} is limiting the rate, not the drip rate"
+    elif signals["filesToMove"] < rate:
+        decision = "hold"
+        reason = f"Only {signals['filesToMove']} file(s) waiting, so the drip rate isn't limiting"
+    else:
+        decision = "increase"
+        rate = min(control["maxRate"], rate + DRIP_RATE_INCREASE)
+        reason = "No sign of overload"
+
+    # Remember the best latency that we have seen, which is our baseline for spotting a slowdown
+    latency = signals.get("workflowLatencySeconds")
+    if (latency is not None) and ((control["bestLatencySeconds"] is None) or (latency < control["bestLatencySeconds"])):
+        control["bestLatencySeconds"] = latency
+
+    control["decision"] = decision
+    control["reason"] = reason
+    control["signals"] = signals
+    sf_data["dripRate"] = rate
+    print(json.dumps({"DripControl": {"Rate": rate, "Decision": decision, "Reason": reason, "Signals": signals}}))
@@ -0,0 +1,137 @@
+"""
+This python module maintains a count of the in-flight (queued or running) Transcribe jobs for each API mode.  The
+counts are held as atomic counters in the DynamoDB tracking table - they are incremented when the main workflow
+starts a job and decremented when the EventBridge handler sees that job finish - so that the bulk workflow can
+check the space in the Transcribe queue with a single read rather than listing every job.
+
+Jobs that PCA did not start, or events that are missed, will cause the counters to drift, so they are periodically
+reconciled against the Transcribe list APIs, which count every in-flight job in the account.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import time
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+import pcaconfiguration as cf
+
+# Counter location in our tracking table, and how often they are checked against Transcribe
+COUNTER_TABLE_NAME = os.getenv("TableName", "")
+COUNTER_TABLE_PK = "counter#in-flight-jobs"
+COUNTER_RECONCILE_SECONDS = int(os.getenv("COUNTER_RECONCILE_SECONDS", "300"))
+IN_FLIGHT_STATUSES = ["IN_PROGRESS", "QUEUED"]
+
+
+def is_job_counter_enabled():
+    """
+    Returns flag to indicate if we can maintain in-flight job counters, which needs our tracking table
+    """
+    return COUNTER_TABLE_NAME != ""
+
+
+def update_in_flight_count(api_mode, change):
+    """
+    Atomically adjusts the in-flight job counter for an API mode.  A decrement is never allowed to take the
+    counter below zero, which could otherwise happen for a job that was started before the last reconciliation.
+    Failures are only logged, as they must never stop a job from being processed and reconciliation will fix
+    any drift
+
+    :param api_mode: Transcribe API mode of the job
+    :param change: Amount to add to the counter, which is negative for a finished job
+    """
+    if not is_job_counter_enabled():
+        return
+
+    kwargs = {"Key": {"PKJobId": COUNTER_TABLE_PK, "SKApiMode": api_mode},
+              "UpdateExpression": "ADD InFlight :change",
+              "ExpressionAttributeValues": {":change": change}}
+    if change < 0:
+        kwargs["ConditionExpression"] = "InFlight >= :minimum"
+        kwargs["ExpressionAttributeValues"][":minimum"] = -change
+
+    try:
+        boto3.resource("dynamodb").Table(COUNTER_TABLE_NAME).update_item(**kwargs)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            print(f"Unable to update in-flight job counter for {api_mode} mode: {str(e)}")
+
+
+def load_in_flight_counts():
+    """
+    Reads the in-flight job counters for every API mode with a single query
+
+    :return: Dictionary of API mode to counter item, each holding "InFlight" and "ReconciledAt" values
+    """
+    table = boto3.resource("dynamodb").Table(COUNTER_TABLE_NAME)
+    response = table.query(KeyConditionExpression=Key("PKJobId").eq(COUNTER_TABLE_PK), ConsistentRead=True)
+    return {item["SKApiMode"]: item for item in response["Items"]}
+
+
+def count_transcribe_jobs(list_method, summaries_tag):
+    """
+    Counts every in-flight job for one of the Transcribe list APIs, following any pagination
+
+    :param list_method: Boto3 Transcribe client list method
+    :param summaries_tag: Key in the response that holds the job summaries
+    :return: Number of queued and running jobs
+    """
+    found = 0
+    for status in IN_FLIGHT_STATUSES:
+        kwargs = {"Status": status, "MaxResults": 100}
+        while True:
+            response = list_method(**kwargs)
+            found += len(response[summaries_tag])
+            if "NextToken" not in response:
+                break
+            kwargs["NextToken"] = response["NextToken"]
+
+    return found
+
+
+def reconcile_in_flight_counts(transcribe_client):
+    """
+    Resets the in-flight job counters to the number of queued and running jobs reported by Transcribe
+
+    :param transcribe_client: Boto3 client for Transcribe
+    :return: Dictionary of API mode to counter item, as per load_in_flight_counts()
+    """
+    counts = {cf.API_STANDARD: count_transcribe_jobs(transcribe_client.list_transcription_jobs,
+                                                     "TranscriptionJobSummaries"),
+              cf.API_ANALYTICS: count_transcribe_jobs(transcribe_client.list_call_analytics_jobs,
+                                                      "CallAnalyticsJobSummaries")}
+
+    table = boto3.resource("dynamodb").Table(COUNTER_TABLE_NAME)
+    reconciled_at = int(time.time())
+    items = {}
+    for api_mode, in_flight in counts.items():
+        items[api_mode] = {"PKJobId": COUNTER_TABLE_PK, "SKApiMode": api_mode,
+                           "InFlight": in_flight, "ReconciledAt": reconciled_at}
+        table.put_item(Item=items[api_mode])
+
+    print(f"Reconciled in-flight Transcribe job counters: {counts}")
+    return items
+
+
+def get_in_flight_counts(transcribe_client):
+    """
+    Returns the number of in-flight jobs for each API mode.  The counters are used as they are unless any
+    are missing or are due for reconciliation, in which case they are first reset from Transcribe.  If that
+    fails, say through throttling, then any counters that we already have are still used
+
+    :param transcribe_client: Boto3 client for Transcribe
+    :return: Dictionary of API mode to number of in-flight jobs
+    """
+    items = load_in_flight_counts()
+    oldest_reconcile = min([int(items[api_mode].get("ReconciledAt", 0)) if api_mode in items else 0
+                            for api_mode in [cf.API_STANDARD, cf.API_ANALYTICS]])
+    if time.time() - oldest_reconcile >= COUNTER_RECONCILE_SECONDS:
+        try:
+            items = reconcile_in_flight_counts(transcribe_client)
+        except Exception as e:
+            if len(items) < 2:
+                raise
+            print(f"Unable to reconcile in-flight job counters, using current values: {str(e)}")
+
+    return {api_mode: max(0, int(item["InFlight"])) for api_mode, item in items.items()}
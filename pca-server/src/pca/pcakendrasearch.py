@@ -3,24 +3,143 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
 import json
+import os
+import re
+import time
 import boto3
 import textwrap
 import urllib
+import uuid
 import dateutil.parser
+from datetime import datetime
 
 KENDRA = boto3.client('kendra')
 S3 = boto3.client('s3')
 
+# Documents are indexed asynchronously via this queue if it is defined, with the documents themselves held in S3
+KENDRA_INDEX_QUEUE_URL = os.getenv("KENDRA_INDEX_QUEUE_URL", "")
+KENDRA_DOCUMENT_PREFIX = "kendraDocuments"
+KENDRA_BATCH_SIZE = 10
+KENDRA_RETRY_DELAYS = [1, 2, 4]
+KENDRA_PERMANENT_ERRORS = ["InvalidRequest"]
 
-def prepare_transcript(results):
+# Transcripts are wrapped in blocks of about this many characters, and any that are larger than Kendra will
+# extract text from are split into linked documents
+TRANSCRIPT_WIDTH = 70
+TRANSCRIPT_BLOCK_CHARS = 4096
+KENDRA_MAX_DOCUMENT_BYTES = int(os.getenv("KENDRA_MAX_DOCUMENT_BYTES", "5000000"))
+KENDRA_MAX_BATCH_BYTES = 40000000
+
+# A call that is re-indexed in fewer parts than before has its extra parts removed, up to this many parts, as the
+# number of parts that it had before isn't recorded anywhere that we can cheaply read back
+KENDRA_MAX_DOCUMENT_PARTS = int(os.getenv("KENDRA_MAX_DOCUMENT_PARTS", "10"))
+WRAP_WHITESPACE = "\t\n\x0b\x0c\r "
+TIME_MARKER_RE = re.compile(r"\[(\d+(?:\.\d+)?)\]")
+
+# Bucket regions never change, so only look each one up once per container
+BUCKET_REGIONS = {}
+
+
+class TranscriptBuilder:
+    """
+    Builds the text of a transcript's Kendra documents in linear time.  Text is collected in a list, and is
+    wrapped a block at a time - the unfinished last line of a block is carried into the next one, a block only
+    ends where the next text starts with whitespace, and tabs are expanded from their column in the whole text,
+    so the result is exactly what wrapping the whole text at once would give.  Finished lines go into the current
+    part until it reaches the size limit, and then a new part is started, beginning with the time marker that was
+    in force at that point
+    """
+    def __init__(self, max_bytes=KENDRA_MAX_DOCUMENT_BYTES):
+        self.wrapper = textwrap.TextWrapper(width=TRANSCRIPT_WIDTH)
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.pending_chars = 0
+        self.carry = ""
+        self.column = 0
+        self.empty = True
+        self.parts = [[]]
+        self.part_bytes = 0
+        self.last_marker = None
+
+    def append(self, text):
+        """
+        Adds some text to the end of the transcript
+
+        :param text: Text to add
+        """
+        if text == "":
+            return
+        if (self.pending_chars >= TRANSCRIPT_BLOCK_CHARS) and (text[0] in WRAP_WHITESPACE) and \
+                (self.pending[-1][-1] not in WRAP_WHITESPACE):
+            self.wrap_pending(final=False)
+        self.pending.append(text)
+        self.pending_chars += len(text)
+        self.empty = False
+
+    def wrap_pending(self, final):
+        """
+        Wraps the text collected so far, keeping back the last line unless this is the end of the transcript
+
+        :param final: Flag to say that there is no more text to come
+        """
+        text = "".join(self.pending)
+        if "\t" in text:
+            padding = self.column % 8
+            text = ("x" * padding + text).expandtabs()[padding:]
+        line_start = max(text.rfind("\n"), text.rfind("\r")) + 1
+        self.column = (len(text) - line_start) if line_start else (self.column + len(text))
+
+        lines = self.wrapper.wrap(self.carry + text)
+        self.pending = []
+        self.pending_chars = 0
+        self.carry = lines.pop() if (lines and not final) else ""
+        for line in lines:
+            self.add_line(line)
+
+    def add_line(self, line):
+        """
+        Adds a finished line to the current part, starting a new part first if this one is full
+
+        :param line: Wrapped line of text
+        """
+        if self.max_bytes is None:
+            self.parts[-1].append(line)
+            return
+
+        line_bytes = len(line.encode("utf-8")) + 1
+        if self.parts[-1] and (self.part_bytes + line_bytes > self.max_bytes):
+            self.parts.append([])
+            self.part_bytes = 0
+            if (self.last_marker is not None) and not line.startswith("["):
+                self.parts[-1].append(f"[{self.last_marker}]")
+                self.part_bytes += len(self.parts[-1][-1]) + 1
+
+        self.parts[-1].append(line)
+        self.part_bytes += line_bytes
+        markers = TIME_MARKER_RE.findall(line)
+        if markers:
+            self.last_marker = markers[-1]
+
+    def finish(self):
+        """
+        Wraps any remaining text and returns the transcript
+
+        :return: List of the text of each part of the transcript
+        """
+        self.wrap_pending(final=True)
+        return ["\n".join(lines) for lines in self.parts]
+
+
+def prepare_transcript_parts(results, max_bytes=KENDRA_MAX_DOCUMENT_BYTES):
     """
     Parses the output from the Transcribe job, inserting time markers at the start of each sentence.
     The time markers enable Kendra search results to link to the relevant time marker in the
-    corresponding audio recording.
+    corresponding audio recording.  Transcripts that are too large for one Kendra document are split
+    into parts, each of which starts with a time marker
     """
 
     print(f"prepare_transcript() for {results.get_conv_analytics().get_transcribe_job().transcribe_job_name}")
-    txt = ""
+    builder = TranscriptBuilder(max_bytes)
     for segment in results.speech_segments:
         # If we have word-level timestamps then split this into sentences,
         # otherwise a returned Kendra fragment might not contain a timestamp
@@ -29,22 +148,28 @@ def prepare_transcript(results):
             for word in segment.segmentConfidence:
                 # First word in a sentence needs the start time
                 if new_sentence:
-                    if txt != "":
-                        txt = txt + "  "
-                    txt = txt + f"[{word['StartTime']}] "
+                    if not builder.empty:
+                        builder.append("  ")
+                    builder.append(f"[{word['StartTime']}] ")
                     new_sentence = False
 
-                txt = txt + f"{word['Text']}"
+                builder.append(f"{word['Text']}")
                 if str(word["Text"]).endswith(".") or str(word["Text"]).endswith("?"):
                     new_sentence = True
         else:
             # Unfortunately not, so need to create a single entry in Kendra (which could be large)
-            if txt != "":
-                txt = txt + "  "
-            txt = txt + f"[{segment.segmentStartTime}] {segment.segmentText}"
+            if not builder.empty:
+                builder.append("  ")
+            builder.append(f"[{segment.segmentStartTime}] {segment.segmentText}")
+
+    return builder.finish()
 
-    out = textwrap.fill(txt, width=70)
-    return out
+
+def prepare_transcript(results):
+    """
+    Parses the output from the Transcribe job into a single transcript with time markers
+    """
+    return prepare_transcript_parts(results, max_bytes=None)[0]
 
 
 def parse_s3uri(s3ur1):
@@ -59,13 +184,17 @@ def parse_s3uri(s3ur1):
 
 def get_bucket_region(bucket):
     """
-    get bucket location.. buckets in us-east-1 return None, otherwise region is identified in LocationConstraint
+    get bucket location.. buckets in us-east-1 return None, otherwise region is identified in LocationConstraint.
+    The result is cached, including the default for a bucket that we can't look up
     """
+    if bucket in BUCKET_REGIONS:
+        return BUCKET_REGIONS[bucket]
     try:
         region = S3.get_bucket_location(Bucket=bucket)["LocationConstraint"] or 'us-east-1' 
     except Exception as e:
         print(f"Unable to retrieve bucket region (bucket owned by another account?).. defaulting to us-east-1. Bucket: {bucket} - Message: " + str(e))
         region = 'us-east-1'
+    BUCKET_REGIONS[bucket] = region
     return region
 
 
@@ -120,12 +249,27 @@ def durationBucket(durationStr):
         return "over 10 min"
 
 
-def put_kendra_document(indexId, analysisUri, conversationAnalytics, text):
+def create_kendra_documents(analysisUri, conversationAnalytics, transcriptParts):
     """
-    index the prepared transcript in Kendra, setting all the document index attributes to support 
+    create the Kendra documents for the parts of the prepared transcript.  The first part is the call's main
+    document, and any further parts are linked to it by their id and title, and share all of its attributes
+    """
+    documents = []
+    for part_number, text in enumerate(transcriptParts, start=1):
+        document = create_kendra_document(analysisUri, conversationAnalytics, text)
+        if part_number > 1:
+            document["Id"] = f"{document['Id']}#part{part_number}"
+        if len(transcriptParts) > 1:
+            document["Title"] = f"{document['Title']} (part {part_number} of {len(transcriptParts)})"
+        documents.append(document)
+    return documents
+
+
+def create_kendra_document(analysisUri, conversationAnalytics, text):
+    """
+    create the Kendra document for the prepared transcript, setting all the document index attributes to support
     filtering, faceting, and search.
     """
-    print(f"put_document(indexId={indexId}, analysisUri={analysisUri}, conversationAnalytics={conversationAnalytics}, text='{text[0:100]}...')")
     document = {
         "Id": conversationAnalytics["SourceInformation"][0]["TranscribeJobInfo"]["MediaOriginalUri"],
         "Title": conversationAnalytics["SourceInformation"][0]["TranscribeJobInfo"]["TranscriptionJobName"],
@@ -217,13 +361,137 @@ def put_kendra_document(indexId, analysisUri, conversationAnalytics, text):
         ],
         "Blob": text
     }
-    documents = [document]
-    print("KENDRA.batch_put_document: " + json.dumps(documents, default=str)[0:1000] + "...")
-    result = KENDRA.batch_put_document(
-        IndexId = indexId,
-        Documents = documents
-    )
-    if 'FailedDocuments' in result and len(result['FailedDocuments']) > 0:
-        print("ERROR: Failed to index document: " + result['FailedDocuments'][0]['ErrorMessage'])
-    print("result: " + json.dumps(result))
-    return True
\ No newline at end of file
+    return document
+
+
+def put_kendra_document(indexId, analysisUri, conversationAnalytics, transcriptParts):
+    """
+    index the parts of the prepared transcript in Kendra straight away
+    """
+    print(f"put_document(indexId={indexId}, analysisUri={analysisUri}, conversationAnalytics={conversationAnalytics}, text='{transcriptParts[0][0:100]}...', parts={len(transcriptParts)})")
+    documents = create_kendra_documents(analysisUri, conversationAnalytics, transcriptParts)
+    failures, rejected = put_kendra_documents(indexId, documents)
+    for failure in list(failures.values()) + list(rejected.values()):
+        print("ERROR: Failed to index document: " + failure)
+    if not failures:
+        delete_stale_kendra_parts(indexId, [documents])
+    return True
+
+
+def is_kendra_queue_enabled():
+    """
+    Returns flag to indicate if documents should be queued for indexing rather than indexed straight away
+    """
+    return KENDRA_INDEX_QUEUE_URL != ""
+
+
+def queue_kendra_document(indexId, analysisUri, conversationAnalytics, transcriptParts, bucket):
+    """
+    queue the parts of the prepared transcript for indexing in Kendra by the indexer, which submits documents from
+    many calls in batches.  The documents are written to S3, as they could be too large for a queue message, under
+    a key that is unique to this write so that tidying up after an older message can never remove them
+    """
+    documents = create_kendra_documents(analysisUri, conversationAnalytics, transcriptParts)
+    jobName = conversationAnalytics["SourceInformation"][0]["TranscribeJobInfo"]["TranscriptionJobName"]
+    key = f"{KENDRA_DOCUMENT_PREFIX}/{jobName}-{uuid.uuid4().hex}.json"
+    S3.put_object(Bucket=bucket, Key=key,
+                  Body=json.dumps({"documents": documents}, default=lambda value: value.isoformat()).encode("utf-8"))
+    boto3.client("sqs").send_message(QueueUrl=KENDRA_INDEX_QUEUE_URL,
+                                     MessageBody=json.dumps({"indexId": indexId, "bucket": bucket, "key": key,
+                                                             "queuedAt": time.time()}))
+    print(f"Queued {len(documents)} document(s) for {documents[0]['Id']} for indexing from s3://{bucket}/{key}")
+    return True
+
+
+def load_kendra_documents(bucket, key):
+    """
+    load the queued Kendra documents for a call from S3, restoring the date attributes that were written as text
+    """
+    queued = json.loads(S3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+    for document in queued["documents"]:
+        for attribute in document["Attributes"]:
+            if isinstance(attribute["Value"].get("DateValue"), str):
+                attribute["Value"]["DateValue"] = datetime.fromisoformat(attribute["Value"]["DateValue"])
+    return queued["documents"]
+
+
+def get_document_batches(documents):
+    """
+    split documents into batches for Kendra, keeping each one within both the document count and total size limits
+    """
+    batches = []
+    batch_bytes = 0
+    for document in documents:
+        document_bytes = len(document["Blob"].encode("utf-8"))
+        if (not batches) or (len(batches[-1]) >= KENDRA_BATCH_SIZE) or \
+                (batch_bytes + document_bytes > KENDRA_MAX_BATCH_BYTES):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(document)
+        batch_bytes += document_bytes
+    return batches
+
+
+def put_kendra_documents(indexId, documents):
+    """
+    index documents in Kendra in batches of up to 10 that are within the size limit, retrying any that fail with a backoff unless the failure
+    is permanent.  Throttling of a whole batch is retried in the same way
+
+    :return: dictionary of document id to error message for the documents that could not be indexed, but could be
+             if they were retried later
+    :return: dictionary of document id to error message for the documents that Kendra rejected, which will never
+             be indexed however often they are retried
+    """
+    failures = {}
+    rejected = {}
+    for pending in get_document_batches(documents):
+        for delay in KENDRA_RETRY_DELAYS + [None]:
+            try:
+                result = KENDRA.batch_put_document(IndexId=indexId, Documents=pending)
+                failed = {failure["Id"]: failure for failure in result.get("FailedDocuments", [])}
+            except Exception as e:
+                # The whole batch failed, which is usually throttling
+                failed = {document["Id"]: {"Id": document["Id"], "ErrorMessage": str(e)} for document in pending}
+
+            for document_id, failure in list(failed.items()):
+                if failure.get("ErrorCode") in KENDRA_PERMANENT_ERRORS:
+                    rejected[document_id] = failure["ErrorMessage"]
+                    failed.pop(document_id)
+            pending = [document for document in pending if document["Id"] in failed]
+            if not pending:
+                break
+            if delay is None:
+                failures.update({document_id: failure["ErrorMessage"] for document_id, failure in failed.items()})
+            else:
+                time.sleep(delay)
+
+    print(json.dumps({"KendraIndexing": {"Documents": len(documents), "Failed": len(failures),
+                                         "Rejected": len(rejected)}}))
+    return failures, rejected
+
+
+def get_stale_part_ids(documents):
+    """
+    get the ids of the parts that a call's documents may have had when it was last indexed but no longer has, as
+    they would otherwise be left in the index with the old transcript text
+    """
+    return [f"{documents[0]['Id']}#part{part_number}"
+            for part_number in range(len(documents) + 1, KENDRA_MAX_DOCUMENT_PARTS + 1)]
+
+
+def delete_stale_kendra_parts(indexId, calls):
+    """
+    delete any parts left in Kendra from earlier versions of calls that have just been indexed, in batches of up to 10.
+    Documents that were never there are ignored by Kendra, and failures are only logged
+
+    :param calls: list of the documents for each call that was indexed
+    """
+    stale_ids = [document_id for documents in calls for document_id in get_stale_part_ids(documents)]
+    for batch_start in range(0, len(stale_ids), KENDRA_BATCH_SIZE):
+        batch = stale_ids[batch_start:batch_start + KENDRA_BATCH_SIZE]
+        try:
+            result = KENDRA.batch_delete_document(IndexId=indexId, DocumentIdList=batch)
+            for failure in result.get("FailedDocuments", []):
+                print(f"ERROR: Failed to remove stale document part {failure['Id']}: {failure.get('ErrorMessage')}")
+        except Exception as e:
+            print(f"ERROR: Failed to remove {len(batch)} stale document part(s): {str(e)}")
@@ -7,6 +7,8 @@ JSON that is stored in S3.
 - ConversationAnalytics - holds all of the header-level call and analytical data for the call
 - TranscribeJobInfo - holds information about the underlying Transcribe job
 - SpeechSegment - single instance of a speech segment, and PCAResults holds an array of these for the call
+- SpeakerAccumulator - running per-speaker sentiment totals, used to update trends as segments change speaker
+- TimelineIndex - sorted index of start times, used to find the segments that start at or after a point in the call
 
 The output JSON is split into the following high-level structure.
 
@@ -22,13 +24,101 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 """
 import boto3
+import bisect
 import json
+import os
 import pcaconfiguration as cf
+import pcasearchindex
 from datetime import datetime
+from math import floor
 from pathlib import Path
 
 TMP_DIR = "/tmp/"
 INTERIM_RESULTS_KEY = "interimResults"
+PAGED_RESULTS_KEY = "pagedResults"
+
+# Optional paged output layout, written alongside the full parsed results file
+PAGED_RESULTS = os.getenv("PAGED_RESULTS", "false")
+PAGE_MAX_SEGMENTS = int(os.getenv("PAGE_MAX_SEGMENTS", "250"))
+PAGE_MAX_SECONDS = float(os.getenv("PAGE_MAX_SECONDS", "300"))
+PAGED_HEADER_NAME = "header.json"
+PAGED_MANIFEST_NAME = "manifest.json"
+
+# Optional columnar sidecar for per-word confidence data, which is otherwise the bulk of a results file
+WORD_CONFIDENCE_KEY = "wordConfidence"
+WORD_CONFIDENCE_SIDECAR = os.getenv("WORD_CONFIDENCE_SIDECAR", "false")
+
+
+def is_paged_output_enabled():
+    """
+    Returns flag to indicate if the paged results layout should be written out with the parsed results
+    """
+    return PAGED_RESULTS.lower() == "true"
+
+
+def get_paged_results_prefix(results_key):
+    """
+    Returns the S3 folder that holds the paged layout for a parsed results file.  This is deliberately outside
+    of the parsed results folder, as the UI triggers on every JSON file written to that folder
+
+    :param results_key: S3 key of the parsed results file
+    :return: S3 prefix for the header, manifest and page objects
+    """
+    return PAGED_RESULTS_KEY + "/" + results_key.split("/")[-1]
+
+
+def get_parsed_results_key(results_key):
+    """
+    Returns the final parsed results S3 key for a given interim results file.  Configuration must already
+    have been loaded before this is called.
+
+    :param results_key: S3 key of the interim results file
+    :return: S3 key of the final parsed results file
+    """
+    return cf.appConfig[cf.CONF_PREFIX_PARSED_RESULTS] + "/" + results_key.split("/")[-1]
+
+
+def is_word_confidence_sidecar_enabled():
+    """
+    Returns flag to indicate if word-level confidence data should be written to a sidecar file
+    """
+    return WORD_CONFIDENCE_SIDECAR.lower() == "true"
+
+
+def get_word_confidence_sidecar_key(results_key):
+    """
+    Returns the S3 key of the word confidence sidecar for a results file.  As with the paged layout, this
+    is kept out of the parsed results folder so that the UI does not try to index it
+
+    :param results_key: S3 key of the results file
+    :return: S3 key for the word confidence sidecar
+    """
+    return WORD_CONFIDENCE_KEY + "/" + results_key.split("/")[-1]
+
+
+def load_json_from_s3(s3_client, bucket, key):
+    """
+    Reads a small JSON object directly from S3 into memory
+
+    :param s3_client: Boto3 client for S3
+    :param bucket: Bucket holding the JSON object
+    :param key: Key of the JSON object
+    :return: Parsed JSON data
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return json.loads(response["Body"].read().decode("utf-8"))
+
+
+def write_json_to_s3(s3_client, bucket, key, json_data):
+    """
+    Writes a JSON structure out to the specified S3 location
+
+    :param s3_client: Boto3 client for S3
+    :param bucket: Destination bucket
+    :param key: Destination key
+    :param json_data: JSON data to be written
+    """
+    s3_client.put_object(Bucket=bucket, Key=key, Body=bytes(json.dumps(json_data).encode('UTF-8')))
 
 
 class SpeechSegment:
@@ -58,6 +148,114 @@ class SpeechSegment:
         self.segmentIVR = False
 
 
+class TimelineIndex:
+    """
+    Class to hold a sorted index of the start times of a list of items, such as speech segments, so that the
+    items starting at or after a time can be found with binary searches rather than by scanning the whole list.
+    Results are positions in the original list, and the list does not need to be sorted by start time
+    """
+    def __init__(self, starts):
+        self.starts = starts
+        self.order = sorted(range(len(starts)), key=lambda position: starts[position])
+        self.sorted_starts = [starts[position] for position in self.order]
+
+        # The latest start up to each position in list order
+        self.latest_starts = []
+        for start in starts:
+            self.latest_starts.append(max(start, self.latest_starts[-1]) if self.latest_starts else start)
+
+    def find_first_starting_from(self, time):
+        """
+        Finds the first item in list order that starts at or after the given time
+
+        :param time: Time to search from
+        :return: Position of the item, or None if every item starts earlier
+        """
+        position = bisect.bisect_left(self.latest_starts, time)
+        return position if position < len(self.latest_starts) else None
+
+    def find_starting_between(self, start_time, end_time):
+        """
+        Finds the items that start at or after the start time but before the end time
+
+        :param start_time: Start of the time range
+        :param end_time: End of the time range, which is not included
+        :return: List of item positions, in start time order
+        """
+        return self.order[bisect.bisect_left(self.sorted_starts, start_time):
+                          bisect.bisect_left(self.sorted_starts, end_time)]
+
+
+def create_segment_timeline(speech_segments):
+    """
+    Creates a timeline index for a list of speech segments
+
+    :param speech_segments: List of speech segments
+    :return: TimelineIndex over the start times of the segments
+    """
+    return TimelineIndex([segment.segmentStartTime for segment in speech_segments])
+
+
+class SpeakerAccumulator:
+    """
+    Class to hold the running sentiment totals for one speaker, overall and for each quarter of the call, which
+    generate the same trend as the turn-by-turn processing.  Segments can be added and removed, so the trend can
+    be kept up to date as post-processing moves segments between speakers without rescanning the whole call
+    """
+    def __init__(self):
+        self.turns = 0
+        self.sentiment_sum = 0.0
+        self.quarter_scores = [0.0] * 4
+        self.quarter_datapoints = [0] * 4
+        self.quarter_starts = [[] for quarter in range(4)]
+        self.quarter_ends = [[] for quarter in range(4)]
+
+    def add(self, contribution, sign=1):
+        """
+        Adds a segment's contribution to the totals, or removes it if the sign is -1
+
+        :param contribution: Tuple of (speaker, duration, quarter, score, start, end) for the segment
+        :param sign: 1 to add the contribution, or -1 to remove it
+        """
+        speaker, duration, quarter, score, start, end = contribution
+        self.turns += sign
+        self.quarter_datapoints[quarter] += sign
+        if sign > 0:
+            bisect.insort(self.quarter_starts[quarter], start)
+            bisect.insort(self.quarter_ends[quarter], end)
+        else:
+            self.quarter_starts[quarter].pop(bisect.bisect_left(self.quarter_starts[quarter], start))
+            self.quarter_ends[quarter].pop(bisect.bisect_left(self.quarter_ends[quarter], end))
+        if score is not None:
+            self.sentiment_sum += sign * score
+            self.quarter_scores[quarter] += sign * score
+
+        # Reset totals that are now empty, so that rounding errors can't build up
+        if self.turns == 0:
+            self.sentiment_sum = 0.0
+        if self.quarter_datapoints[quarter] == 0:
+            self.quarter_scores[quarter] = 0.0
+
+    def create_trend(self):
+        """
+        Generates the overall sentiment score and change, and the per-quarter scores, from the current totals
+
+        :return: Dictionary of the "SentimentTrends" values for this speaker
+        """
+        quarter_scores = []
+        for quarter in range(4):
+            quarter_scores.append({"Quarter": quarter + 1,
+                                   "Score": self.quarter_scores[quarter] / max(self.quarter_datapoints[quarter], 1),
+                                   "BeginOffsetSecs": self.quarter_starts[quarter][0]
+                                   if self.quarter_starts[quarter] else 0.0,
+                                   "EndOffsetSecs": self.quarter_ends[quarter][-1]
+                                   if self.quarter_ends[quarter] else 0.0})
+
+        return {"SentimentChange": quarter_scores[-1]["Score"] - quarter_scores[0]["Score"],
+                "SentimentScore": self.sentiment_sum / max(self.turns, 1),
+                "SentimentPerQuarter": quarter_scores}
+
+
 class ConversationAnalytics:
     """ Class to hold the header-level analytics information about a call """
     def __init__(self):
@@ -225,16 +423,15 @@ class ConversationAnalytics:
 
         # If we had some categories then ensure each segment is tagged with them
         if len(timed_categories) > 0:
-            # Go through each speech segment and see if a category fits here
-            for segment in speech_segments:
-                for cat_time in timed_categories.copy().keys():
-                    if cat_time <= segment.segmentStartTime:
-                        segment.segmentCategoriesDetectedPre += timed_categories[cat_time]
-                        timed_categories.pop(cat_time)
-
-            # If we have any categories left then tag them to the final segment
-            for category in timed_categories:
-                speech_segments[-1].segmentCategoriesDetectedPost += timed_categories[category]
+            # Each category goes on the first speech segment that starts at or after it, or if
+            # there isn't one then it's tagged to the final segment
+            timeline = create_segment_timeline(speech_segments)
+            for cat_time in timed_categories:
+                position = timeline.find_first_starting_from(cat_time)
+                if position is not None:
+                    speech_segments[position].segmentCategoriesDetectedPre += timed_categories[cat_time]
+                else:
+                    speech_segments[-1].segmentCategoriesDetectedPost += timed_categories[cat_time]
 
         # Return the header structure for detected categories
         return categories_detected
@@ -339,6 +536,10 @@ class PCAResults:
     def __init__(self):
         self.speech_segments = []
         self.analytics = ConversationAnalytics()
+        self.word_confidence_bucket = None
+        self.word_confidence_key = None
+        self.speaker_accumulators = None
+        self.segment_contributions = {}
 
     def get_speaker_prefix(self, known_speaker):
         """
@@ -359,9 +560,11 @@ class PCAResults:
         """
         return self.analytics
 
-    def create_output_speech_segments(self):
+    def create_output_speech_segments(self, include_word_confidence=True):
         """
         Creates a list of speech segments for this conversation
+
+        :param include_word_confidence: Include the per-word [WordConfidence] block in each segment
         """
         speech_segments = []
 
@@ -387,21 +590,24 @@ class PCAResults:
                             "FollowOnCategories": segment.segmentCategoriesDetectedPost,
                             "IssuesDetected": segment.segmentIssuesDetected,
                             "ActionItemsDetected": segment.segmentActionItemsDetected,
-                            "OutcomesDetected": segment.segmentOutcomesDetected,
-                            "WordConfidence": segment.segmentConfidence}
+                            "OutcomesDetected": segment.segmentOutcomesDetected}
+            if include_word_confidence:
+                next_segment["WordConfidence"] = segment.segmentConfidence
 
             # Add what we have to the full list
             speech_segments.append(next_segment)
 
         return speech_segments
 
-    def write_results_to_s3(self, object_key=None, bucket=None, interim=False):
+    def write_results_to_s3(self, object_key=None, bucket=None, interim=False, word_sidecar=False):
         """
-        Writes out the PCA result data to the specified bucket/key location.
+        Writes out the PCA result data to the specified bucket/key location.  If requested, the per-word confidence
+        data is written to a separate columnar sidecar file, and the results file just holds a reference to it.
 
         :param bucket: Bucket where the results are to be uploaded to
         :param object_key: Name of the output file for the results
         :param interim: Forcibly writes the key to our interim results folder
+        :param word_sidecar: Write the word confidence data to a sidecar file rather than inline
         :return: JSON results object
         :return: Destination S3 object key
         """
@@ -416,7 +622,11 @@ class PCAResults:
 
         # Generate the JSON output from our internal structures
         json_data = {"ConversationAnalytics": self.analytics.create_json_output(),
-                     "SpeechSegments": self.create_output_speech_segments()}
+                     "SpeechSegments": self.create_output_speech_segments(include_word_confidence=not word_sidecar)}
+
+        # The sidecar has to exist before any results file that refers to it
+        if word_sidecar:
+            json_data["WordConfidenceSidecar"] = self.write_word_confidence_to_s3(dest_bucket, dest_key)
 
         # Write out the JSON data to the specified S3 location
         s3_resource = boto3.resource('s3')
@@ -428,6 +638,190 @@ class PCAResults:
         # Return the JSON in case the caller needs it, and the actual output filename
         return json_data, dest_key
 
+    def write_final_results_to_s3(self, bucket, interim_key, keep_interim=False):
+        """
+        Writes the results straight to the final parsed results location for the given interim results file,
+        along with any optional output layouts that have been enabled.  This should only be called by the last
+        step in the workflow that changes the results, as the final file is what triggers the UI indexing.
+
+        :param bucket: Bucket where the results are to be written
+        :param interim_key: S3 key of the interim results file that is being finalised
+        :param keep_interim: Also write the results back to the interim file, which is useful when debugging
+        :return: S3 key of the final parsed results file
+        """
+        dest_key = get_parsed_results_key(interim_key)
+        if keep_interim:
+            self.write_results_to_s3(bucket=bucket, object_key=interim_key)
+
+        # Any sidecar is written before the results file, but pages and search updates only get written after it
+        json_data, dest_key = self.write_results_to_s3(bucket=bucket, object_key=dest_key,
+                                                       word_sidecar=is_word_confidence_sidecar_enabled())
+        if is_paged_output_enabled():
+            manifest = self.write_paged_results_to_s3(bucket=bucket, results_key=dest_key)
+            print(f"Written paged results for {dest_key} across {len(manifest['Pages'])} page(s)")
+        if pcasearchindex.is_search_index_enabled():
+            update_key = pcasearchindex.write_search_index_update(bucket, dest_key, json_data)
+            print(f"Queued {dest_key} for the transcript search index as {update_key}")
+
+        return dest_key
+
+    def create_word_confidence_columns(self):
+        """
+        Creates the columnar form of the per-word confidence data, where each speech segment is represented by
+        parallel arrays of word text, confidence, start and end times.  Segments are in the same order as they
+        are in the results file's [SpeechSegments] block
+
+        :return: List of columnar word confidence entries, one per speech segment
+        """
+        columns = []
+        for segment in self.speech_segments:
+            columns.append({"Text": [word["Text"] for word in segment.segmentConfidence],
+                            "Confidence": [word["Confidence"] for word in segment.segmentConfidence],
+                            "StartTime": [word["StartTime"] for word in segment.segmentConfidence],
+                            "EndTime": [word["EndTime"] for word in segment.segmentConfidence]})
+
+        return columns
+
+    def write_word_confidence_to_s3(self, bucket, results_key):
+        """
+        Writes out the columnar word confidence sidecar for the given results file
+
+        :param bucket: Bucket where the sidecar is to be written
+        :param results_key: S3 key of the results file that the sidecar belongs to
+        :return: S3 key of the sidecar file
+        """
+        sidecar_key = get_word_confidence_sidecar_key(results_key)
+        write_json_to_s3(boto3.client('s3'), bucket, sidecar_key,
+                         {"ResultsKey": results_key,
+                          "Segments": self.create_word_confidence_columns()})
+        self.word_confidence_bucket = bucket
+        self.word_confidence_key = sidecar_key
+
+        return sidecar_key
+
+    def load_word_confidence_from_s3(self):
+        """
+        Re-hydrates the per-word confidence data of every speech segment from the sidecar file referenced by the
+        results that were last read in.  Does nothing if those results held their word confidence data inline.
+        """
+        if self.word_confidence_key is None:
+            return
+
+        sidecar = load_json_from_s3(boto3.client('s3'), self.word_confidence_bucket, self.word_confidence_key)
+        for segment, columns in zip(self.speech_segments, sidecar["Segments"]):
+            segment.segmentConfidence = [{"Text": text, "Confidence": conf, "StartTime": start, "EndTime": end}
+                                         for text, conf, start, end in zip(columns["Text"], columns["Confidence"],
+                                                                           columns["StartTime"], columns["EndTime"])]
+
+    def create_output_pages(self, max_segments=PAGE_MAX_SEGMENTS, max_seconds=PAGE_MAX_SECONDS):
+        """
+        Splits the output speech segments into time-ordered pages.  A new page is started once the current one
+        holds max_segments segments, or when the next segment starts max_seconds or more after the first segment
+        on the current page, so a page never has more than max_segments segments in it
+
+        :param max_segments: Maximum number of segments on a page
+        :param max_seconds: Maximum time span of segment start times on a page
+        :return: List of pages, where each page is a list of output speech segments
+        """
+        pages = []
+        next_page = []
+        page_start_time = 0.0
+        ordered_segments = sorted(self.create_output_speech_segments(), key=lambda x: x["SegmentStartTime"])
+        for segment in ordered_segments:
+            # Close off the current page if this segment would overflow it
+            if next_page and ((len(next_page) >= max_segments) or
+                              ((segment["SegmentStartTime"] - page_start_time) >= max_seconds)):
+                pages.append(next_page)
+                next_page = []
+
+            # First segment on a page defines the page start time
+            if not next_page:
+                page_start_time = segment["SegmentStartTime"]
+            next_page.append(segment)
+
+        # Don't forget the final partial page
+        if next_page:
+            pages.append(next_page)
+
+        return pages
+
+    def write_paged_results_to_s3(self, bucket, results_key):
+        """
+        Writes out the paged layout of the results for the given parsed results file.  This consists of a small
+        header object holding just the [ConversationAnalytics] block, a set of time-ordered speech segment pages,
+        and a manifest that lists the time range of every page.  The manifest is written last, so a reader will
+        never see a manifest that refers to pages that have not yet been written.
+
+        :param bucket: Bucket where the paged results are to be written
+        :param results_key: S3 key of the parsed results file that these pages represent
+        :return: Manifest JSON for the paged results
+        """
+        s3_client = boto3.client('s3')
+        prefix = get_paged_results_prefix(results_key)
+
+        # Header first, which is all that most consumers need
+        header_key = prefix + "/" + PAGED_HEADER_NAME
+        write_json_to_s3(s3_client, bucket, header_key, {"ConversationAnalytics": self.analytics.create_json_output()})
+
+        # Now each of the pages, tracking their time ranges for the manifest
+        manifest_pages = []
+        segment_count = 0
+        for page_number, page in enumerate(self.create_output_pages()):
+            page_key = prefix + f"/segments-{page_number:05d}.json"
+            write_json_to_s3(s3_client, bucket, page_key, {"SpeechSegments": page})
+            manifest_pages.append({"Page": page_number,
+                                   "Key": page_key,
+                                   "StartTime": page[0]["SegmentStartTime"],
+                                   "EndTime": max(segment["SegmentEndTime"] for segment in page),
+                                   "SegmentCount": len(page)})
+            segment_count += len(page)
+
+        # Finally, the manifest itself
+        manifest = {"ResultsKey": results_key,
+                    "HeaderKey": header_key,
+                    "Duration": self.analytics.duration,
+                    "SegmentCount": segment_count,
+                    "PageMaxSegments": PAGE_MAX_SEGMENTS,
+                    "PageMaxSeconds": PAGE_MAX_SECONDS,
+                    "Pages": manifest_pages}
+        write_json_to_s3(s3_client, bucket, prefix + "/" + PAGED_MANIFEST_NAME, manifest)
+
+        return manifest
+
+    def read_paged_results_from_s3(self, bucket, results_key, start_time=0.0, end_time=None, header_only=False):
+        """
+        Reads in results that were written in the paged layout.  The header is always loaded, but speech segments
+        are only read from the pages that overlap the requested time window, and only those segments that
+        overlap the window are kept.  This allows a caller to lazily page through very long calls.
+
+        :param bucket: Bucket holding the paged results
+        :param results_key: S3 key of the parsed results file that the pages represent
+        :param start_time: Start of the time window in seconds
+        :param end_time: End of the time window in seconds, or None for the end of the call
+        :param header_only: Only load the [ConversationAnalytics] header, and no speech segments
+        :return: Manifest JSON for the paged results, which lists the time range of every page
+        """
+        s3_client = boto3.client('s3')
+        prefix = get_paged_results_prefix(results_key)
+
+        # The manifest tells us where everything is, and the header is always needed
+        manifest = load_json_from_s3(s3_client, bucket, prefix + "/" + PAGED_MANIFEST_NAME)
+        header = load_json_from_s3(s3_client, bucket, manifest["HeaderKey"])
+        self.analytics.parse_json_input(header["ConversationAnalytics"])
+
+        # Load in the segments from the pages overlapping our time window
+        self.speech_segments = []
+        if not header_only:
+            for page in manifest["Pages"]:
+                if (page["EndTime"] >= start_time) and ((end_time is None) or (page["StartTime"] <= end_time)):
+                    page_json = load_json_from_s3(s3_client, bucket, page["Key"])
+                    for next_segment in page_json["SpeechSegments"]:
+                        if (float(next_segment["SegmentEndTime"]) >= start_time) and \
+                                ((end_time is None) or (float(next_segment["SegmentStartTime"]) <= end_time)):
+                            self.speech_segments.append(self.parse_speech_segment_input(next_segment))
+
+        return manifest
+
     def regenerate_header_entities(self):
         """
         Some telephony post-processing can erase segment-level entities, such as all of those assigned to
@@ -465,7 +859,95 @@ class PCAResults:
                               "Values": header_ent_dict[entity]}
                 self.analytics.custom_entities.append(nextEntity)
 
-    def read_results_from_s3(self, bucket, object_key, offline=False):
+    def get_segment_contribution(self, segment):
+        """
+        Works out what a speech segment contributes to its speaker's time and sentiment totals.  As in the
+        turn-by-turn processing, a segment belongs to the call quarter in which its midpoint lies, and only
+        positive and negative segments have a sentiment score
+
+        :param segment: Speech segment
+        :return: Tuple of (speaker, duration, quarter, score, start, end) for the segment
+        """
+        duration = segment.segmentEndTime - segment.segmentStartTime
+        quarter = 0
+        if self.analytics.duration > 0.0:
+            segment_midpoint = segment.segmentStartTime + duration / 2
+            quarter = max(min(floor((segment_midpoint * 4) / self.analytics.duration), 3), 0)
+
+        score = None
+        if segment.segmentIsPositive or segment.segmentIsNegative:
+            score = -segment.segmentSentimentScore if segment.segmentIsNegative else segment.segmentSentimentScore
+
+        return segment.segmentSpeaker, duration, quarter, score, segment.segmentStartTime, segment.segmentEndTime
+
+    def cache_speaker_accumulators(self):
+        """
+        Builds the per-speaker sentiment totals from the current speech segments in a single pass, and remembers
+        what each segment contributed to them.  This must be called before any segments are changed, so that
+        update_speaker_analytics() can later apply just the changes
+        """
+        self.speaker_accumulators = {}
+        self.segment_contributions = {}
+        for segment in self.speech_segments:
+            contribution = self.get_segment_contribution(segment)
+            self.segment_contributions[id(segment)] = (segment, contribution)
+            self.speaker_accumulators.setdefault(contribution[0], SpeakerAccumulator()).add(contribution)
+
+    def update_speaker_analytics(self, changed_segments):
+        """
+        Updates the speaker times and sentiment trends after some speech segments have been changed, such as
+        being given to a different speaker, having their sentiment cleared, being split, or being new.  Only
+        the speakers whose segments changed are updated.  Speaker times are adjusted by the change in each
+        speaker's segment durations, so times that came from Transcribe keep their other components.  In the
+        Standard API mode trends are regenerated from the segments for speakers that already have one, keeping
+        any other values in their trend entry, and new speakers only get a speaker time.  In the Call Analytics
+        mode the trends are left alone, as they came from Transcribe's own sentiment scores and our formula
+        works on a different scale, so only the speaker times are updated
+
+        :param changed_segments: List of speech segments that have been changed or added since the last update
+        :return: Set of the speakers whose values were updated
+        """
+        if self.speaker_accumulators is None:
+            self.cache_speaker_accumulators()
+
+        changed_speakers = set()
+        for segment in changed_segments:
+            new_contribution = self.get_segment_contribution(segment)
+            old_segment, old_contribution = self.segment_contributions.get(id(segment), (None, None))
+            if old_contribution == new_contribution:
+                continue
+
+            # Swap this segment's old contribution for its new one, in both the sentiment and time totals
+            updates = [(new_contribution, 1)]
+            if old_contribution is not None:
+                updates.insert(0, (old_contribution, -1))
+            for contribution, sign in updates:
+                speaker, duration = contribution[0], contribution[1]
+                self.speaker_accumulators.setdefault(speaker, SpeakerAccumulator()).add(contribution, sign)
+                speaker_time = self.analytics.speaker_time.setdefault(speaker, {"TotalTimeSecs": 0.0})
+                speaker_time["TotalTimeSecs"] = float(speaker_time["TotalTimeSecs"] + sign * duration)
+                changed_speakers.add(speaker)
+            self.segment_contributions[id(segment)] = (segment, new_contribution)
+
+        # Regenerate the trends of the speakers that have one, unless Transcribe gave them to us
+        if self.analytics.transcribe_job.api_mode == cf.API_ANALYTICS:
+            return changed_speakers
+        for speaker in changed_speakers:
+            if speaker in self.analytics.sentiment_trends:
+                self.analytics.sentiment_trends[speaker].update(self.speaker_accumulators[speaker].create_trend())
+
+        return changed_speakers
+
+    def read_results_from_s3(self, bucket, object_key, offline=False, load_word_confidence=True):
+        """
+        Reads in a PCA results file.  If the per-word confidence data was written to a sidecar file then it is
+        only loaded in if requested; otherwise a caller can load it later via load_word_confidence_from_s3()
+
+        :param bucket: Bucket holding the results file
+        :param object_key: Key of the results file
+        :param offline: Use the local copy of the results file in our temporary folder rather than S3
+        :param load_word_confidence: Re-hydrate any sidecar word confidence data into the speech segments
+        """
 
         # Download results file from S3
         local_filename = TMP_DIR + object_key.split('/')[-1]
@@ -483,30 +965,48 @@ class PCAResults:
         # Loop around each defined segment in the JSON, and create a new data structure
         self.speech_segments = []
         for next_segment in json_data["SpeechSegments"]:
-            new_segment = SpeechSegment()
-
-            # Standard segment data
-            new_segment.segmentStartTime = float(next_segment["SegmentStartTime"])
-            new_segment.segmentEndTime = float(next_segment["SegmentEndTime"])
-            new_segment.segmentSpeaker = next_segment["SegmentSpeaker"]
-            new_segment.segmentInterruption = bool(next_segment["SegmentInterruption"])
-            new_segment.segmentText = next_segment["OriginalText"]
-            new_segment.segmentLoudnessScores = next_segment["LoudnessScores"]
-            new_segment.segmentIsPositive = bool(next_segment["SentimentIsPositive"])
-            new_segment.segmentIsNegative = bool(next_segment["SentimentIsNegative"])
-            new_segment.segmentSentimentScore = float(next_segment["SentimentScore"])
-            new_segment.segmentAllSentiments = next_segment["BaseSentimentScores"]
-            new_segment.segmentCustomEntities = next_segment["EntitiesDetected"]
-            new_segment.segmentCategoriesDetectedPre = next_segment["CategoriesDetected"]
-            new_segment.segmentCategoriesDetectedPost = next_segment["FollowOnCategories"]
-            new_segment.segmentIssuesDetected = next_segment["IssuesDetected"]
-            new_segment.segmentActionItemsDetected = next_segment["ActionItemsDetected"]
-            new_segment.segmentOutcomesDetected = next_segment["OutcomesDetected"]
-            new_segment.segmentConfidence = next_segment["WordConfidence"]
-
-            # Additional segment data (not in original version)
-            if "IVRSegment" in next_segment:
-                new_segment.segmentIVR = bool(next_segment["IVRSegment"])
+            self.speech_segments.append(self.parse_speech_segment_input(next_segment))
+
+        # Word-level confidence data may be held separately
+        if "WordConfidenceSidecar" in json_data:
+            self.word_confidence_bucket = bucket
+            self.word_confidence_key = json_data["WordConfidenceSidecar"]
+            if load_word_confidence and not offline:
+                self.load_word_confidence_from_s3()
+        else:
+            self.word_confidence_bucket = None
+            self.word_confidence_key = None
 
-            # Add what we have to the full list
-            self.speech_segments.append(new_segment)
+    def parse_speech_segment_input(self, next_segment):
+        """
+        Creates the internal data structure for a single speech segment from the supplied JSON fragment
+
+        :param next_segment: Single entry from the "SpeechSegments" block of a PCA results file
+        :return: New SpeechSegment instance
+        """
+        new_segment = SpeechSegment()
+
+        # Standard segment data
+        new_segment.segmentStartTime = float(next_segment["SegmentStartTime"])
+        new_segment.segmentEndTime = float(next_segment["SegmentEndTime"])
+        new_segment.segmentSpeaker = next_segment["SegmentSpeaker"]
+        new_segment.segmentInterruption = bool(next_segment["SegmentInterruption"])
+        new_segment.segmentText = next_segment["OriginalText"]
+        new_segment.segmentLoudnessScores = next_segment["LoudnessScores"]
+        new_segment.segmentIsPositive = bool(next_segment["SentimentIsPositive"])
+        new_segment.segmentIsNegative = bool(next_segment["SentimentIsNegative"])
+        new_segment.segmentSentimentScore = float(next_segment["SentimentScore"])
+        new_segment.segmentAllSentiments = next_segment["BaseSentimentScores"]
+        new_segment.segmentCustomEntities = next_segment["EntitiesDetected"]
+        new_segment.segmentCategoriesDetectedPre = next_segment["CategoriesDetected"]
+        new_segment.segmentCategoriesDetectedPost = next_segment["FollowOnCategories"]
+        new_segment.segmentIssuesDetected = next_segment["IssuesDetected"]
+        new_segment.segmentActionItemsDetected = next_segment["ActionItemsDetected"]
+        new_segment.segmentOutcomesDetected = next_segment["OutcomesDetected"]
+        new_segment.segmentConfidence = next_segment.get("WordConfidence", [])
+
+        # Additional segment data (not in original version)
+        if "IVRSegment" in next_segment:
+            new_segment.segmentIVR = bool(next_segment["IVRSegment"])
+
+        return new_segment
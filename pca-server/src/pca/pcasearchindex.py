@@ -0,0 +1,345 @@
+"""
+This python module maintains an embedded full-text search index of call transcripts, which can be used instead of
+Amazon Kendra.  The index is a SQLite database with an FTS5 table, where every speech segment of a call is a row
+holding its text, speaker, time offsets, sentiment and entities, so a search returns the matching segments along with
+where they are in each call.
+
+Each time a call's final results are written its rows are written to S3 as a small update file, so that results
+processing never has to wait for the index.  The compactor function periodically applies the pending updates to the
+database, replacing any earlier rows for those calls, optimises it and writes it back to S3.  The query function
+downloads the database whenever it has changed and runs searches against its local copy.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+import boto3
+import pcaconfiguration as cf
+
+# Optional transcript search index - "auto" enables it whenever there is no Kendra index
+SEARCH_INDEX = os.getenv("SEARCH_INDEX", "false")
+SEARCH_INDEX_PREFIX = "searchIndex"
+SEARCH_INDEX_DATABASE_KEY = SEARCH_INDEX_PREFIX + "/transcripts.db"
+SEARCH_INDEX_PENDING_PREFIX = SEARCH_INDEX_PREFIX + "/pending/"
+SEARCH_INDEX_LOCAL_FILE = "/tmp/transcripts.db"
+SEARCH_INDEX_REFRESH_SECONDS = int(os.getenv("SEARCH_INDEX_REFRESH_SECONDS", "60"))
+SEARCH_DEFAULT_RESULTS = 25
+SEARCH_MAX_RESULTS = 250
+
+# The database is rebuilt from scratch if its free space reaches this fraction of its size
+SEARCH_INDEX_VACUUM_RATIO = 0.25
+
+SEARCH_INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS calls (
+        call_id TEXT PRIMARY KEY,
+        results_key TEXT,
+        analysis_uri TEXT,
+        guid TEXT,
+        agent TEXT,
+        cust TEXT,
+        conversation_time TEXT,
+        duration REAL,
+        language_code TEXT,
+        updated TEXT)""",
+    """CREATE TABLE IF NOT EXISTS segments (
+        id INTEGER PRIMARY KEY,
+        call_id TEXT NOT NULL,
+        segment INTEGER,
+        speaker TEXT,
+        start_time REAL,
+        end_time REAL,
+        sentiment TEXT,
+        sentiment_score REAL,
+        entities TEXT,
+        text TEXT)""",
+    "CREATE INDEX IF NOT EXISTS segments_call ON segments (call_id)",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(
+        text, entities, content='segments', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON segments BEGIN
+        INSERT INTO segments_fts (rowid, text, entities) VALUES (new.id, new.text, new.entities);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON segments BEGIN
+        INSERT INTO segments_fts (segments_fts, rowid, text, entities) VALUES ('delete', old.id, old.text,
+                                                                               old.entities);
+    END"""
+]
+
+# Local copy of the database used by queries, along with its S3 ETag and when we last checked that
+SEARCH_INDEX_CACHE = {}
+
+
+def is_search_index_enabled():
+    """
+    Returns flag to indicate if calls should be added to the transcript search index.  Configuration must already
+    have been loaded before this is called.
+    """
+    if SEARCH_INDEX.lower() == "auto":
+        return cf.appConfig.get(cf.CONF_KENDRA_INDEX_ID, "None") == "None"
+    return SEARCH_INDEX.lower() == "true"
+
+
+def get_search_call_id(results_key):
+    """
+    Returns the id of a call in the search index, which is the filename of its parsed results file
+
+    :param results_key: S3 key of the parsed results file
+    :return: Id of the call in the search index
+    """
+    return results_key.split("/")[-1]
+
+
+def create_search_index_update(results_key, json_data):
+    """
+    Creates the search index update for a call from its results, which has one row for each speech segment
+
+    :param results_key: S3 key of the parsed results file
+    :param json_data: JSON results, with [ConversationAnalytics] and [SpeechSegments] blocks
+    :return: Search index update for the call
+    """
+    analytics = json_data["ConversationAnalytics"]
+    call_id = get_search_call_id(results_key)
+    speaker_names = {label["Speaker"]: label.get("DisplayText", label["Speaker"])
+                     for label in analytics.get("SpeakerLabels", [])}
+
+    segments = []
+    for segment_number, segment in enumerate(json_data["SpeechSegments"]):
+        if segment["SentimentIsPositive"]:
+            sentiment = "positive"
+        elif segment["SentimentIsNegative"]:
+            sentiment = "negative"
+        else:
+            sentiment = "neutral"
+        entities = "\n".join(f"{entity['Type']}: {entity['Text']}" for entity in segment["EntitiesDetected"])
+        segments.append({"segment": segment_number,
+                         "speaker": speaker_names.get(segment["SegmentSpeaker"], segment["SegmentSpeaker"]),
+                         "startTime": segment["SegmentStartTime"],
+                         "endTime": segment["SegmentEndTime"],
+                         "sentiment": sentiment,
+                         "sentimentScore": segment["SentimentScore"],
+                         "entities": entities,
+                         "text": segment["DisplayText"]})
+
+    return {"callId": call_id,
+            "call": {"resultsKey": results_key,
+                     "analysisUri": f"{cf.appConfig.get(cf.CONF_WEB_URI, '')}dashboard/parsedFiles/{call_id}",
+                     "guid": analytics.get("GUID", ""),
+                     "agent": analytics.get("Agent", ""),
+                     "cust": analytics.get("Cust", ""),
+                     "conversationTime": analytics.get("ConversationTime", ""),
+                     "duration": float(analytics.get("Duration", 0.0)),
+                     "languageCode": analytics.get("LanguageCode", ""),
+                     "updated": datetime.now(timezone.utc).isoformat()},
+            "segments": segments}
+
+
+def write_search_index_update(bucket, results_key, json_data):
+    """
+    Writes a call's search index update to the pending folder, ready for the compactor.  Keys start with the time,
+    so that the compactor applies the updates in the order that they were written
+
+    :param bucket: Bucket holding the search index
+    :param results_key: S3 key of the parsed results file
+    :param json_data: JSON results, with [ConversationAnalytics] and [SpeechSegments] blocks
+    :return: S3 key of the update file
+    """
+    update = create_search_index_update(results_key, json_data)
+    update_key = f"{SEARCH_INDEX_PENDING_PREFIX}{int(time.time() * 1000):013d}-{update['callId']}.json"
+    boto3.client("s3").put_object(Bucket=bucket, Key=update_key, Body=json.dumps(update).encode("utf-8"))
+    return update_key
+
+
+def open_search_index(path, read_only=False):
+    """
+    Opens a search index database, creating its tables if they don't exist yet
+
+    :param path: Local path of the database file
+    :param read_only: Open the database for queries only
+    :return: SQLite connection to the database
+    """
+    if read_only:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        connection = sqlite3.connect(path)
+        with connection:
+            for statement in SEARCH_INDEX_SCHEMA:
+                connection.execute(statement)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def apply_search_index_updates(connection, updates):
+    """
+    Applies search index updates to the database in a single transaction.  Each update replaces all of the rows
+    for its call, so if a call has been updated more than once then the last one wins
+
+    :param connection: SQLite connection to the database
+    :param updates: List of search index updates, in the order that they were written
+    """
+    with connection:
+        for update in updates:
+            call = update["call"]
+            connection.execute("DELETE FROM segments WHERE call_id = ?", (update["callId"],))
+            connection.execute("INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (update["callId"], call["resultsKey"], call["analysisUri"], call["guid"],
+                                call["agent"], call["cust"], call["conversationTime"], call["duration"],
+                                call["languageCode"], call["updated"]))
+            connection.executemany("INSERT INTO segments (call_id, segment, speaker, start_time, end_time, sentiment,"
+                                   " sentiment_score, entities, text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(update["callId"], segment["segment"], segment["speaker"], segment["startTime"],
+                                     segment["endTime"], segment["sentiment"], segment["sentimentScore"],
+                                     segment["entities"], segment["text"]) for segment in update["segments"]])
+
+
+def compact_search_index(connection):
+    """
+    Merges the FTS index into as few b-trees as possible, which keeps queries fast as calls are added, and
+    rebuilds the database if replaced calls have left too much free space in it
+
+    :param connection: SQLite connection to the database
+    """
+    with connection:
+        connection.execute("INSERT INTO segments_fts (segments_fts) VALUES ('optimize')")
+    page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    if page_count and (free_pages / page_count >= SEARCH_INDEX_VACUUM_RATIO):
+        connection.execute("VACUUM")
+
+
+def get_fts_query(query):
+    """
+    Turns plain search text into an FTS5 query that matches all of its words, for when the text isn't
+    valid FTS5 query syntax
+
+    :param query: Search text
+    :return: FTS5 query
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def search_transcripts(connection, query, speaker=None, sentiment=None, call_id=None, limit=SEARCH_DEFAULT_RESULTS):
+    """
+    Searches the transcript index, returning the best matching speech segments first.  The query can use the FTS5
+    query syntax, such as phrases, prefixes, NEAR and the column filters "text:" and "entities:", and if it isn't
+    valid syntax then it matches segments containing all of its words
+
+    :param connection: SQLite connection to the database
+    :param query: Search query
+    :param speaker: Only return segments from this speaker
+    :param sentiment: Only return segments with this sentiment - positive, negative or neutral
+    :param call_id: Only return segments from this call
+    :param limit: Maximum number of segments to return
+    :return: List of matching segments, with their call details and time offsets
+    """
+    sql = ("SELECT s.call_id, s.segment, s.speaker, s.start_time, s.end_time, s.sentiment, s.sentiment_score,"
+           " s.entities, s.text, snippet(segments_fts, 0, '<em>', '</em>', '...', 24) AS snippet,"
+           " bm25(segments_fts) AS score, c.results_key, c.analysis_uri, c.guid, c.agent, c.cust,"
+           " c.conversation_time"
+           " FROM segments_fts JOIN segments s ON s.id = segments_fts.rowid JOIN calls c ON c.call_id = s.call_id"
+           " WHERE segments_fts MATCH ?")
+    filters = []
+    for column, value in [("s.speaker", speaker), ("s.sentiment", sentiment), ("s.call_id", call_id)]:
+        if value:
+            sql += f" AND {column} = ?"
+            filters.append(value)
+    sql += " ORDER BY score LIMIT ?"
+    limit = max(1, min(int(limit), SEARCH_MAX_RESULTS))
+
+    try:
+        rows = connection.execute(sql, [query] + filters + [limit]).fetchall()
+    except sqlite3.OperationalError:
+        # Not valid FTS5 syntax, so just search for the words
+        rows = connection.execute(sql, [get_fts_query(query)] + filters + [limit]).fetchall()
+
+    results = []
+    for row in rows:
+        results.append({"callId": row["call_id"],
+                        "resultsKey": row["results_key"],
+                        "analysisUri": row["analysis_uri"],
+                        "guid": row["guid"],
+                        "agent": row["agent"],
+                        "cust": row["cust"],
+                        "conversationTime": row["conversation_time"],
+                        "segment": row["segment"],
+                        "speaker": row["speaker"],
+                        "startTime": row["start_time"],
+                        "endTime": row["end_time"],
+                        "sentiment": row["sentiment"],
+                        "sentimentScore": row["sentiment_score"],
+                        "entities": [{"Type": entity.split(": ", 1)[0], "Text": entity.split(": ", 1)[-1]}
+                                     for entity in row["entities"].split("\n") if entity],
+                        "text": row["text"],
+                        "snippet": row["snippet"],
+                        "score": row["score"]})
+    return results
+
+
+def download_search_index(bucket, path):
+    """
+    Downloads the search index database from S3 to a local file
+
+    :param bucket: Bucket holding the search index
+    :param path: Local path to write the database to
+    :return: ETag of the downloaded database, or None if there isn't one yet
+    """
+    s3_client = boto3.client("s3")
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=SEARCH_INDEX_DATABASE_KEY)
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "NoSuchKey":
+            return None
+        raise
+
+    # Write to a temporary file first, so a failed download never leaves a partial database behind
+    temp_path = path + ".download"
+    with open(temp_path, "wb") as database_file:
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            database_file.write(chunk)
+    os.replace(temp_path, path)
+    return response["ETag"]
+
+
+def upload_search_index(bucket, path):
+    """
+    Uploads a local search index database to S3, replacing the current one
+
+    :param bucket: Bucket holding the search index
+    :param path: Local path of the database
+    """
+    boto3.client("s3").upload_file(path, bucket, SEARCH_INDEX_DATABASE_KEY)
+
+
+def load_search_index(bucket):
+    """
+    Returns a read-only connection to a local copy of the search index for queries.  The copy is kept between
+    invocations, and only downloaded again if the database in S3 has changed - this is only checked every
+    SEARCH_INDEX_REFRESH_SECONDS, so most queries never leave the function
+
+    :param bucket: Bucket holding the search index
+    :return: SQLite connection to the database, or None if there isn't a database yet
+    """
+    now = time.time()
+    if SEARCH_INDEX_CACHE.get("checked", 0) + SEARCH_INDEX_REFRESH_SECONDS > now:
+        return SEARCH_INDEX_CACHE.get("connection")
+
+    try:
+        etag = boto3.client("s3").head_object(Bucket=bucket, Key=SEARCH_INDEX_DATABASE_KEY)["ETag"]
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") not in ["404", "NoSuchKey"]:
+            raise
+        etag = None
+
+    if etag != SEARCH_INDEX_CACHE.get("etag"):
+        if SEARCH_INDEX_CACHE.get("connection") is not None:
+            SEARCH_INDEX_CACHE["connection"].close()
+        SEARCH_INDEX_CACHE["connection"] = None
+        if etag is not None:
+            etag = download_search_index(bucket, SEARCH_INDEX_LOCAL_FILE)
+            SEARCH_INDEX_CACHE["connection"] = open_search_index(SEARCH_INDEX_LOCAL_FILE, read_only=True)
+        SEARCH_INDEX_CACHE["etag"] = etag
+
+    SEARCH_INDEX_CACHE["checked"] = now
+    return SEARCH_INDEX_CACHE["connection"]
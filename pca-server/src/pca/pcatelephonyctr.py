@@ -0,0 +1,189 @@
+"""
+This python module loads and indexes the Contact Trace Record (CTR) files supplied by a telephony system, which are
+used by the telephony-specific steps of the main processing workflow.  A call's CTR files are fetched concurrently,
+and each is parsed just once into an index holding only what those steps need - for Genesys that is the IVR, ACD and
+agent speaking intervals, already converted to timestamps, along with the customer, queue and call identifiers.
+
+The index is small enough to be passed between workflow steps, so the transcript processing step can prefetch it
+while it is working and hand it on, which saves the telephony step from having to fetch and parse the files itself.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import boto3
+import pcaconfiguration as cf
+
+# Where offline CTR files are read from, and the largest index that we will pass between workflow steps
+TMP_DIR = "/tmp/"
+CTR_INDEX_MAX_BYTES = 32768
+
+
+def get_ctr_filenames(original_file):
+    """
+    Works out the names of the CTR files for an audio file, which are named the same as the audio file with
+    the configured suffixes - the first is the conversation CTR and the second is the call-specific CTR
+
+    :param original_file: Full S3 key for the call audio file
+    :return: S3 keys for the conversation CTR and call CTR files
+    """
+    suffixes = cf.appConfig[cf.CONF_TELEPHONY_CTR_SUFFIX]
+    conv_suffix = suffixes[0] if len(suffixes) > 0 else ""
+    call_suffix = suffixes[1] if len(suffixes) > 1 else ""
+    return original_file + conv_suffix, original_file + call_suffix
+
+
+def load_ctr_file(ctr_filename, offline=False):
+    """
+    Loads the JSON data from a CTR file in the input bucket, or from our temporary folder when offline
+
+    :param ctr_filename: Name of S3 file for this specific CTR file
+    :param offline: Flag to indicate that the file should be read locally
+    :return: JSON data from this file
+    """
+    if offline:
+        json_filepath = Path(TMP_DIR + ctr_filename.split("/")[-1])
+        with open(json_filepath.absolute(), "r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+
+    response = boto3.client("s3").get_object(Bucket=cf.appConfig[cf.CONF_S3BUCKET_INPUT], Key=ctr_filename)
+    return json.loads(response["Body"].read().decode("utf-8"))
+
+
+def load_ctr_files(original_file, offline=False):
+    """
+    Loads the conversation and call CTR files for the specified audio file at the same time.  Both are needed,
+    so if either can't be loaded then neither is returned
+
+    :param original_file: Full S3 key for the call audio file
+    :param offline: Flag to indicate that the files should be read locally
+    :return: JSON structures for the Conversation CTR and Call CTR files, which are empty if not loaded
+    """
+    conv_ctr_filename, call_ctr_filename = get_ctr_filenames(original_file)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        conv_stage = executor.submit(load_ctr_file, conv_ctr_filename, offline)
+        call_stage = executor.submit(load_ctr_file, call_ctr_filename, offline)
+
+    try:
+        conv_ctr_json = conv_stage.result()
+    except Exception as e:
+        # Exception, most likely file doesn't exist
+        print(f"Unable to load/parse Genesys conversation CTR file '{conv_ctr_filename}'\n{e}")
+        return [], []
+
+    try:
+        call_ctr_json = call_stage.result()
+    except Exception as e:
+        # Exception, most likely file doesn't exist
+        print(f"Unable to load/parse Genesys call CTR file '{call_ctr_filename}'\n{e}")
+        return [], []
+
+    return conv_ctr_json, call_ctr_json
+
+
+def parse_genesys_ctr_datetime(call_time, conv_ctr=True):
+    """
+    Extracts the timestamp from a Genesys CTR datetime string.  Typically, the expression for this string format
+    is "%Y-%m-%dT%H:%M:%S.%fZ", but it has been seen in Genesys CTR files that some entries do not have a microsecond
+    component.  Hence, we may have to try several parse options.
+
+    :param call_time: CTR datetime string
+    :return: Datetime object representing the CTR datetime string
+    """
+
+    # If there's a "+" in the time then go with that format
+    if "+" in call_time:
+        dt_text = call_time.split("+")[0]
+        genesys_call_time = datetime.strptime(dt_text, "%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        # Otherwise try the standard "Z" style format
+        try:
+            # Try first with times that have a microsecond part (which is normal)
+            genesys_call_time = datetime.strptime(call_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+        except ValueError:
+            # If that fails then try again without the microsecond (which is unusual, but happens)
+            genesys_call_time = datetime.strptime(call_time, "%Y-%m-%dT%H:%M:%SZ").replace(microsecond=1)
+
+    return genesys_call_time
+
+
+def get_segment_interval(segment):
+    """
+    Converts the start and end times of a Genesys CTR segment into timestamps
+
+    :param segment: CTR session segment
+    :return: [start, end] timestamps
+    """
+    return [parse_genesys_ctr_datetime(segment["segmentStart"]).timestamp(),
+            parse_genesys_ctr_datetime(segment["segmentEnd"]).timestamp()]
+
+
+def build_genesys_ctr_index(conv_ctr_json, call_ctr_json):
+    """
+    Parses the Genesys conversation and call CTR files into the index used by the Genesys CTR step.  This walks the
+    participants, sessions and segments just once.  Intervals are kept in their CTR order, as the order in which
+    they are applied to the speech segments matters when they overlap
+
+    :param conv_ctr_json: Genesys conversation CTR data
+    :param call_ctr_json: Genesys call CTR data
+    :return: Index of the CTR data
+    """
+    ctr_index = {"conversationStart": conv_ctr_json["conversationStart"],
+                 "originatingDirection": conv_ctr_json["originatingDirection"],
+                 "call": {"id": call_ctr_json["id"], "conversationId": call_ctr_json["conversationId"],
+                          "startTime": call_ctr_json["startTime"], "endTime": call_ctr_json["endTime"]},
+                 "hasIvr": False, "ivrIntervals": [], "acdIntervals": [], "agents": [], "customer": None,
+                 "queueIds": []}
+
+    for participant in conv_ctr_json["participants"]:
+        purpose = participant["purpose"]
+        if purpose == "ivr":
+            # IVR speaking times are its "ivr" segments - "system" ones aren't voice
+            ctr_index["hasIvr"] = True
+            ctr_index["ivrIntervals"] += [get_segment_interval(segment) for session in participant["sessions"]
+                                          for segment in session["segments"] if segment["segmentType"] == "ivr"]
+        elif purpose == "acd":
+            # ACD times aren't strictly IVR entries, but the caller is still hearing an automated voice
+            ctr_index["hasIvr"] = True
+            ctr_index["acdIntervals"] += [get_segment_interval(segment) for session in participant["sessions"]
+                                          for segment in session["segments"] if segment["segmentType"] == "interact"]
+        elif purpose == "agent":
+            # Agent speaking times are the "interact" segments of their voice sessions
+            ctr_index["agents"].append({"userId": participant["userId"],
+                                        "intervals": [get_segment_interval(segment)
+                                                      for session in participant["sessions"]
+                                                      if session["mediaType"] == "voice"
+                                                      for segment in session["segments"]
+                                                      if segment["segmentType"] == "interact"]})
+        elif (purpose == "customer") and (ctr_index["customer"] is None):
+            ctr_index["customer"] = {"participantId": participant["participantId"]}
+
+        # Collect the unique queue ids from every participant
+        for session in participant["sessions"]:
+            for segment in session["segments"]:
+                if ("queueId" in segment) and (segment["queueId"] not in ctr_index["queueIds"]):
+                    ctr_index["queueIds"].append(segment["queueId"])
+
+    return ctr_index
+
+
+def prefetch_genesys_ctr_index(original_file):
+    """
+    Loads and indexes the Genesys CTR files for an audio file ahead of the Genesys CTR step.  This never fails, as
+    that step will just load the files itself if there's no index, and an index too large to pass on is dropped
+
+    :param original_file: Full S3 key for the call audio file
+    :return: Index of the CTR data, or None if there isn't one
+    """
+    try:
+        conv_ctr_json, call_ctr_json = load_ctr_files(original_file)
+        if conv_ctr_json:
+            ctr_index = build_genesys_ctr_index(conv_ctr_json, call_ctr_json)
+            if len(json.dumps(ctr_index)) <= CTR_INDEX_MAX_BYTES:
+                return ctr_index
+    except Exception as e:
+        print(f"Unable to prefetch Genesys CTR files, leaving them for the CTR step: {e}")
+    return None
@@ -0,0 +1,243 @@
+"""
+This python function is part of the main processing workflow.  It maintains a catalog of the Amazon Transcribe
+resources - Custom Language Models, custom vocabularies and vocabulary filters - that match our configured base
+names, so that submitting a job does not need to query Transcribe for every language of every file.
+
+The catalog is built with one list call per resource type, regardless of the number of languages, and is cached
+across warm Lambda invocations.  Once it passes half of its lifetime it is refreshed on a background thread, and
+the cached copy is used until a refresh completes.  If a table name is configured then the catalog is also shared
+between Lambda containers via the DynamoDB tracking table.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+import threading
+import time
+import boto3
+import pcaconfiguration as cf
+
+# Catalog lifetime, and optional DynamoDB table that is used to share it
+CATALOG_TTL_SECONDS = int(os.getenv("CATALOG_TTL_SECONDS", "300"))
+CATALOG_TABLE_NAME = os.getenv("CATALOG_TABLE_NAME", "")
+CATALOG_TABLE_PK = "catalog#transcribe-resources"
+CATALOG_TABLE_SK = "catalog"
+
+# Cached catalog for this Lambda container, and the lock that protects it
+cached_catalog = None
+catalog_lock = threading.Lock()
+background_refresh = None
+
+
+class TranscribeCatalog:
+    """ Class to hold the Transcribe resources that match our configured base names """
+    def __init__(self, base_names, models, vocabularies, vocabulary_filters, created_at):
+        self.base_names = base_names
+        self.models = models
+        self.vocabularies = vocabularies
+        self.vocabulary_filters = vocabulary_filters
+        self.created_at = created_at
+
+    def get_age(self):
+        """
+        Returns the age of this catalog in seconds
+        """
+        return time.time() - self.created_at
+
+    def has_vocabulary(self, vocab_name):
+        """
+        Returns flag to indicate if the named custom vocabulary exists and is ready for use
+        """
+        return vocab_name in self.vocabularies
+
+    def has_vocabulary_filter(self, vocab_filter_name):
+        """
+        Returns flag to indicate if the named vocabulary filter exists
+        """
+        return vocab_filter_name in self.vocabulary_filters
+
+    def create_json_output(self):
+        """
+        Generates the JSON representation of the catalog, which is used when sharing it
+        """
+        return {"BaseNames": self.base_names,
+                "Models": self.models,
+                "Vocabularies": self.vocabularies,
+                "VocabularyFilters": self.vocabulary_filters,
+                "CreatedAt": self.created_at}
+
+    @staticmethod
+    def parse_json_input(json_input):
+        """
+        Creates a catalog from its JSON representation
+        """
+        return TranscribeCatalog(json_input["BaseNames"], json_input["Models"], json_input["Vocabularies"],
+                                 json_input["VocabularyFilters"], float(json_input["CreatedAt"]))
+
+
+def get_configured_base_names():
+    """
+    Returns the configured resource base names, as a catalog built for other names cannot be used
+    """
+    return {"CLM": cf.appConfig[cf.CONF_CLMNAME],
+            "Vocabulary": cf.appConfig[cf.CONF_VOCABNAME],
+            "VocabularyFilter": cf.appConfig[cf.CONF_FILTER_NAME]}
+
+
+def list_all(list_method, result_key, base_name, **kwargs):
+    """
+    Calls one of the Transcribe list APIs, following any pagination, filtering by our base name if we have one
+
+    :param list_method: Boto3 Transcribe client list method
+    :param result_key: Key in the response that holds the results list
+    :param base_name: Configured base name of the resource type
+    :return: Full list of results
+    """
+    if base_name != "":
+        kwargs["NameContains"] = base_name
+
+    results = []
+    while True:
+        response = list_method(**kwargs)
+        results += response[result_key]
+        if "NextToken" not in response:
+            break
+        kwargs["NextToken"] = response["NextToken"]
+
+    return results
+
+
+def build_catalog(transcribe_client):
+    """
+    Builds a new catalog by querying Transcribe for each type of resource
+
+    :param transcribe_client: Boto3 client for Transcribe
+    :return: New TranscribeCatalog
+    """
+    base_names = get_configured_base_names()
+    models = list_all(transcribe_client.list_language_models, "Models", base_names["CLM"],
+                      StatusEquals="COMPLETED")
+    vocabularies = list_all(transcribe_client.list_vocabularies, "Vocabularies", base_names["Vocabulary"],
+                            StateEquals="READY")
+    vocabulary_filters = list_all(transcribe_client.list_vocabulary_filters, "VocabularyFilters",
+                                  base_names["VocabularyFilter"])
+
+    # Only keep what we need from each resource
+    return TranscribeCatalog(base_names,
+                             [{"ModelName": model["ModelName"],
+                               "LanguageCode": model["LanguageCode"],
+                               "BaseModelName": model["BaseModelName"]} for model in models],
+                             [vocab["VocabularyName"] for vocab in vocabularies],
+                             [vocab_filter["VocabularyFilterName"] for vocab_filter in vocabulary_filters],
+                             time.time())
+
+
+def load_shared_catalog():
+    """
+    Loads the shared catalog from our table, if one has been configured
+
+    :return: Shared TranscribeCatalog, or None if there isn't one
+    """
+    if CATALOG_TABLE_NAME == "":
+        return None
+
+    try:
+        table = boto3.resource("dynamodb").Table(CATALOG_TABLE_NAME)
+        response = table.get_item(Key={"PKJobId": CATALOG_TABLE_PK, "SKApiMode": CATALOG_TABLE_SK})
+        if "Item" in response:
+            return TranscribeCatalog.parse_json_input(json.loads(response["Item"]["Catalog"]))
+    except Exception as e:
+        print(f"Unable to load shared Transcribe catalog: {str(e)}")
+
+    return None
+
+
+def save_shared_catalog(catalog):
+    """
+    Saves a newly-built catalog to our table, if one has been configured
+
+    :param catalog: TranscribeCatalog to be shared
+    """
+    if CATALOG_TABLE_NAME == "":
+        return
+
+    try:
+        table = boto3.resource("dynamodb").Table(CATALOG_TABLE_NAME)
+        table.put_item(Item={"PKJobId": CATALOG_TABLE_PK,
+                             "SKApiMode": CATALOG_TABLE_SK,
+                             "Catalog": json.dumps(catalog.create_json_output())})
+    except Exception as e:
+        print(f"Unable to save shared Transcribe catalog: {str(e)}")
+
+
+def is_catalog_usable(catalog, max_age):
+    """
+    Checks that a catalog exists, was built for our configured base names, and is no older than the given age
+    """
+    return (catalog is not None) and (catalog.base_names == get_configured_base_names()) and \
+        (catalog.get_age() < max_age)
+
+
+def refresh_catalog(transcribe_client):
+    """
+    Refreshes our cached catalog, preferring a fresh-enough shared catalog over querying Transcribe
+
+    :param transcribe_client: Boto3 client for Transcribe
+    :return: Refreshed TranscribeCatalog
+    """
+    global cached_catalog
+
+    catalog = load_shared_catalog()
+    if not is_catalog_usable(catalog, CATALOG_TTL_SECONDS / 2):
+        catalog = build_catalog(transcribe_client)
+        save_shared_catalog(catalog)
+        print(f"Built Transcribe catalog with {len(catalog.models)} CLM(s), {len(catalog.vocabularies)} "
+              f"vocabularies and {len(catalog.vocabulary_filters)} vocabulary filter(s)")
+
+    with catalog_lock:
+        cached_catalog = catalog
+
+    return catalog
+
+
+def refresh_in_background(transcribe_client):
+    """
+    Background thread target that refreshes the catalog, but leaves the existing one in place on failure
+    """
+    try:
+        refresh_catalog(transcribe_client)
+    except Exception as e:
+        print(f"Background refresh of Transcribe catalog failed: {str(e)}")
+
+
+def get_catalog(transcribe_client):
+    """
+    Returns the current catalog of Transcribe resources.  A catalog that has passed half of its lifetime is
+    still used, but a background refresh is started; one that has expired is refreshed before returning.  If
+    that refresh fails then an expired catalog is used rather than failing the job submission
+
+    :param transcribe_client: Boto3 client for Transcribe
+    :return: TranscribeCatalog
+    """
+    global background_refresh
+
+    with catalog_lock:
+        catalog = cached_catalog
+
+    if is_catalog_usable(catalog, CATALOG_TTL_SECONDS / 2):
+        return catalog
+    elif is_catalog_usable(catalog, CATALOG_TTL_SECONDS):
+        if (background_refresh is None) or not background_refresh.is_alive():
+            background_refresh = threading.Thread(target=refresh_in_background, args=(transcribe_client,),
+                                                  daemon=True)
+            background_refresh.start()
+        return catalog
+
+    try:
+        return refresh_catalog(transcribe_client)
+    except Exception as e:
+        if (catalog is not None) and (catalog.base_names == get_configured_base_names()):
+            print(f"Unable to refresh Transcribe catalog, using expired copy: {str(e)}")
+            return catalog
+        raise
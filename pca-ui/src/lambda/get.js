@@ -4,6 +4,27 @@ const s3 = new AWS.S3({signatureVersion: 'v4'});
 const dataBucket = process.env.DataBucket;
 const audioBucket = process.env.AudioBucket;
 
+async function loadWordConfidence(data) {
+    // Per-word confidence data may have been written to a columnar sidecar file
+    const res = await s3
+        .getObject({
+            Bucket: dataBucket,
+            Key: data.WordConfidenceSidecar,
+        })
+        .promise();
+    const sidecar = JSON.parse(res.Body.toString());
+
+    data.SpeechSegments.forEach((segment, index) => {
+        const columns = sidecar.Segments[index];
+        segment.WordConfidence = columns.Text.map((text, word) => ({
+            Text: text,
+            Confidence: columns.Confidence[word],
+            StartTime: columns.StartTime[word],
+            EndTime: columns.EndTime[word],
+        }));
+    });
+}
+
 async function getData(key) {
     let res;
     try {
@@ -23,6 +44,14 @@ async function getData(key) {
 
     const data = JSON.parse(res.Body.toString());
 
+    if (data.WordConfidenceSidecar) {
+        try {
+            await loadWordConfidence(data);
+        } catch (e) {
+            console.log("Unable to load word confidence sidecar:", e);
+        }
+    }
+
     const jobInfo =
         data.ConversationAnalytics.SourceInformation[0].TranscribeJobInfo;
 
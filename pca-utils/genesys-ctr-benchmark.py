@@ -0,0 +1,267 @@
+"""
+This script checks that the Genesys CTR step's interval matching gives the same results as an earlier version of it,
+and times the two.  It generates synthetic calls, each with a random set of speech segments and a Genesys CTR with
+overlapping IVR, ACD and agent intervals, and then runs the IVR extraction and multiple-agent handling of both the
+current step and the one in the given git revision, such as the last one before the intervals were swept against
+start-ordered segments, over copies of each call.  The resulting speech segments, speaker labels, agent count and
+customer id must be identical, and the larger calls are then timed.  Speaker times are not compared, as the step now
+keeps them up to date differently, so instead the current step's times must match its speech segment durations.
+
+It needs the same Python packages as the PCA server functions, and must be run from inside this git repository:
+
+    python genesys-ctr-benchmark.py --baseline-ref <revision> [--calls <count>]
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = subprocess.run(["git", "rev-parse", "--show-toplevel"], capture_output=True, text=True,
+                           check=True).stdout.strip()
+PCA_SOURCE_DIR = os.path.join(REPO_ROOT, "pca-server", "src", "pca")
+GENESYS_STEP_PATH = "pca-server/src/pca/pca-aws-sf-ctr-genesys.py"
+sys.path.insert(0, PCA_SOURCE_DIR)
+
+import pcaconfiguration as cf
+import pcaresults
+import pcatelephonyctr
+
+# Synthetic calls all start at the same time, and these are the sizes of the calls that are timed
+CALL_START = datetime(2024, 1, 1, 10, 0, 0)
+BENCHMARK_CALLS = [(500, 50, 3), (2000, 200, 4), (5000, 500, 6)]
+
+
+def load_module(name, path):
+    """
+    Loads a Python module from a file, as the step's filename isn't a valid module name
+
+    :param name: Name to give the module
+    :param path: Path of the module's file
+    :return: Loaded module
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_baseline_module(ref):
+    """
+    Loads the Genesys CTR step as it was in an earlier git revision
+
+    :param ref: Git revision holding the baseline version of the step
+    :return: Loaded module
+    """
+    source = subprocess.run(["git", "show", f"{ref}:{GENESYS_STEP_PATH}"], cwd=REPO_ROOT, capture_output=True,
+                            text=True, check=True).stdout
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as baseline_file:
+        baseline_file.write(source)
+    try:
+        return load_module("genesys_baseline", baseline_file.name)
+    finally:
+        os.remove(baseline_file.name)
+
+
+def timestamp(offset):
+    """
+    Returns a Genesys CTR timestamp for a number of seconds into the call
+
+    :param offset: Seconds from the start of the call
+    :return: Timestamp string
+    """
+    return (CALL_START + timedelta(seconds=offset)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def create_call(seed, segment_count, ivr_count, agent_count):
+    """
+    Generates a synthetic call, with its speech segments split between the agent and customer channels, and a
+    conversation CTR whose IVR, ACD and agent intervals are scattered across the call and overlap each other
+
+    :param seed: Random number seed for this call
+    :param segment_count: Number of speech segments
+    :param ivr_count: Number of IVR intervals
+    :param agent_count: Number of agent participants
+    :return: PCA results for the call
+    :return: Conversation CTR data for the call
+    """
+    rand = random.Random(seed)
+    results = pcaresults.PCAResults()
+    results.analytics.speaker_labels = [{"Speaker": "spk_0", "DisplayText": "Agent"},
+                                        {"Speaker": "spk_1", "DisplayText": "Customer"}]
+    results.analytics.speaker_time = {"spk_0": {"TotalTimeSecs": 0.0}, "spk_1": {"TotalTimeSecs": 0.0}}
+    offset = 0.0
+    for index in range(segment_count):
+        segment = pcaresults.SpeechSegment()
+        segment.segmentSpeaker = "spk_0" if rand.random() < 0.6 else "spk_1"
+        segment.segmentStartTime = round(offset, 3)
+        words = []
+        for word in range(rand.randint(1, 12)):
+            duration = round(rand.uniform(0.1, 0.5), 3)
+            words.append({"Text": (" " if word else "") + f"w{word}", "StartTime": round(offset, 3),
+                          "EndTime": round(offset + duration, 3), "Confidence": 0.9})
+            offset += duration + round(rand.uniform(0.0, 0.15), 3)
+        segment.segmentConfidence = words
+        segment.segmentEndTime = words[-1]["EndTime"]
+        segment.segmentText = "".join(word["Text"] for word in words)
+        segment.segmentAllSentiments = {"Positive": 0.1, "Negative": 0.1, "Neutral": 0.8}
+        if rand.random() < 0.3:
+            segment.segmentCustomEntities = [
+                {"Type": "X", "Text": "w0", "BeginOffset": 0, "EndOffset": 2},
+                {"Type": "X", "Text": "w1", "BeginOffset": len(segment.segmentText) - 2,
+                 "EndOffset": len(segment.segmentText)}]
+        results.analytics.speaker_time[segment.segmentSpeaker]["TotalTimeSecs"] += \
+            segment.segmentEndTime - segment.segmentStartTime
+        results.speech_segments.append(segment)
+        offset += rand.uniform(0.05, 1.0)
+    call_length = offset
+
+    # IVR intervals can start before the call, and a few are "system" ones that aren't speech
+    ivr_segments = []
+    for index in range(ivr_count):
+        start = rand.uniform(-2, call_length)
+        ivr_segments.append({"segmentType": "ivr" if rand.random() < 0.8 else "system",
+                             "segmentStart": timestamp(start), "segmentEnd": timestamp(start + rand.uniform(0.5, 8))})
+    participants = [{"purpose": "ivr", "sessions": [{"segments": ivr_segments}]},
+                    {"purpose": "acd", "sessions": [{"segments": [
+                        {"segmentType": "interact", "segmentStart": timestamp(rand.uniform(0, call_length)),
+                         "segmentEnd": timestamp(rand.uniform(0, call_length))}
+                        for index in range(max(1, ivr_count // 10))]}]}]
+
+    # Agents can appear more than once, so the same user can have several participants
+    for agent in range(agent_count):
+        agent_segments = []
+        for index in range(rand.randint(1, 6)):
+            start = rand.uniform(0, call_length)
+            agent_segments.append({"segmentType": "interact", "segmentStart": timestamp(start),
+                                   "segmentEnd": timestamp(start + rand.uniform(5, call_length / 3))})
+        participants.append({"purpose": "agent", "userId": f"user{agent % max(1, agent_count - 1)}",
+                             "sessions": [{"mediaType": "voice", "segments": agent_segments}]})
+    participants.append({"purpose": "customer", "participantId": "customer-1", "sessions": []})
+
+    return results, {"conversationStart": timestamp(0), "originatingDirection": "inbound",
+                     "participants": participants}
+
+
+def run_step(module, results, conv_ctr, baseline):
+    """
+    Runs the IVR extraction and multiple-agent handling of a version of the Genesys CTR step over a call, giving it
+    the CTR in the form that it expects - the baseline takes the raw CTR, and the current step takes its index
+
+    :param module: Loaded Genesys CTR step
+    :param results: PCA results for the call, which are updated
+    :param conv_ctr: Conversation CTR data for the call
+    :param baseline: Flag to say that this is the baseline version of the step
+    :return: Seconds taken
+    :return: Number of unique agents and the customer id
+    """
+    ctr = conv_ctr
+    if not baseline:
+        call_ctr = {"id": "call-1", "conversationId": "conversation-1", "startTime": timestamp(0),
+                    "endTime": timestamp(1)}
+        ctr = json.loads(json.dumps(pcatelephonyctr.build_genesys_ctr_index(conv_ctr, call_ctr)))
+        results.cache_speaker_accumulators()
+
+    call_start_time = CALL_START.timestamp()
+    agent_channel = module.get_speaker_channel(results.analytics.speaker_labels, "agent")
+    start_time = time.perf_counter()
+    module.extract_ivr_lines(agent_channel, call_start_time, ctr, results.analytics, results)
+    unique_agents = module.handle_multiple_agents(agent_channel, call_start_time, ctr, results, 0)
+    customer_id = module.set_customer_id(results.analytics.speaker_labels, ctr)
+    return time.perf_counter() - start_time, (unique_agents, customer_id)
+
+
+def snapshot(results):
+    """
+    Serialises the parts of a call's results that the Genesys CTR step changes, so that two runs can be compared
+
+    :param results: PCA results for the call
+    :return: JSON string of the speech segments and speaker labels
+    """
+    return json.dumps({"segments": [vars(segment) for segment in results.speech_segments],
+                       "speakerLabels": results.analytics.speaker_labels}, sort_keys=True, default=str)
+
+
+def check_speaker_times(results):
+    """
+    Checks that every speaker's time is the total duration of their speech segments
+
+    :param results: PCA results for the call
+    :return: Flag to say that the speaker times are correct
+    """
+    segment_times = {}
+    for segment in results.speech_segments:
+        segment_times[segment.segmentSpeaker] = segment_times.get(segment.segmentSpeaker, 0.0) + \
+            segment.segmentEndTime - segment.segmentStartTime
+    return all(abs(speaker_time["TotalTimeSecs"] - segment_times.get(speaker, 0.0)) < 1e-6
+               for speaker, speaker_time in results.analytics.speaker_time.items())
+
+
+def compare_call(baseline_module, current_module, results, conv_ctr):
+    """
+    Runs both versions of the step over copies of the same call
+
+    :param baseline_module: Baseline version of the Genesys CTR step
+    :param current_module: Current version of the Genesys CTR step
+    :param results: PCA results for the call, which aren't changed
+    :param conv_ctr: Conversation CTR data for the call
+    :return: Flag to say that both gave the same results
+    :return: Seconds taken by the baseline and by the current step
+    """
+    outcomes = []
+    for module, baseline in [(baseline_module, True), (current_module, False)]:
+        call_results = copy.deepcopy(results)
+        try:
+            seconds, returned = run_step(module, call_results, conv_ctr, baseline)
+            outcomes.append((seconds, returned, snapshot(call_results), baseline or check_speaker_times(call_results)))
+        except Exception as e:
+            outcomes.append((0.0, f"{type(e).__name__}: {str(e)}", None, True))
+    same = (outcomes[0][1:3] == outcomes[1][1:3]) and outcomes[1][3]
+    return same, outcomes[0][0], outcomes[1][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares and times the Genesys CTR step against a baseline")
+    parser.add_argument("--baseline-ref", required=True,
+                        help="Git revision holding the baseline version of the Genesys CTR step")
+    parser.add_argument("--calls", type=int, default=300, help="Number of random calls to compare")
+    args = parser.parse_args()
+
+    cf.appConfig[cf.CONF_TELEPHONY_CTR] = "genesys"
+    baseline_module = load_baseline_module(args.baseline_ref)
+    current_module = load_module("genesys_current", os.path.join(REPO_ROOT, GENESYS_STEP_PATH))
+
+    # Small random calls cover the edge cases, such as IVR intervals that split segments or start before the call
+    mismatches = 0
+    for seed in range(args.calls):
+        rand = random.Random(seed)
+        results, conv_ctr = create_call(seed, rand.randint(2, 80), rand.randint(0, 30), rand.randint(0, 4))
+        same, baseline_seconds, current_seconds = compare_call(baseline_module, current_module, results, conv_ctr)
+        if not same:
+            mismatches += 1
+            print(f"Call {seed}: results differ from {args.baseline_ref}")
+    print(f"Compared {args.calls} calls against {args.baseline_ref}: {mismatches} mismatch(es)")
+
+    # Larger calls show how the two scale
+    for segment_count, ivr_count, agent_count in BENCHMARK_CALLS:
+        results, conv_ctr = create_call(99, segment_count, ivr_count, agent_count)
+        same, baseline_seconds, current_seconds = compare_call(baseline_module, current_module, results, conv_ctr)
+        print(f"{segment_count} segments, {ivr_count} IVR intervals, {agent_count} agents: "
+              f"baseline {baseline_seconds:.3f}s, current {current_seconds:.3f}s, "
+              f"speedup {baseline_seconds / max(current_seconds, 1e-9):.1f}x, same results {same}")
+        mismatches += 0 if same else 1
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()